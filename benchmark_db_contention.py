@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Benchmark SQLite under many teachers saving lessons and browsing at once
+
+Each simulated teacher runs in its own thread (like a WSGI worker thread)
+and repeatedly either saves a lesson and records API usage, or loads their
+lesson library. The run is repeated for each storage profile in
+differentiation_tool/db.py on a fresh temporary database.
+
+Usage: python benchmark_db_contention.py [--teachers N] [--seconds N] [--write-ratio F]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from differentiation_tool import db
+
+LESSON_BODY = ('<h2>Practice</h2><p>Trace the loop and record each value.</p>'
+               '<pre><code>for i in range(10):\n    total += i\n</code></pre>\n') * 120
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def teacher(user_id, deadline, write_ratio, results, lock):
+    rng = random.Random(user_id)
+    reads, writes, errors = [], [], 0
+
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            conn = db.get_db()
+            if rng.random() < write_ratio:
+                conn.execute('''
+                    INSERT INTO lessons (user_id, title, original_material_hash, content_hash, students_involved)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (user_id, f'Lesson {len(writes)}', db.put_content(conn, 'Loops worksheet'),
+                      db.put_content(conn, LESSON_BODY), 'Group A'))
+                conn.commit()
+                conn.close()
+                db.track_api_usage(user_id, 'generate_differentiated_content', 'Gemini API')
+                writes.append(time.perf_counter() - start)
+            else:
+                conn.execute(
+                    'SELECT * FROM lessons WHERE user_id = ? ORDER BY created_at DESC',
+                    (user_id,)
+                ).fetchall()
+                conn.close()
+                reads.append(time.perf_counter() - start)
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) and 'busy' not in str(e):
+                raise
+            errors += 1
+            conn.close()
+
+    with lock:
+        results['reads'].extend(reads)
+        results['writes'].extend(writes)
+        results['errors'] += errors
+
+
+def run_profile(profile, teachers, seconds, write_ratio):
+    tmp = tempfile.mkdtemp()
+    db.STORAGE_PROFILE = profile
+    db.configure(os.path.join(tmp, 'bench.db'))
+    db.init_db()
+
+    conn = db.get_db()
+    conn.executemany(
+        'INSERT INTO users (email, password_hash, first_name, last_name, is_active) VALUES (?, ?, ?, ?, 1)',
+        [(f'teacher{i}@example.com', 'x', 'Teacher', str(i)) for i in range(teachers)]
+    )
+    conn.commit()
+    conn.close()
+
+    results = {'reads': [], 'writes': [], 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+    threads = [threading.Thread(target=teacher, args=(i + 1, deadline, write_ratio, results, lock))
+               for i in range(teachers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    db.usage_recorder.flush()
+    db._pool.close_all()
+    ops = len(results['reads']) + len(results['writes'])
+    return {
+        'ops_per_sec': ops / seconds,
+        'writes': len(results['writes']),
+        'errors': results['errors'],
+        'read_p50': percentile(results['reads'], 50) * 1000,
+        'read_p95': percentile(results['reads'], 95) * 1000,
+        'write_p95': percentile(results['writes'], 95) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--teachers', type=int, default=24)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--write-ratio', type=float, default=0.3)
+    args = parser.parse_args()
+
+    print(f"{args.teachers} teachers, {args.seconds:g}s per profile, {args.write_ratio:.0%} writes\n")
+    print(f"{'profile':<10}{'ops/s':>9}{'writes':>9}{'locked':>9}{'read p50':>11}{'read p95':>11}{'write p95':>11}")
+    for profile in ('compat', 'wal'):
+        r = run_profile(profile, args.teachers, args.seconds, args.write_ratio)
+        print(f"{profile:<10}{r['ops_per_sec']:9.0f}{r['writes']:9d}{r['errors']:9d}"
+              f"{r['read_p50']:9.1f}ms{r['read_p95']:9.1f}ms{r['write_p95']:9.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
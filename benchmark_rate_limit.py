@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Benchmark Gemini calls under burst load against a quota-enforcing fake server
+
+A burst of teachers make calls at once through a fake model that allows
+--quota requests per second and answers the rest with a 429 carrying a
+retry-after hint, like Gemini does. Compares a single attempt per call (the
+old behaviour, where a 429 failed the teacher's request) with
+gemini_api.call_with_retry(), which goes through the per-key token bucket
+and retries with backoff.
+
+Pass --limit above --quota to see the limiter adapt when it is configured
+higher than the real quota.
+
+Usage: python benchmark_rate_limit.py [--teachers N] [--calls N] [--quota N] [--limit N]
+"""
+
+import argparse
+import threading
+import time
+
+from google.api_core import exceptions as google_exceptions
+
+from differentiation_tool import gemini_api
+
+
+class FakeQuotaServer:
+    """Allows `quota` requests per second (bursts up to one second's worth)"""
+
+    def __init__(self, quota, latency):
+        self.quota = quota
+        self.latency = latency
+        self.tokens = float(quota)
+        self.updated = time.monotonic()
+        self.accepted = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def generate_content(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.quota, self.tokens + (now - self.updated) * self.quota)
+            self.updated = now
+            if self.tokens < 1:
+                self.rejected += 1
+                wait = (1 - self.tokens) / self.quota
+                raise google_exceptions.ResourceExhausted(f'Quota exceeded. Please retry in {wait:.2f}s.')
+            self.tokens -= 1
+            self.accepted += 1
+        time.sleep(self.latency)
+        return 'ok'
+
+
+class FakeClient:
+    fingerprint = 'benchmark-key'
+
+
+def run(mode, teachers, calls, quota, limit, latency):
+    server = FakeQuotaServer(quota, latency)
+    gemini_api.rate_limiter = gemini_api.RateLimiter(rate=limit * 60, burst=limit)
+    results = {'ok': 0, 'failed': 0}
+    lock = threading.Lock()
+
+    def teacher():
+        for _ in range(calls):
+            try:
+                if mode == 'single attempt':
+                    server.generate_content()
+                else:
+                    gemini_api.call_with_retry(FakeClient(), server.generate_content)
+                outcome = 'ok'
+            except (google_exceptions.ResourceExhausted, gemini_api.GeminiBusyError):
+                outcome = 'failed'
+            with lock:
+                results[outcome] += 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=teacher) for _ in range(teachers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'ok': results['ok'],
+        'failed': results['failed'],
+        'rejected': server.rejected,
+        'seconds': elapsed,
+        'rate': results['ok'] / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--teachers', type=int, default=40)
+    parser.add_argument('--calls', type=int, default=3)
+    parser.add_argument('--quota', type=int, default=20, help='requests per second the fake server allows')
+    parser.add_argument('--limit', type=int, help='limiter requests per second (default: the quota)')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per successful call')
+    args = parser.parse_args()
+    limit = args.limit or args.quota
+
+    # Scale the backoff to the benchmark's one-second quota window
+    gemini_api.RETRY_BASE_DELAY = 0.1
+    gemini_api.RETRY_MAX_DELAY = 2.0
+
+    total = args.teachers * args.calls
+    print(f"{args.teachers} teachers x {args.calls} calls = {total} calls, quota {args.quota}/s, limiter {limit}/s\n")
+    print(f"{'mode':<18}{'ok':>6}{'failed':>8}{'429s':>7}{'seconds':>9}{'ok/s':>8}")
+    for mode in ('single attempt', 'limiter + retry'):
+        r = run(mode, args.teachers, args.calls, args.quota, limit, args.latency)
+        print(f"{mode:<18}{r['ok']:6d}{r['failed']:8d}{r['rejected']:7d}{r['seconds']:9.2f}{r['rate']:8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Benchmark markdown rendering of large generated lessons
+
+Compares building a fresh markdown pipeline per call (the old behaviour)
+with the rendering module's reused per-thread instance and code block cache,
+for whole documents and for a streamed response.
+
+Usage: python benchmark_rendering.py [--sections N] [--repeat N]
+"""
+
+import argparse
+import time
+
+import markdown
+
+from differentiation_tool import rendering
+
+CODE_SAMPLES = [
+    ('python', 'def average(scores):\n    """Return the mean score"""\n    total = 0\n'
+               '    for score in scores:\n        total += score\n    return total / len(scores)\n'),
+    ('java', 'public class Student {\n    private String name;\n    private int grade;\n\n'
+             '    public Student(String name, int grade) {\n        this.name = name;\n'
+             '        this.grade = grade;\n    }\n}\n'),
+    ('javascript', 'const items = document.querySelectorAll(".item");\n'
+                   'items.forEach((item, i) => {\n  item.textContent = `Item ${i + 1}`;\n});\n'),
+    ('', 'for i in range(10):\n    if i % 2 == 0:\n        print(i, "is even")\n'),
+]
+
+
+def build_lesson(sections):
+    """A lesson shaped like Gemini output: headings, lists, tables and lots of code"""
+    parts = ['# Differentiated Lesson: Working With Data\n']
+    for i in range(sections):
+        lang, code = CODE_SAMPLES[i % len(CODE_SAMPLES)]
+        parts.append(f'## Part {i + 1}: Practice\n')
+        parts.append('Read the example carefully, then **predict** the output before running it. '
+                     'Students using the *guided notes* should fill in each blank as they go.\n')
+        parts.append('- Identify the inputs\n- Trace each loop iteration\n- Compare with a partner\n')
+        parts.append(f'```{lang}\n{code}```\n')
+        parts.append('| Step | Value | Notes |\n|------|-------|-------|\n| 1 | 0 | start |\n| 2 | 5 | add |\n')
+        # Worked examples repeat the same snippet, as generated lessons often do
+        parts.append(f'Now modify the code:\n\n```{lang}\n{code}```\n')
+    return '\n'.join(parts)
+
+
+def fresh_pipeline(text):
+    return markdown.markdown(text, extensions=rendering.MARKDOWN_EXTENSIONS)
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def stream(text, chunk_size=80):
+    renderer = rendering.IncrementalMarkdownRenderer()
+    for i in range(0, len(text), chunk_size):
+        renderer.feed(text[i:i + chunk_size])
+    renderer.finish()
+    return renderer.full_html()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sections', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    lesson = build_lesson(args.sections)
+    print(f"Lesson: {len(lesson):,} characters, {lesson.count('```') // 2} code blocks\n")
+
+    assert rendering.render_markdown(lesson) == fresh_pipeline(lesson), "Cached pipeline output differs"
+
+    baseline = timed(lambda: fresh_pipeline(lesson), args.repeat)
+
+    def cold():
+        rendering.code_block_cache.clear()
+        rendering.render_markdown(lesson)
+    cold_ms = timed(cold, args.repeat)
+
+    rendering.render_markdown(lesson)
+    warm_ms = timed(lambda: rendering.render_markdown(lesson), args.repeat)
+
+    rendering.code_block_cache.clear()
+    stream_ms = timed(lambda: stream(lesson), max(1, args.repeat // 4))
+
+    print(f"{'Fresh pipeline per call':<36}{baseline:8.1f} ms")
+    print(f"{'Reused instance, code cache cleared':<36}{cold_ms:8.1f} ms")
+    print(f"{'Reused instance, warm code cache':<36}{warm_ms:8.1f} ms  ({baseline / warm_ms:.1f}x)")
+    print(f"{'Streamed fragments + full document':<36}{stream_ms:8.1f} ms")
+    print(f"\nCode block cache: {rendering.code_block_cache.stats()}")
+
+
+if __name__ == '__main__':
+    main()
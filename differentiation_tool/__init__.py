@@ -8,9 +8,12 @@ with accommodations, IEPs, and 504 plans.
 Usage:
     from differentiation_tool import bp
     app.register_blueprint(bp)
+
+The database is migrated when the blueprint is registered. Set the
+DIFF_DB_PATH config key (or environment variable) to choose its location.
 """
 
-from . import db  # This will auto-initialize the database
+from . import db
 from .routes import bp
 
 __version__ = '1.0.0'
@@ -4,11 +4,15 @@ Admin routes for user management and statistics
 from flask import render_template, request, redirect, url_for, session, flash
 from werkzeug.security import generate_password_hash
 from . import db
+from . import response_cache
 
 
 # This file contains admin routes that will be imported by routes.py
 # All routes are defined with the admin_required decorator applied
 
+# Columns the user manager displays (never password hashes or API keys)
+USER_LIST_COLUMNS = 'u.id, u.email, u.first_name, u.last_name, u.is_active, u.is_admin, u.created_at'
+
 def admin_dashboard_view():
     """Admin dashboard"""
     conn = db.get_db()
@@ -23,16 +27,18 @@ def admin_dashboard_view():
     active_users = conn.execute('SELECT COUNT(*) as count FROM users WHERE is_active = 1').fetchone()['count']
     admin_users = conn.execute('SELECT COUNT(*) as count FROM users WHERE is_admin = 1').fetchone()['count']
 
-    # Get total lessons
-    total_lessons = conn.execute('SELECT COUNT(*) as count FROM lessons').fetchone()['count']
+    # Get total lessons (from the per-teacher counters)
+    total_lessons = conn.execute(
+        'SELECT COALESCE(SUM(lessons_created_count), 0) as count FROM user_stats'
+    ).fetchone()['count']
 
-    # Get recent API usage
+    # Get recent API usage (from the daily rollup)
     recent_api_usage = conn.execute('''
-        SELECT COUNT(*) as count, DATE(created_at) as date
-        FROM api_usage
-        WHERE created_at >= date('now', '-7 days')
-        GROUP BY DATE(created_at)
-        ORDER BY date DESC
+        SELECT SUM(count) as count, day as date
+        FROM api_usage_daily
+        WHERE day >= date('now', '-7 days')
+        GROUP BY day
+        ORDER BY day DESC
     ''').fetchall()
 
     conn.close()
@@ -47,18 +53,36 @@ def admin_dashboard_view():
 
 
 def manage_users_view():
-    """List all users"""
+    """List users, newest first, or search them by name and email"""
     conn = db.get_db()
 
-    search = request.args.get('search', '')
-    if search:
-        users = conn.execute('''
-            SELECT * FROM users
-            WHERE email LIKE ? OR first_name LIKE ? OR last_name LIKE ?
-            ORDER BY created_at DESC
-        ''', (f'%{search}%', f'%{search}%', f'%{search}%')).fetchall()
+    search = request.args.get('search', '').strip()
+    match = db.fts_query(search) if search else None
+    after = request.args.get('after')
+    per_page = request.args.get('per_page', db.PAGE_SIZE)
+
+    if match:
+        # Best matches first (bm25 is lower for better matches); names weigh
+        # more than email
+        users = db.fetch_page(
+            conn,
+            f'{USER_LIST_COLUMNS}, f.score',
+            '''(
+                SELECT rowid, bm25(users_fts, 1.0, 2.0, 2.0) AS score
+                FROM users_fts WHERE users_fts MATCH ?
+            ) f
+            JOIN users u ON u.id = f.rowid''',
+            keys=(('f.score', 'score'), ('u.id', 'id')),
+            params=(match,), after=after, per_page=per_page, descending=False
+        )
+    elif search:
+        users = db.Page([], None, True, db.page_size(per_page))
     else:
-        users = conn.execute('SELECT * FROM users ORDER BY created_at DESC').fetchall()
+        users = db.fetch_page(
+            conn, USER_LIST_COLUMNS, 'users u',
+            keys=(('u.created_at', 'created_at'), ('u.id', 'id')),
+            after=after, per_page=per_page
+        )
 
     conn.close()
 
@@ -176,14 +200,11 @@ def bulk_delete_users_view():
         return redirect(url_for('differentiation.admin_users'))
 
     conn = db.get_db()
-
-    for user_id in user_ids:
-        conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
-
+    deleted = db.delete_users(conn, user_ids, keep_user_id=session['user_id'])
     conn.commit()
     conn.close()
 
-    flash(f'{len(user_ids)} user(s) deleted successfully!', 'success')
+    flash(f'{deleted} user(s) deleted successfully!', 'success')
     return redirect(url_for('differentiation.admin_users'))
 
 
@@ -202,50 +223,66 @@ def statistics_view():
     """View detailed statistics"""
     conn = db.get_db()
 
-    # Get all users with their stats
-    users_stats = conn.execute('''
-        SELECT u.id, u.email, u.first_name, u.last_name, u.is_admin, u.is_active, u.created_at,
-               COALESCE(s.api_requests_count, 0) as api_requests,
-               COALESCE(s.lessons_created_count, 0) as lessons_created,
-               COALESCE(s.students_count, 0) as students_count,
-               COALESCE(s.groups_count, 0) as groups_count
-        FROM users u
-        LEFT JOIN user_stats s ON u.id = s.user_id
-        ORDER BY api_requests DESC
-    ''').fetchall()
-
-    # Get API usage over time
+    # Users with their stats, busiest first, a page at a time (every user
+    # has a user_stats row)
+    users_stats = db.fetch_page(
+        conn,
+        '''s.user_id, u.email, u.first_name, u.last_name, u.is_admin, u.is_active, u.created_at,
+           s.api_requests_count as api_requests,
+           s.lessons_created_count as lessons_created,
+           s.students_count, s.groups_count,
+           s.prompt_tokens, s.cached_tokens, s.output_tokens,
+           ROUND(100.0 * s.cache_hits / NULLIF(s.metered, 0), 1) as cache_hit_rate''',
+        'user_stats s JOIN users u ON u.id = s.user_id',
+        keys=(('s.api_requests_count', 'api_requests'), ('s.user_id', 'user_id')),
+        after=request.args.get('after'),
+        per_page=request.args.get('per_page', db.PAGE_SIZE)
+    )
+
+    # Get API usage and tokens over time (from the daily rollup). Hit rate
+    # is the share of calls that read the curriculum cache; cached share
+    # is the part of all prompt tokens served from it.
     api_usage_timeline = conn.execute('''
-        SELECT DATE(created_at) as date, COUNT(*) as count
-        FROM api_usage
-        WHERE created_at >= date('now', '-30 days')
-        GROUP BY DATE(created_at)
-        ORDER BY date DESC
+        SELECT day as date, SUM(count) as count,
+               SUM(prompt_tokens) as prompt_tokens, SUM(cached_tokens) as cached_tokens,
+               SUM(output_tokens) as output_tokens,
+               ROUND(100.0 * SUM(cache_hits) / NULLIF(SUM(metered), 0), 1) as cache_hit_rate,
+               ROUND(100.0 * SUM(cached_tokens) / NULLIF(SUM(prompt_tokens), 0), 1) as cached_share,
+               SUM(latency_ms) / NULLIF(SUM(metered), 0) as avg_latency_ms
+        FROM api_usage_daily
+        WHERE day >= date('now', '-30 days')
+        GROUP BY day
+        ORDER BY day DESC
     ''').fetchall()
 
     # Get top API users
     top_api_users = conn.execute('''
-        SELECT u.first_name, u.last_name, u.email, COUNT(a.id) as api_count
-        FROM users u
-        JOIN api_usage a ON u.id = a.user_id
-        GROUP BY u.id
-        ORDER BY api_count DESC
+        SELECT u.first_name, u.last_name, u.email, s.api_requests_count as api_count
+        FROM user_stats s
+        JOIN users u ON u.id = s.user_id
+        WHERE s.api_requests_count > 0
+        ORDER BY s.api_requests_count DESC
         LIMIT 10
     ''').fetchall()
 
-    # Get lessons created over time
+    # Get lessons created over time (from the daily rollup)
     lessons_timeline = conn.execute('''
-        SELECT DATE(created_at) as date, COUNT(*) as count
-        FROM lessons
-        WHERE created_at >= date('now', '-30 days')
-        GROUP BY DATE(created_at)
-        ORDER BY date DESC
+        SELECT day as date, SUM(count) as count
+        FROM lessons_daily
+        WHERE day >= date('now', '-30 days')
+        GROUP BY day
+        HAVING SUM(count) > 0
+        ORDER BY day DESC
     ''').fetchall()
 
     conn.close()
 
+    # Get shared response cache effectiveness
+    response_cache_stats = response_cache.get_stats()
+
     return render_template('differentiation_tool/admin/statistics.html',
                          users_stats=users_stats,
                          api_usage_timeline=api_usage_timeline,
                          top_api_users=top_api_users,
-                         lessons_timeline=lessons_timeline)
+                         lessons_timeline=lessons_timeline,
+                         response_cache_stats=response_cache_stats)
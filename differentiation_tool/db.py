@@ -1,23 +1,308 @@
 import sqlite3
 import os
+import re
+import json
+import base64
+import hashlib
+import zlib
+import threading
+import time
+import atexit
+import itertools
+import logging
 from datetime import datetime
+from flask import g, has_request_context
 from werkzeug.security import generate_password_hash
+from markupsafe import Markup, escape
+from . import rendering
+
+logger = logging.getLogger(__name__)
 
 # Get the directory where this file is located
 DB_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(DB_DIR, 'differentiation.db')
+
+# Database file; override with DIFF_DB_PATH (or the DIFF_DB_PATH app config
+# key), or use ':memory:' for a throwaway database in tests
+DB_PATH = os.environ.get('DIFF_DB_PATH') or os.path.join(DB_DIR, 'differentiation.db')
+MEMORY_DB = ':memory:'
+
+# zlib level for stored lesson and session text (see put_content)
+CONTENT_COMPRESSION_LEVEL = 6
+
+# Rows converted per batch when migration 7 moves text into content_blobs
+CONTENT_MIGRATION_BATCH_SIZE = 500
+
+# Rows per page in list views, and the most a request may ask for
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Idle connections kept open for reuse
+POOL_SIZE = 8
+
+# Prepared statements cached per connection
+STATEMENT_CACHE_SIZE = 256
+
+# Connection settings, selected with DIFF_DB_PROFILE. 'wal' lets library
+# readers run alongside writers and waits out short write locks instead of
+# failing with "database is locked". 'compat' keeps SQLite's rollback journal
+# for filesystems where WAL's shared-memory index is unsafe (e.g. network
+# mounts).
+STORAGE_PROFILES = {
+    'wal': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 10000,         # ms to wait for a lock before giving up
+        'mmap_size': 64 * 1024 * 1024,
+        'cache_size': -16000,          # negative = KiB, i.e. ~16 MB per connection
+        'checkpoint_interval': 60,     # seconds between WAL checkpoints
+    },
+    'compat': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'busy_timeout': 10000,
+        'mmap_size': 0,
+        'cache_size': -2000,
+        'checkpoint_interval': None,
+    },
+}
+STORAGE_PROFILE = os.environ.get('DIFF_DB_PROFILE', 'wal')
+
+# API usage recording, selected with DIFF_USAGE_MODE. Events are buffered and
+# written by a background thread in batches once max_events are pending or
+# the oldest is max_delay seconds old, so a crash loses at most max_events
+# events or max_delay seconds of usage. If writes fall behind, only the
+# newest max_pending events are kept. 'safe' keeps the window small, 'sync'
+# writes every event as soon as it is recorded.
+USAGE_MODES = {
+    'buffered': {'max_events': 200, 'max_delay': 5.0, 'max_pending': 5000},
+    'safe': {'max_events': 20, 'max_delay': 0.5, 'max_pending': 5000},
+    'sync': {'max_events': 1, 'max_delay': 0, 'max_pending': 5000},
+}
+USAGE_MODE = os.environ.get('DIFF_USAGE_MODE', 'buffered')
+
+# Seconds to wait before retrying a batch that hit a transient error (e.g.
+# the database stayed locked), doubling up to USAGE_RETRY_MAX_DELAY
+USAGE_RETRY_DELAY = 1.0
+USAGE_RETRY_MAX_DELAY = 60.0
+
+class PooledConnection(sqlite3.Connection):
+    """
+    A sqlite3 connection that goes back to the pool instead of closing
+
+    Within a request, get_db() always returns the same connection and
+    close() does nothing; it is released when the request ends. Outside a
+    request (background jobs, scripts), close() releases it immediately.
+    """
+    request_bound = False
+    in_pool = False
+
+    def close(self):
+        if not self.request_bound:
+            _pool.release(self)
+
+class ConnectionPool:
+    """Keeps up to max_idle open connections to DB_PATH"""
+
+    def __init__(self, max_idle=POOL_SIZE):
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._last_checkpoint = time.monotonic()
+
+    def _connect(self):
+        profile = STORAGE_PROFILES[STORAGE_PROFILE]
+        database = _database_target()
+        conn = sqlite3.connect(database, factory=PooledConnection,
+                               timeout=profile['busy_timeout'] / 1000,
+                               cached_statements=STATEMENT_CACHE_SIZE,
+                               check_same_thread=False,
+                               uri=database.startswith('file:'))
+        conn.row_factory = sqlite3.Row
+        conn.db_path = database
+        conn.profile = STORAGE_PROFILE
+        # Per-connection settings, applied once when the connection is opened
+        conn.execute('PRAGMA foreign_keys = ON')
+        conn.execute(f"PRAGMA busy_timeout = {int(profile['busy_timeout'])}")
+        conn.execute(f"PRAGMA journal_mode = {profile['journal_mode']}")
+        conn.execute(f"PRAGMA synchronous = {profile['synchronous']}")
+        conn.execute(f"PRAGMA mmap_size = {int(profile['mmap_size'])}")
+        conn.execute(f"PRAGMA cache_size = {int(profile['cache_size'])}")
+        if _statement_tracer is not None:
+            conn.set_trace_callback(_statement_tracer)
+        return conn
+
+    def _is_current(self, conn):
+        return conn.db_path == _database_target() and conn.profile == STORAGE_PROFILE
+
+    def _maybe_checkpoint(self, conn):
+        """Copy the WAL back into the database every checkpoint_interval seconds"""
+        interval = STORAGE_PROFILES[conn.profile]['checkpoint_interval']
+        if not interval:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_checkpoint < interval:
+                return
+            self._last_checkpoint = now
+        # PASSIVE never waits on readers or writers; whatever it cannot copy
+        # now is picked up by the next checkpoint
+        conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+
+    def checkpoint(self, mode='TRUNCATE'):
+        """Run a WAL checkpoint now (TRUNCATE also resets the WAL file)"""
+        conn = self.acquire()
+        try:
+            return conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone()
+        finally:
+            self.release(conn)
+
+    def acquire(self):
+        with self._lock:
+            while self._idle:
+                conn = self._idle.pop()
+                conn.in_pool = False
+                if self._is_current(conn):
+                    return conn
+                sqlite3.Connection.close(conn)
+        return self._connect()
+
+    def release(self, conn):
+        """
+        Roll back anything left uncommitted and keep the connection for reuse
+
+        Releasing a connection that is already back in the pool (a second
+        close() outside a request) does nothing.
+        """
+        with self._lock:
+            if conn.in_pool:
+                return
+        conn.request_bound = False
+        try:
+            conn.rollback()
+            self._maybe_checkpoint(conn)
+        except sqlite3.Error:
+            sqlite3.Connection.close(conn)
+            return
+        with self._lock:
+            if conn.in_pool:
+                return
+            if len(self._idle) < self.max_idle and self._is_current(conn):
+                conn.in_pool = True
+                self._idle.append(conn)
+                return
+        sqlite3.Connection.close(conn)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.in_pool = False
+            sqlite3.Connection.close(conn)
+
+_pool = ConnectionPool()
+
+# Called with each statement run on a pooled connection (see trace_statements)
+_statement_tracer = None
+
+def trace_statements(callback):
+    """
+    Call callback(sql) with every statement run on pooled connections
+
+    The test suite uses this to collect the queries the app actually runs
+    and check their plans. Idle connections are closed so new ones pick it
+    up; pass None to stop tracing.
+    """
+    global _statement_tracer
+    _statement_tracer = callback
+    _pool.close_all()
+
+# In-memory databases use SQLite's memdb VFS under a unique name, so every
+# pooled connection sees the same data with normal locking (unlike shared
+# cache, busy_timeout applies). The database lives as long as one connection
+# to it is open, so configure() holds one.
+_memory_names = itertools.count(1)
+_memory_uri = None
+_memory_keepalive = None
+
+def _database_target():
+    """What sqlite3.connect() should open for the current DB_PATH"""
+    if DB_PATH == MEMORY_DB:
+        if _memory_uri is None:
+            configure(MEMORY_DB)
+        return _memory_uri
+    return DB_PATH
+
+def configure(path):
+    """
+    Point the connection pool at a different database
+
+    Args:
+        path: Database file path, or MEMORY_DB (':memory:') for a fresh
+              in-memory database shared by this process's connections
+    """
+    global DB_PATH, _memory_uri, _memory_keepalive
+    # Pending usage events belong to the current database
+    usage_recorder.flush()
+    _pool.close_all()
+    if _memory_keepalive is not None:
+        sqlite3.Connection.close(_memory_keepalive)
+        _memory_keepalive = None
+
+    DB_PATH = path
+    if path == MEMORY_DB:
+        _memory_uri = f'file:/differentiation-{os.getpid()}-{next(_memory_names)}?vfs=memdb'
+        _memory_keepalive = _pool._connect()
+    else:
+        _memory_uri = None
+
+def checkpoint(mode='TRUNCATE'):
+    """Fold the write-ahead log back into the database file"""
+    if STORAGE_PROFILES[STORAGE_PROFILE]['journal_mode'] == 'WAL':
+        return _pool.checkpoint(mode)
+
+def _shutdown():
+    usage_recorder.flush()
+    # Skip the checkpoint if this process never opened the database
+    if _pool._idle:
+        try:
+            checkpoint()
+        except sqlite3.Error:
+            pass
+    _pool.close_all()
+
+atexit.register(_shutdown)
 
 def get_db():
-    """Get a database connection"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    """
+    Get a database connection
+
+    Inside a request this is one shared connection (and transaction) for the
+    whole request, so route code and the helpers below see each other's
+    writes. Callers still close() it as before.
+    """
+    if not has_request_context():
+        return _pool.acquire()
+
+    conn = g.get('db_conn')
+    if conn is None:
+        conn = _pool.acquire()
+        conn.request_bound = True
+        g.db_conn = conn
     return conn
 
-def init_db():
-    """Initialize the database with all required tables"""
-    conn = get_db()
-    cursor = conn.cursor()
+def close_db(exception=None):
+    """Release the request's connection back to the pool (teardown handler)"""
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        _pool.release(conn)
 
+def _migration_1(cursor):
+    """
+    Baseline schema
+
+    Databases created before migrations were tracked may be missing some of
+    these columns and tables, so everything here tolerates existing objects.
+    """
     # Users table (teachers)
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -30,6 +315,7 @@ def init_db():
             is_active INTEGER DEFAULT 0,
             gemini_api_key TEXT,
             default_key_requests INTEGER DEFAULT 0,
+            response_cache_enabled INTEGER DEFAULT 1,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
@@ -56,6 +342,12 @@ def init_db():
     except sqlite3.OperationalError:
         pass  # Column already exists
 
+    # Add response cache opt-out column if it doesn't exist (migration)
+    try:
+        cursor.execute('ALTER TABLE users ADD COLUMN response_cache_enabled INTEGER DEFAULT 1')
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+
     # API usage tracking table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS api_usage (
@@ -131,6 +423,7 @@ def init_db():
             approved_suggestions TEXT,
             final_content TEXT,
             selected_standards TEXT,
+            job_error TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
@@ -143,6 +436,12 @@ def init_db():
     except sqlite3.OperationalError:
         pass  # Column already exists
 
+    # Add job_error column for background generation failures (migration)
+    try:
+        cursor.execute('ALTER TABLE diff_sessions ADD COLUMN job_error TEXT')
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+
     # Session students (which students/groups are involved)
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS session_students (
@@ -154,6 +453,20 @@ def init_db():
         )
     ''')
 
+    # Generated suggestions, one row per suggestion with its rendered HTML
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS session_suggestions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            text_html TEXT NOT NULL,
+            applies_to TEXT,
+            approved INTEGER DEFAULT 0,
+            FOREIGN KEY (session_id) REFERENCES diff_sessions (id) ON DELETE CASCADE
+        )
+    ''')
+
     # Saved lessons (lesson library)
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS lessons (
@@ -170,61 +483,951 @@ def init_db():
         )
     ''')
 
-    conn.commit()
-    conn.close()
+    # Shared cache of Gemini responses, keyed by a hash of the prompt inputs
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            cache_key TEXT PRIMARY KEY,
+            endpoint TEXT NOT NULL,
+            response TEXT NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            hit_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
 
-def track_api_usage(user_id, endpoint, request_type):
-    """Track API usage for statistics"""
-    conn = get_db()
+    # Response cache hit/miss counters per endpoint
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS response_cache_stats (
+            endpoint TEXT PRIMARY KEY,
+            hits INTEGER DEFAULT 0,
+            misses INTEGER DEFAULT 0
+        )
+    ''')
+
+    # Secondary indexes for the per-teacher list views, admin date ranges and
+    # foreign key cascades (tests/test_query_plans.py keeps these in use)
+    for statement in (
+        'CREATE INDEX IF NOT EXISTS idx_users_active_created ON users (is_active, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_students_user_name ON students (user_id, last_name, first_name)',
+        'CREATE INDEX IF NOT EXISTS idx_groups_user_name ON groups (user_id, name)',
+        'CREATE INDEX IF NOT EXISTS idx_group_members_student ON group_members (student_id)',
+        'CREATE INDEX IF NOT EXISTS idx_diff_sessions_user_updated ON diff_sessions (user_id, updated_at)',
+        'CREATE INDEX IF NOT EXISTS idx_session_students_session ON session_students (session_id, student_id)',
+        'CREATE INDEX IF NOT EXISTS idx_session_students_student ON session_students (student_id)',
+        'CREATE INDEX IF NOT EXISTS idx_session_suggestions_session ON session_suggestions (session_id, position)',
+        'CREATE INDEX IF NOT EXISTS idx_lessons_user_created ON lessons (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_lessons_created ON lessons (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_lessons_session ON lessons (session_id)',
+        'CREATE INDEX IF NOT EXISTS idx_api_usage_created ON api_usage (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_api_usage_user ON api_usage (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_response_cache_created ON response_cache (created_at)',
+    ):
+        cursor.execute(statement)
+
+def _migration_2(cursor):
+    """Keep user_stats and group member counts exact with triggers"""
+    cursor.execute('ALTER TABLE groups ADD COLUMN member_count INTEGER NOT NULL DEFAULT 0')
+
+    # Per-teacher counters follow inserts and deletes (including cascades)
+    for table, column in (('students', 'students_count'),
+                          ('groups', 'groups_count'),
+                          ('lessons', 'lessons_created_count')):
+        cursor.execute(f'''
+            CREATE TRIGGER trg_{table}_stats_insert AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO user_stats (user_id, {column}, last_updated)
+                VALUES (NEW.user_id, 1, CURRENT_TIMESTAMP)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    {column} = {column} + 1,
+                    last_updated = CURRENT_TIMESTAMP;
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER trg_{table}_stats_delete AFTER DELETE ON {table}
+            BEGIN
+                UPDATE user_stats SET {column} = {column} - 1, last_updated = CURRENT_TIMESTAMP
+                WHERE user_id = OLD.user_id;
+            END
+        ''')
+
+    cursor.execute('''
+        CREATE TRIGGER trg_group_members_insert AFTER INSERT ON group_members
+        BEGIN
+            UPDATE groups SET member_count = member_count + 1 WHERE id = NEW.group_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_group_members_delete AFTER DELETE ON group_members
+        BEGIN
+            UPDATE groups SET member_count = member_count - 1 WHERE id = OLD.group_id;
+        END
+    ''')
+
+    # Backfill from existing rows
+    cursor.execute('''
+        INSERT INTO user_stats (user_id) SELECT id FROM users WHERE true
+        ON CONFLICT(user_id) DO NOTHING
+    ''')
+    cursor.execute('''
+        UPDATE user_stats SET
+            students_count = (SELECT COUNT(*) FROM students WHERE user_id = user_stats.user_id),
+            groups_count = (SELECT COUNT(*) FROM groups WHERE user_id = user_stats.user_id),
+            lessons_created_count = (SELECT COUNT(*) FROM lessons WHERE user_id = user_stats.user_id),
+            last_updated = CURRENT_TIMESTAMP
+    ''')
+    cursor.execute('''
+        UPDATE groups SET member_count = (SELECT COUNT(*) FROM group_members WHERE group_id = groups.id)
+    ''')
+
+def _migration_3(cursor):
+    """Daily rollups of API usage and lessons for the admin views"""
+    cursor.execute('''
+        CREATE TABLE api_usage_daily (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            endpoint TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, user_id, endpoint),
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE lessons_daily (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, user_id),
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX idx_api_usage_daily_user ON api_usage_daily (user_id)')
+    cursor.execute('CREATE INDEX idx_lessons_daily_user ON lessons_daily (user_id)')
+    cursor.execute('CREATE INDEX idx_user_stats_api_requests ON user_stats (api_requests_count)')
+    # The date-range reports read the rollups now, and api_usage and lessons
+    # are the busiest insert tables
+    cursor.execute('DROP INDEX IF EXISTS idx_api_usage_created')
+    cursor.execute('DROP INDEX IF EXISTS idx_lessons_created')
+
+    # api_usage rows also drive user_stats.api_requests_count from here on
+    cursor.execute('''
+        CREATE TRIGGER trg_api_usage_rollup AFTER INSERT ON api_usage
+        BEGIN
+            INSERT INTO api_usage_daily (day, user_id, endpoint, count)
+            VALUES (DATE(NEW.created_at), NEW.user_id, NEW.endpoint, 1)
+            ON CONFLICT(day, user_id, endpoint) DO UPDATE SET count = count + 1;
+
+            INSERT INTO user_stats (user_id, api_requests_count, last_updated)
+            VALUES (NEW.user_id, 1, CURRENT_TIMESTAMP)
+            ON CONFLICT(user_id) DO UPDATE SET
+                api_requests_count = api_requests_count + 1,
+                last_updated = CURRENT_TIMESTAMP;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_lessons_rollup_insert AFTER INSERT ON lessons
+        BEGIN
+            INSERT INTO lessons_daily (day, user_id, count)
+            VALUES (DATE(NEW.created_at), NEW.user_id, 1)
+            ON CONFLICT(day, user_id) DO UPDATE SET count = count + 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_lessons_rollup_delete AFTER DELETE ON lessons
+        BEGIN
+            UPDATE lessons_daily SET count = count - 1
+            WHERE day = DATE(OLD.created_at) AND user_id = OLD.user_id;
+        END
+    ''')
+
+    # Backfill from existing history
+    cursor.execute('''
+        INSERT INTO api_usage_daily (day, user_id, endpoint, count)
+        SELECT DATE(created_at), user_id, endpoint, COUNT(*) FROM api_usage
+        GROUP BY DATE(created_at), user_id, endpoint
+    ''')
+    cursor.execute('''
+        INSERT INTO lessons_daily (day, user_id, count)
+        SELECT DATE(created_at), user_id, COUNT(*) FROM lessons
+        GROUP BY DATE(created_at), user_id
+    ''')
+    cursor.execute('''
+        UPDATE user_stats SET api_requests_count = COALESCE(
+            (SELECT SUM(count) FROM api_usage_daily WHERE user_id = user_stats.user_id), 0)
+    ''')
+
+def _migration_4(cursor):
+    """Full-text user search for the admin user manager"""
+    # External content table: the index lives in users_fts, the text stays in
+    # users. Prefix indexes make 2- and 3-character prefix queries cheap.
+    cursor.execute('''
+        CREATE VIRTUAL TABLE users_fts USING fts5(
+            email, first_name, last_name,
+            content='users', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_users_fts_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO users_fts (rowid, email, first_name, last_name)
+            VALUES (NEW.id, NEW.email, NEW.first_name, NEW.last_name);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_users_fts_delete AFTER DELETE ON users
+        BEGIN
+            INSERT INTO users_fts (users_fts, rowid, email, first_name, last_name)
+            VALUES ('delete', OLD.id, OLD.email, OLD.first_name, OLD.last_name);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_users_fts_update AFTER UPDATE OF email, first_name, last_name ON users
+        BEGIN
+            INSERT INTO users_fts (users_fts, rowid, email, first_name, last_name)
+            VALUES ('delete', OLD.id, OLD.email, OLD.first_name, OLD.last_name);
+            INSERT INTO users_fts (rowid, email, first_name, last_name)
+            VALUES (NEW.id, NEW.email, NEW.first_name, NEW.last_name);
+        END
+    ''')
+    cursor.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+    # Keyset pagination of the unfiltered user list
+    cursor.execute('CREATE INDEX idx_users_created ON users (created_at, id)')
+
+def _migration_5(cursor):
+    """Full-text search of each teacher's lesson library"""
+    # The index keeps its own plain-text copy of each lesson (content is
+    # stored as rendered HTML) so snippets can be cut from it. 'owner' holds
+    # a u<user_id> token, so a teacher's search only visits their lessons.
+    cursor.execute('''
+        CREATE VIRTUAL TABLE lessons_fts USING fts5(
+            owner, title, original_material, content, students_involved,
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    # Rows are added by index_lesson(); deletes (including cascades from
+    # users) are handled here
+    cursor.execute('''
+        CREATE TRIGGER trg_lessons_fts_delete AFTER DELETE ON lessons
+        BEGIN
+            DELETE FROM lessons_fts WHERE rowid = OLD.id;
+        END
+    ''')
+    lessons = cursor.execute('''
+        SELECT id, user_id, title, original_material, differentiated_content, students_involved
+        FROM lessons
+    ''')
+    for lesson in lessons.fetchall():
+        index_lesson(cursor, *lesson)
+
+def _migration_6(cursor):
+    """A user_stats row for every user, so admin statistics can page by index"""
+    cursor.execute('''
+        CREATE TRIGGER trg_users_stats_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO user_stats (user_id) VALUES (NEW.id)
+            ON CONFLICT(user_id) DO NOTHING;
+        END
+    ''')
+    cursor.execute('''
+        INSERT INTO user_stats (user_id) SELECT id FROM users WHERE true
+        ON CONFLICT(user_id) DO NOTHING
+    ''')
+
+# Columns that hold a content_blobs hash instead of text: table -> (hash column, old text column)
+CONTENT_COLUMNS = {
+    'diff_sessions': (('original_material_hash', 'original_material'),
+                      ('final_content_hash', 'final_content')),
+    'lessons': (('original_material_hash', 'original_material'),
+                ('content_hash', 'differentiated_content')),
+}
+
+def _migration_7(cursor):
+    """Move session and lesson text into a compressed, deduplicated blob store"""
+    # Rowid table on purpose: SQLite advises against WITHOUT ROWID for
+    # rows this large
+    cursor.execute('''
+        CREATE TABLE content_blobs (
+            hash TEXT PRIMARY KEY,
+            compression TEXT,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            refs INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    for table, columns in CONTENT_COLUMNS.items():
+        for hash_column, _ in columns:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {hash_column} TEXT')
+
+        # Reference counts follow the rows that point at each blob; a blob
+        # is deleted when its last reference goes. Each column is counted
+        # separately, so a row using one blob twice holds two references.
+        added = ''.join(f'''
+            UPDATE content_blobs SET refs = refs + 1 WHERE hash = NEW.{c};''' for c, _ in columns)
+        cursor.execute(f'''
+            CREATE TRIGGER trg_{table}_content_insert AFTER INSERT ON {table}
+            BEGIN{added}
+            END
+        ''')
+        removed = ''.join(f'''
+            UPDATE content_blobs SET refs = refs - 1 WHERE hash = OLD.{c};''' for c, _ in columns)
+        old_hashes = ', '.join(f'OLD.{c}' for c, _ in columns)
+        cursor.execute(f'''
+            CREATE TRIGGER trg_{table}_content_delete AFTER DELETE ON {table}
+            BEGIN{removed}
+                DELETE FROM content_blobs WHERE hash IN ({old_hashes}) AND refs <= 0;
+            END
+        ''')
+        for c, _ in columns:
+            cursor.execute(f'''
+                CREATE TRIGGER trg_{table}_{c}_update AFTER UPDATE OF {c} ON {table}
+                WHEN OLD.{c} IS NOT NEW.{c}
+                BEGIN
+                    UPDATE content_blobs SET refs = refs + 1 WHERE hash = NEW.{c};
+                    UPDATE content_blobs SET refs = refs - 1 WHERE hash = OLD.{c};
+                    DELETE FROM content_blobs WHERE hash = OLD.{c} AND refs <= 0;
+                END
+            ''')
+
+        # Convert existing rows a batch at a time in id order (the update
+        # triggers count the references), then drop the text columns
+        text_columns = ', '.join(text for _, text in columns)
+        assignments = ', '.join(f'{c} = ?' for c, _ in columns)
+        last_id = 0
+        while True:
+            rows = cursor.execute(f'''
+                SELECT id, {text_columns} FROM {table} WHERE id > ? ORDER BY id LIMIT ?
+            ''', (last_id, CONTENT_MIGRATION_BATCH_SIZE)).fetchall()
+            if not rows:
+                break
+            updates = []
+            for row_id, *texts in rows:
+                updates.append((*(put_content(cursor, text) for text in texts), row_id))
+            cursor.executemany(f'UPDATE {table} SET {assignments} WHERE id = ?', updates)
+            last_id = rows[-1][0]
+        for _, text in columns:
+            cursor.execute(f'ALTER TABLE {table} DROP COLUMN {text}')
+
+def _migration_8(cursor):
+    """Batches: one material differentiated for several groups at once"""
+    cursor.execute('''
+        CREATE TABLE batches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            title TEXT,
+            saved_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('CREATE INDEX idx_batches_user ON batches (user_id)')
+
+    # Each session in a batch is the version for one group
+    cursor.execute('ALTER TABLE diff_sessions ADD COLUMN batch_id INTEGER REFERENCES batches (id) ON DELETE CASCADE')
+    cursor.execute('ALTER TABLE diff_sessions ADD COLUMN group_id INTEGER REFERENCES groups (id) ON DELETE SET NULL')
+    cursor.execute('CREATE INDEX idx_diff_sessions_batch ON diff_sessions (batch_id)')
+    cursor.execute('CREATE INDEX idx_diff_sessions_group ON diff_sessions (group_id)')
+
+# Per-call Gemini metadata on api_usage, summed into the rollups. "metered"
+# counts the calls that carry it (older rows and calls recorded elsewhere
+# do not), and "cache_hits" the calls that read curriculum cache tokens.
+USAGE_METADATA_COLUMNS = ('model', 'cache_name', 'prompt_tokens', 'cached_tokens', 'output_tokens', 'latency_ms')
+USAGE_TOTAL_COLUMNS = ('metered', 'prompt_tokens', 'cached_tokens', 'output_tokens', 'cache_hits', 'latency_ms')
+
+def _migration_9(cursor):
+    """Token counts, latency, model and curriculum cache per Gemini call"""
+    for column in USAGE_METADATA_COLUMNS:
+        column_type = 'TEXT' if column in ('model', 'cache_name') else 'INTEGER'
+        cursor.execute(f'ALTER TABLE api_usage ADD COLUMN {column} {column_type}')
+    for table in ('api_usage_daily', 'user_stats'):
+        for column in USAGE_TOTAL_COLUMNS:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0')
+
+    totals = '''NEW.latency_ms IS NOT NULL, COALESCE(NEW.prompt_tokens, 0), COALESCE(NEW.cached_tokens, 0),
+                COALESCE(NEW.output_tokens, 0), COALESCE(NEW.cached_tokens, 0) > 0, COALESCE(NEW.latency_ms, 0)'''
+    add_totals = ''.join(f''',
+                {column} = {column} + excluded.{column}''' for column in USAGE_TOTAL_COLUMNS)
+    cursor.execute('DROP TRIGGER trg_api_usage_rollup')
+    cursor.execute(f'''
+        CREATE TRIGGER trg_api_usage_rollup AFTER INSERT ON api_usage
+        BEGIN
+            INSERT INTO api_usage_daily (day, user_id, endpoint, count, {', '.join(USAGE_TOTAL_COLUMNS)})
+            VALUES (DATE(NEW.created_at), NEW.user_id, NEW.endpoint, 1,
+                {totals})
+            ON CONFLICT(day, user_id, endpoint) DO UPDATE SET count = count + 1{add_totals};
+
+            INSERT INTO user_stats (user_id, api_requests_count, last_updated, {', '.join(USAGE_TOTAL_COLUMNS)})
+            VALUES (NEW.user_id, 1, CURRENT_TIMESTAMP,
+                {totals})
+            ON CONFLICT(user_id) DO UPDATE SET
+                api_requests_count = api_requests_count + 1,
+                last_updated = CURRENT_TIMESTAMP{add_totals};
+        END
+    ''')
+
+def _migration_10(cursor):
+    """Section of long, chunked material each suggestion targets"""
+    cursor.execute('ALTER TABLE session_suggestions ADD COLUMN section TEXT')
+
+# Schema migrations, applied in order. The database's PRAGMA user_version is
+# the number of migrations already applied. Append new migrations; never
+# edit one that has shipped.
+MIGRATIONS = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+    _migration_6,
+    _migration_7,
+    _migration_8,
+    _migration_9,
+    _migration_10,
+]
+
+def put_content(conn, text):
+    """
+    Store text in content_blobs and return its hash
+
+    Identical text is stored once (e.g. a lesson shares its blobs with the
+    session it was saved from). Text is zlib-compressed unless that does
+    not make it smaller. The blob lives as long as a row references its
+    hash, so call this in the same transaction as the insert or update
+    that stores the hash.
+
+    Returns:
+        The hash to store in a *_hash column, or None for None
+    """
+    if text is None:
+        return None
+    raw = text.encode('utf-8')
+    digest = hashlib.sha256(raw).hexdigest()
+    if conn.execute('SELECT 1 FROM content_blobs WHERE hash = ?', (digest,)).fetchone():
+        return digest
+
+    compressed = zlib.compress(raw, CONTENT_COMPRESSION_LEVEL)
+    if len(compressed) < len(raw):
+        compression, data = 'zlib', compressed
+    else:
+        compression, data = None, raw
     conn.execute(
-        'INSERT INTO api_usage (user_id, endpoint, request_type) VALUES (?, ?, ?)',
-        (user_id, endpoint, request_type)
+        'INSERT INTO content_blobs (hash, compression, size, data) VALUES (?, ?, ?, ?) '
+        'ON CONFLICT(hash) DO NOTHING',
+        (digest, compression, len(raw), data)
     )
+    return digest
 
-    # Update user stats
-    conn.execute('''
-        INSERT INTO user_stats (user_id, api_requests_count, last_updated)
-        VALUES (?, 1, CURRENT_TIMESTAMP)
-        ON CONFLICT(user_id) DO UPDATE SET
-            api_requests_count = api_requests_count + 1,
-            last_updated = CURRENT_TIMESTAMP
-    ''', (user_id,))
+def _decode_content(compression, data):
+    if data is None:
+        return None
+    if compression == 'zlib':
+        data = zlib.decompress(data)
+    return bytes(data).decode('utf-8')
 
-    conn.commit()
-    conn.close()
+def get_content(conn, content_hash):
+    """Text stored under a hash by put_content(), or None"""
+    if content_hash is None:
+        return None
+    row = conn.execute('SELECT compression, data FROM content_blobs WHERE hash = ?', (content_hash,)).fetchone()
+    return _decode_content(row['compression'], row['data']) if row else None
 
-def update_user_stats(user_id):
-    """Update statistics for a user"""
-    conn = get_db()
+def _fetch_with_content(conn, table, where, params):
+    """One row of a CONTENT_COLUMNS table as a dict, with its text columns filled in"""
+    columns = CONTENT_COLUMNS[table]
+    joins = ''.join(f' LEFT JOIN content_blobs b{i} ON b{i}.hash = t.{c}'
+                    for i, (c, _) in enumerate(columns))
+    blob_columns = ''.join(f', b{i}.compression AS _c{i}, b{i}.data AS _d{i}'
+                           for i in range(len(columns)))
+    row = conn.execute(f'SELECT t.*{blob_columns} FROM {table} t{joins} WHERE {where}', params).fetchone()
+    if row is None:
+        return None
+
+    record = {key: row[key] for key in row.keys() if not key.startswith('_')}
+    for i, (_, text) in enumerate(columns):
+        record[text] = _decode_content(row[f'_c{i}'], row[f'_d{i}'])
+    return record
+
+def get_session(conn, session_id, user_id):
+    """A teacher's differentiation session with original_material and final_content"""
+    return _fetch_with_content(conn, 'diff_sessions', 't.id = ? AND t.user_id = ?', (session_id, user_id))
+
+def get_lesson(conn, lesson_id, user_id):
+    """A teacher's saved lesson with original_material and differentiated_content"""
+    return _fetch_with_content(conn, 'lessons', 't.id = ? AND t.user_id = ?', (lesson_id, user_id))
+
+def _id_array(values):
+    """JSON array of the integer ids in values (e.g. form fields), for json_each()"""
+    ids = []
+    for value in values:
+        try:
+            ids.append(int(value))
+        except (TypeError, ValueError):
+            continue
+    return json.dumps(ids)
+
+# Bulk writes: each is a few set-based statements, with the id lists passed
+# as one JSON array parameter. None of them commit, so callers can group
+# several into one transaction.
+
+def add_group_members(conn, group_id, user_id, student_ids):
+    """Add the teacher's students to a group; ids that are not theirs are ignored"""
+    return conn.execute('''
+        INSERT INTO group_members (group_id, student_id)
+        SELECT ?, s.id FROM students s
+        WHERE s.user_id = ? AND s.id IN (SELECT value FROM json_each(?))
+        ON CONFLICT(group_id, student_id) DO NOTHING
+    ''', (group_id, user_id, _id_array(student_ids))).rowcount
 
-    # Count lessons
-    lessons_count = conn.execute(
-        'SELECT COUNT(*) as count FROM lessons WHERE user_id = ?', (user_id,)
-    ).fetchone()['count']
+def set_group_members(conn, group_id, user_id, student_ids):
+    """
+    Make a group's members exactly student_ids
 
-    # Count students
-    students_count = conn.execute(
-        'SELECT COUNT(*) as count FROM students WHERE user_id = ?', (user_id,)
-    ).fetchone()['count']
+    Only memberships that change are written, so unchanged members (and the
+    member_count trigger) are left alone.
 
-    # Count groups
-    groups_count = conn.execute(
-        'SELECT COUNT(*) as count FROM groups WHERE user_id = ?', (user_id,)
-    ).fetchone()['count']
+    Returns:
+        (added, removed) counts, or None if the group is not the teacher's
+    """
+    if not conn.execute('SELECT 1 FROM groups WHERE id = ? AND user_id = ?', (group_id, user_id)).fetchone():
+        return None
 
-    # Update stats
+    wanted = _id_array(student_ids)
+    removed = conn.execute('''
+        DELETE FROM group_members
+        WHERE group_id = ? AND student_id NOT IN (SELECT value FROM json_each(?))
+    ''', (group_id, wanted)).rowcount
+    added = add_group_members(conn, group_id, user_id, student_ids)
+    return added, removed
+
+def add_session_students(conn, session_id, user_id, student_ids=(), group_ids=()):
+    """
+    Add students to a session, directly and by expanding groups
+
+    Each student is added once however many of the selected groups they are
+    in. Students and groups that are not the teacher's are ignored.
+
+    Returns:
+        Number of students added
+    """
+    return conn.execute('''
+        INSERT INTO session_students (session_id, student_id)
+        SELECT ?, s.id FROM students s
+        WHERE s.user_id = ? AND s.id IN (SELECT value FROM json_each(?))
+        UNION
+        SELECT ?, gm.student_id FROM group_members gm
+        JOIN groups g ON g.id = gm.group_id
+        WHERE g.user_id = ? AND g.id IN (SELECT value FROM json_each(?))
+    ''', (session_id, user_id, _id_array(student_ids),
+          session_id, user_id, _id_array(group_ids))).rowcount
+
+def delete_users(conn, user_ids, keep_user_id=None):
+    """
+    Delete users (and, by cascade, everything they own) in one statement
+
+    Args:
+        conn: Database connection
+        user_ids: Ids to delete
+        keep_user_id: An id never to delete, e.g. the admin doing the deleting
+
+    Returns:
+        Number of users deleted
+    """
+    return conn.execute('''
+        DELETE FROM users
+        WHERE id IN (SELECT value FROM json_each(?)) AND id IS NOT ?
+    ''', (_id_array(user_ids), keep_user_id)).rowcount
+
+def fts_query(text):
+    """
+    Turn free text from a search box into an FTS5 MATCH expression
+
+    Every word must match as a prefix, so "jan sm" finds Jane Smith.
+    Punctuation is dropped rather than passed through as FTS5 syntax.
+
+    Returns:
+        The MATCH expression, or None if the text has no searchable words
+    """
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+# Lesson search columns weighted by bm25: owner, title, original material,
+# differentiated content, students
+LESSON_SEARCH_WEIGHTS = (0.0, 10.0, 2.0, 1.0, 3.0)
+
+# Markers snippet() wraps around matches; replaced with <mark> after escaping
+_MATCH_START = '\x02'
+_MATCH_END = '\x03'
+
+def index_lesson(conn, lesson_id, user_id, title, original_material, differentiated_content, students_involved):
+    """Add a saved lesson to the library search index"""
     conn.execute('''
-        INSERT INTO user_stats (user_id, lessons_created_count, students_count, groups_count, last_updated)
-        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ON CONFLICT(user_id) DO UPDATE SET
-            lessons_created_count = ?,
-            students_count = ?,
-            groups_count = ?,
-            last_updated = CURRENT_TIMESTAMP
-    ''', (user_id, lessons_count, students_count, groups_count, lessons_count, students_count, groups_count))
+        INSERT INTO lessons_fts (rowid, owner, title, original_material, content, students_involved)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (lesson_id, f'u{user_id}', title or '', original_material or '',
+          rendering.html_to_text(differentiated_content), students_involved or ''))
 
-    conn.commit()
-    conn.close()
+def search_lessons(conn, user_id, text, limit=50):
+    """
+    Search a teacher's saved lessons
+
+    Args:
+        conn: Database connection
+        user_id: Whose library to search
+        text: Search box text (see fts_query)
+        limit: Maximum number of results
+
+    Returns:
+        List of dicts with id, title, students_involved and created_at, plus
+        title_html and snippet_html with matches wrapped in <mark>, best
+        matches first
+    """
+    match = fts_query(text)
+    if not match:
+        return []
+
+    weights = ', '.join(str(w) for w in LESSON_SEARCH_WEIGHTS)
+    markers = (_MATCH_START, _MATCH_END)
+    # snippet(-1) would pick the owner column, which matches every row, so
+    # cut one from each text column and show the first that has a match
+    rows = conn.execute(f'''
+        SELECT l.id, l.title, l.students_involved, l.created_at,
+               highlight(lessons_fts, 1, ?, ?) AS title_marked,
+               snippet(lessons_fts, 3, ?, ?, '…', 24) AS content_snippet,
+               snippet(lessons_fts, 2, ?, ?, '…', 24) AS material_snippet,
+               snippet(lessons_fts, 4, ?, ?, '…', 24) AS students_snippet
+        FROM lessons_fts
+        JOIN lessons l ON l.id = lessons_fts.rowid
+        WHERE lessons_fts MATCH ?
+        ORDER BY bm25(lessons_fts, {weights})
+        LIMIT ?
+    ''', (*markers * 4, f'owner : "u{int(user_id)}" AND ({match})', limit)).fetchall()
+
+    results = []
+    for row in rows:
+        snippets = [row['content_snippet'], row['material_snippet'], row['students_snippet']]
+        snippet = next((s for s in snippets if s and _MATCH_START in s), row['content_snippet'])
+        results.append({
+            'id': row['id'],
+            'title': row['title'],
+            'students_involved': row['students_involved'],
+            'created_at': row['created_at'],
+            'title_html': _mark_matches(row['title_marked']),
+            'snippet_html': _mark_matches(snippet),
+        })
+    return results
+
+def _mark_matches(marked):
+    """Escape snippet text and turn the match markers into <mark> tags"""
+    return Markup(str(escape(marked or ''))
+                  .replace(_MATCH_START, '<mark>')
+                  .replace(_MATCH_END, '</mark>'))
+
+def encode_cursor(values):
+    """Opaque keyset pagination token for the last row of a page"""
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode('utf-8')).decode('ascii')
+
+def decode_cursor(token, size):
+    """Values from encode_cursor(), or None if the token is missing or invalid"""
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    except ValueError:
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    return values
+
+class Page:
+    """One page of a keyset-paginated listing (see fetch_page)"""
+
+    def __init__(self, rows, next_cursor, is_first, per_page):
+        self.rows = rows
+        self.next_cursor = next_cursor
+        self.is_first = is_first
+        self.per_page = per_page
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __bool__(self):
+        return bool(self.rows)
+
+def page_size(value, default=PAGE_SIZE):
+    """Clamp a requested page size (e.g. ?per_page=) to 1..MAX_PAGE_SIZE"""
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+def fetch_page(conn, columns, source, keys, where=None, params=(), after=None,
+               per_page=PAGE_SIZE, descending=True):
+    """
+    Fetch one page of a listing with a keyset cursor
+
+    Rather than OFFSET, each page continues from the sort key of the last row
+    of the previous one, so with an index on the key every page costs the
+    same, and only the listed columns are read.
+
+    Args:
+        conn: Database connection
+        columns: SELECT list; must include every key's column name
+        source: FROM clause (table, joins, subquery)
+        keys: Sort key as (sql_expression, column_name) pairs, ending with a
+              unique column such as id; all sorted in the same direction
+        where: Optional WHERE condition for the whole listing
+        params: Parameters for source and where, in order
+        after: Cursor from the previous page's next_cursor, or None
+        per_page: Rows per page (clamped by page_size())
+        descending: Sort direction
+
+    Returns:
+        Page of rows with next_cursor set if more rows follow
+    """
+    per_page = page_size(per_page)
+    start = decode_cursor(after, len(keys))
+    expressions = ', '.join(expression for expression, _ in keys)
+
+    conditions = [where] if where else []
+    args = list(params)
+    if start is not None:
+        conditions.append(f"({expressions}) {'<' if descending else '>'} ({', '.join('?' * len(keys))})")
+        args.extend(start)
+    direction = 'DESC' if descending else 'ASC'
+    order = ', '.join(f'{expression} {direction}' for expression, _ in keys)
+
+    sql = f'SELECT {columns} FROM {source}'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(f'({condition})' for condition in conditions)
+    sql += f' ORDER BY {order} LIMIT ?'
+    # One extra row tells us whether there is a next page
+    rows = conn.execute(sql, (*args, per_page + 1)).fetchall()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1][name] for _, name in keys)
+    return Page(rows, next_cursor, start is None, per_page)
+
+def init_db():
+    """
+    Bring the database schema up to date
+
+    Applies each migration newer than the database's user_version in its
+    own transaction. When the schema is current this is a single PRAGMA
+    read, so it is cheap to call at every worker start.
+
+    Migrations rely on foreign keys being intact, so a database holding
+    orphaned rows is refused before any migration runs (see
+    check_foreign_keys), and a migration that leaves a violation behind is
+    rolled back.
+
+    Returns:
+        The schema version after migrating
+
+    Raises:
+        sqlite3.IntegrityError: if the database has orphaned rows, or a
+            migration left a foreign key violation
+    """
+    conn = _pool.acquire()
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < len(MIGRATIONS):
+            check_foreign_keys(conn)
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            # IMMEDIATE takes the write lock up front; another worker may have
+            # migrated while we waited for it
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= number:
+                conn.rollback()
+                continue
+            migration(conn.cursor())
+            violation = conn.execute('PRAGMA foreign_key_check').fetchone()
+            if violation:
+                conn.rollback()
+                raise sqlite3.IntegrityError(
+                    f"Migration {number} left a foreign key violation: "
+                    f"{violation[0]} row {violation[1]} references a missing {violation[2]} row"
+                )
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        return max(version, len(MIGRATIONS))
+    finally:
+        _pool.release(conn)
+
+def check_foreign_keys(conn):
+    """
+    Refuse to run on a database with rows whose parent row is missing
+
+    Foreign keys were not enforced before connections were pooled, so older
+    databases can still hold, for example, the students and sessions of
+    deleted teachers. Nothing is deleted here: back the database up and run
+    purge_orphans.py to clean it.
+
+    Raises:
+        sqlite3.IntegrityError: listing the violations, by table and parent
+    """
+    violations = {}
+    # (table, rowid, parent, fk id)
+    for table, rowid, parent, _ in conn.execute('PRAGMA foreign_key_check'):
+        violations.setdefault((table, parent), []).append(rowid)
+    if not violations:
+        return
+
+    details = []
+    for (table, parent), rowids in sorted(violations.items()):
+        shown = ', '.join(str(rowid) for rowid in rowids[:10])
+        more = f', ... ({len(rowids)} in total)' if len(rowids) > 10 else ''
+        details.append(f"  {table} rows {shown}{more} reference missing {parent} rows")
+    raise sqlite3.IntegrityError(
+        f"{DB_PATH} has foreign key violations:\n" + '\n'.join(details) +
+        f"\nBack up the database and run: python purge_orphans.py {DB_PATH}"
+    )
+
+class UsageRecorder:
+    """
+    Buffers API usage events and writes them in batches
+
+    Events are timestamped when recorded and kept in memory until max_events
+    are pending or the oldest has waited max_delay seconds; a background
+    thread then inserts them with one executemany() transaction. Callers
+    never write: a request may hold the write lock on its own connection, so
+    writing on another one from the request's thread would wait on itself.
+    Anything still pending is written at shutdown. A hard crash loses at
+    most the events in the buffer, which the mode's limits bound (see
+    USAGE_MODES).
+
+    Events that can never be written (e.g. for a teacher deleted while the
+    event was buffered) are dropped one by one. After a transient error the
+    batch is kept and retried with exponential backoff. If writes fall
+    behind, the buffer keeps only the newest max_pending events.
+    """
+
+    def __init__(self, mode=USAGE_MODE):
+        self.mode = mode
+        self._events = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._retry_delay = 0
+        self._retry_at = 0
+
+    def record(self, user_id, endpoint, request_type, metadata=None):
+        settings = USAGE_MODES[self.mode]
+        # Same format as CURRENT_TIMESTAMP, so the rollups bucket it by day
+        created_at = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        metadata = metadata or {}
+        with self._cond:
+            self._events.append((user_id, endpoint, request_type, created_at,
+                                 *(metadata.get(column) for column in USAGE_METADATA_COLUMNS)))
+            dropped = len(self._events) - settings['max_pending']
+            if dropped > 0:
+                del self._events[:dropped]
+                logger.warning("API usage writes are falling behind; dropped %d oldest events", dropped)
+            if self._thread is None:
+                # Started lazily so it runs in the worker process, not a
+                # pre-fork parent
+                self._thread = threading.Thread(target=self._run, name='usage-recorder', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            settings = USAGE_MODES[self.mode]
+            with self._cond:
+                while not self._events:
+                    self._cond.wait()
+                # Back off after a failed write
+                while (remaining := self._retry_at - time.monotonic()) > 0:
+                    self._cond.wait(remaining)
+                deadline = time.monotonic() + settings['max_delay']
+                while 0 < len(self._events) < settings['max_events']:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            self.flush()
+
+    def flush(self):
+        """
+        Write all pending events now; returns how many were written
+
+        Called by the background thread and at shutdown. Not for request
+        code, for the reason given above.
+        """
+        with self._cond:
+            events, self._events = self._events, []
+        if not events:
+            return 0
+
+        conn = _pool.acquire()
+        try:
+            written = self._insert(conn, events)
+        except sqlite3.OperationalError as e:
+            # Locked, busy or out of disk: keep the batch and back off
+            with self._cond:
+                self._events[:0] = events
+                self._retry_delay = min(max(self._retry_delay * 2, USAGE_RETRY_DELAY), USAGE_RETRY_MAX_DELAY)
+                self._retry_at = time.monotonic() + self._retry_delay
+            logger.warning("Error recording API usage, will retry in %gs: %s", self._retry_delay, e)
+            return 0
+        except sqlite3.Error:
+            logger.exception("Error recording API usage, dropped %d events", len(events))
+            return 0
+        finally:
+            _pool.release(conn)
+
+        with self._cond:
+            self._retry_delay = 0
+            self._retry_at = 0
+        return written
+
+    def _insert(self, conn, events):
+        """Insert events in one transaction; returns how many were written"""
+        insert = f'''
+            INSERT INTO api_usage (user_id, endpoint, request_type, created_at, {', '.join(USAGE_METADATA_COLUMNS)})
+            VALUES (?, ?, ?, ?{', ?' * len(USAGE_METADATA_COLUMNS)})
+        '''
+        written = len(events)
+        try:
+            # Triggers update user_stats and the daily rollups
+            conn.executemany(insert, events)
+        except sqlite3.IntegrityError:
+            # Find the events that can never be written and drop only those
+            conn.rollback()
+            for event in events:
+                try:
+                    conn.execute(insert, event)
+                except sqlite3.IntegrityError as e:
+                    written -= 1
+                    logger.warning("Dropped API usage event for user %s (%s): %s", event[0], event[1], e)
+        conn.commit()
+        return written
+
+    def pending(self):
+        with self._cond:
+            return len(self._events)
+
+usage_recorder = UsageRecorder()
+
+def track_api_usage(user_id, endpoint, request_type, metadata=None):
+    """
+    Track API usage for statistics (written in the background, see UsageRecorder)
+
+    Args:
+        metadata: Optional dict with any of USAGE_METADATA_COLUMNS, e.g. the
+                  token counts and latency of a Gemini call
+    """
+    usage_recorder.record(user_id, endpoint, request_type, metadata)
 
 def get_user_api_key(user_id):
     """Get user's Gemini API key and default key request count"""
@@ -252,15 +1455,32 @@ def save_user_api_key(user_id, api_key):
     conn.commit()
     conn.close()
 
-def increment_default_key_requests(user_id):
+def increment_default_key_requests(user_id, count=1):
     """Increment the count of requests made with the default API key"""
     conn = get_db()
     conn.execute(
-        'UPDATE users SET default_key_requests = default_key_requests + 1 WHERE id = ?',
-        (user_id,)
+        'UPDATE users SET default_key_requests = default_key_requests + ? WHERE id = ?',
+        (count, user_id)
     )
     conn.commit()
     conn.close()
 
-# Initialize database when module is imported
-init_db()
+def get_response_cache_enabled(user_id):
+    """Check whether a user allows reuse of shared cached responses"""
+    conn = get_db()
+    user = conn.execute(
+        'SELECT response_cache_enabled FROM users WHERE id = ?',
+        (user_id,)
+    ).fetchone()
+    conn.close()
+    return bool(user and user['response_cache_enabled'])
+
+def set_response_cache_enabled(user_id, enabled):
+    """Opt a user in to or out of the shared response cache"""
+    conn = get_db()
+    conn.execute(
+        'UPDATE users SET response_cache_enabled = ? WHERE id = ?',
+        (1 if enabled else 0, user_id)
+    )
+    conn.commit()
+    conn.close()
@@ -1,21 +1,73 @@
 import os
 import json
 import re
-import markdown
+import hashlib
+import logging
+import threading
+import time
+import random
+import difflib
 import google.generativeai as genai
-from google.generativeai import caching
+import google.ai.generativelanguage as glm
+from google.generativeai import caching, protos
+from google.generativeai.types import caching_types
+from google.protobuf import field_mask_pb2
+from google.api_core import exceptions as google_exceptions
 import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from . import db
+from . import rendering
+
+logger = logging.getLogger(__name__)
 
 # Default API key (hardcoded fallback - limited to 4 requests per user)
 DEFAULT_API_KEY = os.environ.get('GEMINI_API_KEY', '')
 
-# Cache object for curriculum standards (module-level to persist across requests)
-_curriculum_cache = None
-_cache_created_at = None
+# Model used for generation and for the curriculum context cache
+GEMINI_MODEL = 'gemini-2.0-flash'
+
+# Bump whenever a prompt template changes so cached responses are not reused
+PROMPT_VERSION = 2
+
+# Server-side TTL of curriculum caches, and how close to expiry we extend them
+CACHE_TTL = datetime.timedelta(hours=1)
+CACHE_REFRESH_MARGIN = 5 * 60  # seconds
+
+# Maximum number of (key, model, content) caches tracked per process
+CACHE_REGISTRY_SIZE = 32
+
+# Seconds to wait before retrying cache creation after a failure
+CACHE_RETRY_AFTER = 5 * 60
 
-def configure_gemini(api_key=None):
+# Idle clients kept per API key, and number of distinct keys kept pooled
+CLIENT_POOL_SIZE = 4
+CLIENT_POOL_KEYS = 32
+
+# Requests per minute allowed per API key, and how many may go out in a burst
+GEMINI_REQUESTS_PER_MINUTE = float(os.environ.get('GEMINI_REQUESTS_PER_MINUTE', '30'))
+GEMINI_BURST = int(os.environ.get('GEMINI_BURST', '5'))
+
+# Attempts per call on rate-limit and transient server errors, the backoff
+# before the second attempt and its cap, and the longest a call may wait
+# in total (for tokens or between attempts) before giving up
+GEMINI_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 2.0  # seconds
+RETRY_MAX_DELAY = 60.0  # seconds
+GEMINI_MAX_WAIT = 180.0  # seconds
+
+# Material longer than this many characters gets suggestions per chunk,
+# with up to CHUNK_WORKERS chunk calls at once; suggestions at least this
+# similar (difflib ratio) are merged as duplicates
+CHUNK_MAX_CHARS = int(os.environ.get('GEMINI_CHUNK_CHARS', '8000'))
+CHUNK_WORKERS = 4
+SUGGESTION_SIMILARITY = 0.85
+
+def resolve_api_key(api_key=None):
     """
-    Configure the Gemini API with API key
+    Pick the API key to use for a call
 
     Args:
         api_key: User's API key. If None, uses the default key from environment.
@@ -23,26 +75,532 @@ def configure_gemini(api_key=None):
     key_to_use = api_key if api_key else DEFAULT_API_KEY
     if not key_to_use:
         raise ValueError("No API key available. Please set your Gemini API key.")
-    genai.configure(api_key=key_to_use)
+    return key_to_use
 
-def load_curriculum_standards():
-    """Load curriculum standards from file"""
-    curriculum_path = os.path.join(
-        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
-        'Intro_CS.md'
-    )
+def key_fingerprint(api_key=None):
+    """Return a short, non-reversible identifier for an API key"""
+    key_to_use = api_key if api_key else DEFAULT_API_KEY
+    return hashlib.sha256(key_to_use.encode('utf-8')).hexdigest()[:16]
+
+class GeminiClient:
+    """
+    Gemini service clients bound to a single API key
+
+    Unlike genai.configure(), which swaps process-global credentials, every
+    request made through an instance carries its own key, so calls for
+    different teachers can run concurrently on any thread.
+
+    google-generativeai has no public per-client credentials, so this is the
+    one place that reaches into its private API: the models' _client and
+    _cached_content, and CachedContent's request and response helpers. The
+    SDK is pinned in requirements.txt to the release these were written
+    against, and check_sdk() verifies them at import.
+    """
+
+    def __init__(self, api_key):
+        self.api_key = api_key
+        self.fingerprint = key_fingerprint(api_key)
+        client_options = {'api_key': api_key}
+        self.generative_client = glm.GenerativeServiceClient(client_options=client_options)
+        self.cache_client = glm.CacheServiceClient(client_options=client_options)
+
+    def model(self, model_name=GEMINI_MODEL, cached_content=None):
+        """Build a GenerativeModel that sends its requests with this key"""
+        if cached_content is not None:
+            model = genai.GenerativeModel(model_name=cached_content.model)
+            model._cached_content = cached_content.name
+        else:
+            model = genai.GenerativeModel(model_name)
+        model._client = self.generative_client
+        return model
+
+    def create_cached_content(self, **kwargs):
+        """Create a CachedContent owned by this key (same args as CachedContent.create)"""
+        request = caching.CachedContent._prepare_create_request(**kwargs)
+        response = self.cache_client.create_cached_content(request)
+        return caching.CachedContent._from_obj(response)
+
+    def extend_cached_content(self, cache, ttl):
+        """Push a cache's server-side expiry out to now + ttl"""
+        request = protos.UpdateCachedContentRequest(
+            cached_content=protos.CachedContent(
+                name=cache.name,
+                ttl=caching_types.to_optional_ttl(ttl)
+            ),
+            update_mask=field_mask_pb2.FieldMask(paths=['ttl'])
+        )
+        response = self.cache_client.update_cached_content(request)
+        cache._update(response)
+        return cache
+
+def check_sdk():
+    """
+    Fail at startup if the installed SDK lacks the internals GeminiClient uses
+
+    Raises:
+        ImportError: naming each missing attribute, so an SDK upgrade breaks
+                     loudly here instead of in every Gemini call
+    """
+    missing = [f'CachedContent.{name}'
+               for name in ('_prepare_create_request', '_from_obj', '_update')
+               if not callable(getattr(caching.CachedContent, name, None))]
+
+    # Constructing a model makes no network calls
+    model = genai.GenerativeModel(GEMINI_MODEL)
+    if '_client' not in vars(model):
+        missing.append('GenerativeModel._client')
+    model._cached_content = 'cachedContents/check'
+    if getattr(model, 'cached_content', None) != 'cachedContents/check':
+        missing.append('GenerativeModel._cached_content')
+
+    if missing:
+        raise ImportError(
+            f"google-generativeai {genai.__version__} lacks {', '.join(missing)}, which "
+            "GeminiClient needs; install the version pinned in requirements.txt"
+        )
+
+check_sdk()
+
+class GeminiClientPool:
+    """
+    Small per-key pool of reusable GeminiClient instances
+
+    Building the underlying gRPC channels is comparatively expensive, so
+    clients are checked out for the duration of one call and returned
+    afterwards. At most `size` idle clients are kept per key, and only the
+    `max_keys` most recently used keys are kept at all.
+    """
+
+    def __init__(self, size=CLIENT_POOL_SIZE, max_keys=CLIENT_POOL_KEYS):
+        self.size = size
+        self.max_keys = max_keys
+        self._idle = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, api_key=None):
+        """Check out a client for api_key (or the default key)"""
+        key_to_use = resolve_api_key(api_key)
+        fingerprint = key_fingerprint(key_to_use)
+        with self._lock:
+            idle = self._idle.get(fingerprint)
+            if idle:
+                self._idle.move_to_end(fingerprint)
+                return idle.pop()
+        return GeminiClient(key_to_use)
+
+    def release(self, client):
+        """Return a client to the pool"""
+        with self._lock:
+            idle = self._idle.setdefault(client.fingerprint, [])
+            self._idle.move_to_end(client.fingerprint)
+            if len(idle) < self.size:
+                idle.append(client)
+            while len(self._idle) > self.max_keys:
+                self._idle.popitem(last=False)
+
+    @contextmanager
+    def client(self, api_key=None):
+        """Context manager yielding a pooled client for api_key"""
+        client = self.acquire(api_key)
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+_client_pool = GeminiClientPool()
+
+def gemini_client(api_key=None):
+    """
+    Get a pooled, key-bound Gemini client
+
+    Usage:
+        with gemini_client(api_key) as client:
+            model = client.model()
+
+    Args:
+        api_key: User's API key. If None, uses the default key.
+    """
+    return _client_pool.client(api_key)
+
+class GeminiBusyError(RuntimeError):
+    """A Gemini call still hit rate limits or server errors after every retry"""
+
+# Errors worth retrying: quota (429) and transient server-side failures
+RETRYABLE_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.DeadlineExceeded,
+)
+RATE_LIMIT_ERRORS = (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted)
+
+_RETRY_IN_RE = re.compile(r'retry in ([\d.]+)\s*s', re.IGNORECASE)
+
+def retry_after_hint(error):
+    """
+    Seconds the server asked us to wait before retrying, if it said
+
+    Looks at a google.rpc.RetryInfo detail, a Retry-After header and the
+    "Please retry in 12.3s" text Gemini puts in quota errors.
+    """
+    for detail in getattr(error, 'details', None) or ():
+        delay = getattr(detail, 'retry_delay', None)
+        if delay is not None and (delay.seconds or delay.nanos):
+            return delay.seconds + delay.nanos / 1e9
 
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
     try:
-        with open(curriculum_path, 'r', encoding='utf-8') as f:
-            return f.read()
-    except FileNotFoundError:
-        print(f"Warning: Curriculum standards file not found at {curriculum_path}")
-        return ""
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        pass
+
+    match = _RETRY_IN_RE.search(str(error))
+    if match:
+        return float(match.group(1))
+    return None
+
+class RateLimiter:
+    """
+    Per-key token buckets shared by every thread in the process
+
+    Each API key (by fingerprint) refills at `rate` requests per minute up
+    to `burst` tokens. When Gemini answers with a rate-limit error the
+    key's rate is halved and the whole bucket is paused for the server's
+    retry-after hint, so the other threads using that key back off too
+    instead of piling more 429s onto it. Each success moves the rate back
+    towards the configured maximum.
+    """
+
+    def __init__(self, rate=GEMINI_REQUESTS_PER_MINUTE, burst=GEMINI_BURST):
+        self.max_rate = rate / 60.0
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, fingerprint, now):
+        bucket = self._buckets.get(fingerprint)
+        if bucket is None:
+            bucket = self._buckets[fingerprint] = {
+                'tokens': float(self.burst),
+                'rate': self.max_rate,
+                'updated': now,
+                'paused_until': 0.0,
+            }
+        return bucket
+
+    def acquire(self, fingerprint, max_wait=GEMINI_MAX_WAIT):
+        """
+        Take one token for a key, sleeping until one is available
+
+        Returns:
+            Seconds spent waiting
+
+        Raises:
+            GeminiBusyError: if no token frees up within max_wait seconds
+        """
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                bucket = self._bucket(fingerprint, now)
+                if now >= bucket['paused_until']:
+                    elapsed = now - max(bucket['updated'], bucket['paused_until'])
+                    bucket['tokens'] = min(self.burst, bucket['tokens'] + elapsed * bucket['rate'])
+                    bucket['updated'] = now
+                    if bucket['tokens'] >= 1:
+                        bucket['tokens'] -= 1
+                        return now - start
+                    wait = (1 - bucket['tokens']) / bucket['rate']
+                else:
+                    wait = bucket['paused_until'] - now
+
+            if time.monotonic() - start + wait > max_wait:
+                raise GeminiBusyError('Gemini is busy right now. Please try again in a few minutes.')
+            time.sleep(wait)
+
+    def throttle(self, fingerprint, delay):
+        """Record a rate-limit error: slow the key down and pause it for delay seconds"""
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._bucket(fingerprint, now)
+            bucket['rate'] = max(self.max_rate / 16, bucket['rate'] / 2)
+            bucket['tokens'] = min(bucket['tokens'], 0.0)
+            bucket['paused_until'] = max(bucket['paused_until'], now + delay)
+
+    def succeeded(self, fingerprint):
+        """Record a successful call: recover a little of the key's rate"""
+        with self._lock:
+            bucket = self._bucket(fingerprint, time.monotonic())
+            bucket['rate'] = min(self.max_rate, bucket['rate'] + self.max_rate / 10)
+
+    def stats(self):
+        """Current rate (requests per minute) and paused state per key"""
+        with self._lock:
+            now = time.monotonic()
+            return {
+                fingerprint: {
+                    'rate_per_minute': round(bucket['rate'] * 60, 1),
+                    'paused_for': round(max(0.0, bucket['paused_until'] - now), 1),
+                }
+                for fingerprint, bucket in self._buckets.items()
+            }
+
+rate_limiter = RateLimiter()
+
+def backoff_delay(attempt, error=None):
+    """
+    Seconds to wait before retry number `attempt` (1 for the first retry)
+
+    A retry-after hint from the server wins. Otherwise it is "full jitter"
+    exponential backoff: a random delay up to base * 2^(attempt - 1), so
+    threads that failed together do not retry together.
+    """
+    hint = retry_after_hint(error) if error is not None else None
+    if hint is not None:
+        return min(RETRY_MAX_DELAY, hint) + random.uniform(0, 1)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+def call_with_retry(client, call):
+    """
+    Run call() under the key's rate limit, retrying rate-limit and
+    transient server errors with backoff
+
+    Other errors (bad key, invalid request) are raised straight away.
+
+    Raises:
+        GeminiBusyError: if the call still fails after GEMINI_MAX_ATTEMPTS
+    """
+    start = time.monotonic()
+    for attempt in range(1, GEMINI_MAX_ATTEMPTS + 1):
+        remaining = GEMINI_MAX_WAIT - (time.monotonic() - start)
+        rate_limiter.acquire(client.fingerprint, max_wait=max(0.0, remaining))
+        try:
+            result = call()
+        except RETRYABLE_ERRORS as e:
+            delay = backoff_delay(attempt, e)
+            if isinstance(e, RATE_LIMIT_ERRORS):
+                rate_limiter.throttle(client.fingerprint, delay)
+            if attempt == GEMINI_MAX_ATTEMPTS or time.monotonic() - start + delay > GEMINI_MAX_WAIT:
+                raise GeminiBusyError(
+                    'Gemini is busy right now (rate limit or server error). Please try again in a few minutes.'
+                ) from e
+            logger.warning("Gemini call failed (%s), retry %d in %.1fs", e.__class__.__name__, attempt, delay)
+            time.sleep(delay)
+        else:
+            rate_limiter.succeeded(client.fingerprint)
+            return result
+
+# Path to the curriculum standards document
+CURRICULUM_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'Intro_CS.md'
+)
+
+# Minimum seconds between stat() calls on the curriculum file
+STANDARDS_CHECK_INTERVAL = 5
+
+# Header patterns used when parsing the curriculum document
+_DOMAIN_RE = re.compile(r'^##\s+Domain\s+(\d+)\s+[–-]\s+(.+)$')
+_STANDARD_RE = re.compile(r'^###\s+Standard\s+([\d.]+)\s+[–-]\s+(.+)$')
+_INDICATOR_RE = re.compile(r'^\*\s+\*\*([\d.]+)\*\*\s+(.+)$')
+
+# Markdown headings that start a new chunk of long material
+_HEADING_RE = re.compile(r'^(#{1,3})\s+(.+?)\s*#*\s*$')
+
+class StandardsIndex:
+    """
+    Process-wide, in-memory index of the curriculum standards file
+
+    The file is parsed once and only re-read when its mtime/size changes
+    (checked at most every `check_interval` seconds); a re-read whose
+    content hash is unchanged keeps the existing index. Lookups by code,
+    the domain/standard tree and the formatted prompt lines are all
+    precomputed so request handlers never touch the disk or the regexes.
+    """
+
+    def __init__(self, path, check_interval=STANDARDS_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._signature = False
+        self._checked_at = None
+        self.content_hash = None
+        self.text = ""
+        self.standards = []
+        self.by_code = {}
+        self.tree = []
+        self._positions = {}
+        self._lines = {}
+        self._selection_cache = {}
+
+    def refresh(self, force=False):
+        """Reload the index if the underlying file has changed"""
+        now = time.monotonic()
+        if (not force and self._checked_at is not None
+                and now - self._checked_at < self.check_interval):
+            return
+
+        with self._lock:
+            if (not force and self._checked_at is not None
+                    and now - self._checked_at < self.check_interval):
+                return
+            self._checked_at = now
+
+            try:
+                stat = os.stat(self.path)
+                signature = (stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                signature = None
+
+            if signature == self._signature:
+                return
+            self._signature = signature
+
+            if signature is None:
+                logger.warning("Curriculum standards file not found at %s", self.path)
+                self._build("")
+                self.content_hash = None
+                return
+
+            with open(self.path, 'r', encoding='utf-8') as f:
+                text = f.read()
+
+            content_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+            if content_hash != self.content_hash:
+                self._build(text)
+                self.content_hash = content_hash
+
+    def _build(self, text):
+        """Parse curriculum text and swap in the new index"""
+        standards = []
+        tree = []
+        current_domain = None
+        current_domain_title = None
+        current_standard = None
+        current_standard_title = None
+        domain_node = None
+        standard_node = None
+
+        for line in text.split('\n'):
+            line = line.strip()
+
+            # Match domain headers (e.g., "## Domain 1 – Careers and Professionalism")
+            domain_match = _DOMAIN_RE.match(line)
+            if domain_match:
+                current_domain = f"Domain {domain_match.group(1)}"
+                current_domain_title = domain_match.group(2).strip()
+                domain_node = None
+                continue
+
+            # Match standard headers (e.g., "### Standard 1.1 – Demonstrate...")
+            standard_match = _STANDARD_RE.match(line)
+            if standard_match:
+                current_standard = f"Standard {standard_match.group(1)}"
+                current_standard_title = standard_match.group(2).strip()
+                standard_node = None
+                continue
+
+            # Match performance indicators (e.g., "* **1.1.1** Text...")
+            indicator_match = _INDICATOR_RE.match(line)
+            if indicator_match and current_domain and current_standard:
+                std = {
+                    'domain': current_domain,
+                    'domain_title': current_domain_title,
+                    'standard': current_standard,
+                    'standard_title': current_standard_title,
+                    'code': indicator_match.group(1),
+                    'text': indicator_match.group(2).strip()
+                }
+                standards.append(std)
+
+                if domain_node is None:
+                    domain_node = {
+                        'domain': current_domain,
+                        'domain_title': current_domain_title,
+                        'heading': f"{current_domain} – {current_domain_title}",
+                        'standards': []
+                    }
+                    tree.append(domain_node)
+                if standard_node is None:
+                    standard_node = {
+                        'standard': current_standard,
+                        'standard_title': current_standard_title,
+                        'heading': f"{current_standard} – {current_standard_title}",
+                        'indicators': []
+                    }
+                    domain_node['standards'].append(standard_node)
+                standard_node['indicators'].append(std)
+
+        self.text = text
+        self.standards = standards
+        self.tree = tree
+        self.by_code = {std['code']: std for std in standards}
+        self._positions = {std['code']: i for i, std in enumerate(standards)}
+        self._lines = {std['code']: f"    • {std['code']}: {std['text']}" for std in standards}
+        self._selection_cache = {}
+
+    def get(self, code):
+        """Look up a single performance indicator by code"""
+        self.refresh()
+        return self.by_code.get(code)
+
+    def format_selected(self, selected_codes):
+        """Build the prompt block for a set of codes, in document order"""
+        self.refresh()
+        key = frozenset(selected_codes)
+        cached = self._selection_cache.get(key)
+        if cached is not None:
+            return cached
+
+        positions = self._positions
+        selected = sorted((positions[c] for c in key if c in positions))
+        if not selected:
+            return ""
+
+        output_lines = ["SELECTED CURRICULUM STANDARDS TO REFERENCE:\n"]
+        last_domain = None
+        last_standard = None
+        for pos in selected:
+            std = self.standards[pos]
+            domain_key = f"{std['domain']} – {std['domain_title']}"
+            standard_key = f"{std['standard']} – {std['standard_title']}"
+            if domain_key != last_domain:
+                output_lines.append(f"\n{domain_key}")
+                last_domain = domain_key
+                last_standard = None
+            if standard_key != last_standard:
+                output_lines.append(f"  {standard_key}")
+                last_standard = standard_key
+            output_lines.append(self._lines[std['code']])
+
+        text = "\n".join(output_lines)
+        if len(self._selection_cache) >= 256:
+            self._selection_cache.clear()
+        self._selection_cache[key] = text
+        return text
+
+_standards_index = StandardsIndex(CURRICULUM_PATH)
+
+def get_standards_index():
+    """Return the process-wide standards index, refreshed if the file changed"""
+    _standards_index.refresh()
+    return _standards_index
+
+def load_curriculum_standards():
+    """Load curriculum standards from file"""
+    return get_standards_index().text
 
 def parse_curriculum_standards():
     """
     Parse curriculum standards into a structured format for selection
 
+    The list is shared by the process-wide index; callers must not mutate it.
+
     Returns:
         List of dicts with structure:
         {
@@ -54,51 +612,17 @@ def parse_curriculum_standards():
             'text': 'Demonstrate understanding of various career paths...'
         }
     """
-    curriculum_text = load_curriculum_standards()
-    if not curriculum_text:
-        return []
-
-    standards = []
-    current_domain = None
-    current_domain_title = None
-    current_standard = None
-    current_standard_title = None
-
-    lines = curriculum_text.split('\n')
-
-    for line in lines:
-        line = line.strip()
-
-        # Match domain headers (e.g., "## Domain 1 – Careers and Professionalism")
-        domain_match = re.match(r'^##\s+Domain\s+(\d+)\s+[–-]\s+(.+)$', line)
-        if domain_match:
-            current_domain = f"Domain {domain_match.group(1)}"
-            current_domain_title = domain_match.group(2).strip()
-            continue
-
-        # Match standard headers (e.g., "### Standard 1.1 – Demonstrate...")
-        standard_match = re.match(r'^###\s+Standard\s+([\d.]+)\s+[–-]\s+(.+)$', line)
-        if standard_match:
-            current_standard = f"Standard {standard_match.group(1)}"
-            current_standard_title = standard_match.group(2).strip()
-            continue
-
-        # Match performance indicators (e.g., "* **1.1.1** Text...")
-        indicator_match = re.match(r'^\*\s+\*\*([\d.]+)\*\*\s+(.+)$', line)
-        if indicator_match and current_domain and current_standard:
-            code = indicator_match.group(1)
-            text = indicator_match.group(2).strip()
-
-            standards.append({
-                'domain': current_domain,
-                'domain_title': current_domain_title,
-                'standard': current_standard,
-                'standard_title': current_standard_title,
-                'code': code,
-                'text': text
-            })
-
-    return standards
+    return get_standards_index().standards
+
+def get_standards_tree():
+    """
+    Get curriculum standards grouped by domain and standard
+
+    Returns:
+        List of domain dicts, each with a 'standards' list whose entries
+        hold an 'indicators' list of the dicts from parse_curriculum_standards()
+    """
+    return get_standards_index().tree
 
 def get_selected_standards_text(selected_codes):
     """
@@ -113,69 +637,160 @@ def get_selected_standards_text(selected_codes):
     if not selected_codes:
         return ""
 
-    all_standards = parse_curriculum_standards()
-    selected = [s for s in all_standards if s['code'] in selected_codes]
-
-    if not selected:
-        return ""
+    return get_standards_index().format_selected(selected_codes)
 
-    # Group by domain and standard
-    grouped = {}
-    for std in selected:
-        domain_key = f"{std['domain']} – {std['domain_title']}"
-        standard_key = f"{std['standard']} – {std['standard_title']}"
-
-        if domain_key not in grouped:
-            grouped[domain_key] = {}
-        if standard_key not in grouped[domain_key]:
-            grouped[domain_key][standard_key] = []
-
-        grouped[domain_key][standard_key].append(std)
-
-    # Format output
-    output_lines = ["SELECTED CURRICULUM STANDARDS TO REFERENCE:\n"]
+def _expiry_timestamp(cache):
+    """Server-reported expiry of a CachedContent as a POSIX timestamp"""
+    try:
+        return cache.expire_time.timestamp()
+    except (AttributeError, TypeError, ValueError):
+        return time.time() + CACHE_TTL.total_seconds()
 
-    for domain, standards in grouped.items():
-        output_lines.append(f"\n{domain}")
-        for standard, indicators in standards.items():
-            output_lines.append(f"  {standard}")
-            for indicator in indicators:
-                output_lines.append(f"    • {indicator['code']}: {indicator['text']}")
+class CurriculumCacheRegistry:
+    """
+    LRU registry of curriculum context caches
 
-    return "\n".join(output_lines)
+    Entries are keyed by (API key fingerprint, model, curriculum content hash)
+    so a cache is only ever used with the key that created it. Each entry
+    tracks the server's expire_time; an entry close to expiry has its TTL
+    extended on next use, and one that can no longer be extended is
+    recreated.
+    """
 
-def get_or_create_curriculum_cache(api_key=None):
+    def __init__(self, max_entries=CACHE_REGISTRY_SIZE, ttl=CACHE_TTL,
+                 refresh_margin=CACHE_REFRESH_MARGIN, retry_after=CACHE_RETRY_AFTER):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.retry_after = retry_after
+        self._entries = OrderedDict()
+        self._failures = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _lock_for(self, registry_key):
+        with self._lock:
+            lock = self._key_locks.get(registry_key)
+            if lock is None:
+                lock = self._key_locks[registry_key] = threading.Lock()
+            return lock
+
+    def _lookup(self, registry_key):
+        """Return a cache that is safely inside its expiry window, if any"""
+        with self._lock:
+            entry = self._entries.get(registry_key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(registry_key)
+            if entry['expires_at'] - time.time() > self.refresh_margin:
+                return entry['cache']
+            return None
+
+    def _store(self, registry_key, cache):
+        with self._lock:
+            self._entries[registry_key] = {
+                'cache': cache,
+                'expires_at': _expiry_timestamp(cache)
+            }
+            self._entries.move_to_end(registry_key)
+            self._failures.pop(registry_key, None)
+            while len(self._entries) > self.max_entries:
+                evicted_key, _ = self._entries.popitem(last=False)
+                self._key_locks.pop(evicted_key, None)
+
+    def get(self, client, model, content_hash, create):
+        """
+        Get a live cache for this key/model/content, creating it if needed
+
+        Args:
+            client: GeminiClient bound to the key the cache belongs to
+            model: Model name the cache was created for
+            content_hash: Hash of the cached curriculum content
+            create: Callable returning a new CachedContent (or raising)
+
+        Returns:
+            CachedContent, or None if no cache could be created
+        """
+        registry_key = (client.fingerprint, model, content_hash)
+
+        cache = self._lookup(registry_key)
+        if cache is not None:
+            return cache
+
+        with self._lock_for(registry_key):
+            # Another thread may have refreshed it while we waited
+            cache = self._lookup(registry_key)
+            if cache is not None:
+                return cache
+
+            failed_at = self._failures.get(registry_key)
+            if failed_at is not None and time.time() - failed_at < self.retry_after:
+                return None
+
+            with self._lock:
+                entry = self._entries.get(registry_key)
+
+            if entry is not None and entry['expires_at'] > time.time():
+                try:
+                    client.extend_cached_content(entry['cache'], self.ttl)
+                    self._store(registry_key, entry['cache'])
+                    return entry['cache']
+                except Exception as e:
+                    logger.warning("Error extending cache %s: %s", entry['cache'].name, e)
+
+            try:
+                cache = create()
+            except Exception as e:
+                logger.warning("Error creating cache, falling back to non-cached mode: %s", e)
+                with self._lock:
+                    self._entries.pop(registry_key, None)
+                    self._failures[registry_key] = time.time()
+                return None
+
+            self._store(registry_key, cache)
+            logger.info("Created curriculum cache: %s", cache.name)
+            return cache
+
+    def clear(self):
+        """Forget every tracked cache (server-side caches expire on their own)"""
+        with self._lock:
+            self._entries.clear()
+            self._failures.clear()
+            self._key_locks.clear()
+
+_cache_registry = CurriculumCacheRegistry()
+
+def get_or_create_curriculum_cache(api_key=None, client=None):
     """
     Get existing cache or create new one for curriculum standards
 
     Args:
         api_key: User's API key. If None, uses the default key.
+        client: Optional GeminiClient to use instead of checking one out
     """
-    global _curriculum_cache, _cache_created_at
-
-    configure_gemini(api_key)
-
-    # Check if cache exists and is still valid (refresh every 6 hours)
-    if _curriculum_cache and _cache_created_at:
-        age = datetime.datetime.now() - _cache_created_at
-        if age.total_seconds() < 6 * 3600:  # 6 hours
-            return _curriculum_cache
+    if client is None:
+        with gemini_client(api_key) as client:
+            return get_or_create_curriculum_cache(client=client)
 
-    # Load curriculum standards
-    curriculum_text = load_curriculum_standards()
-
-    if not curriculum_text:
+    index = get_standards_index()
+    if not index.text:
         return None
 
-    try:
-        # Create a new cache with the curriculum standards
-        # Cache will expire after 1 hour by default
-        # NOTE: The curriculum content must be in 'contents' parameter, not in system_instruction
-        # This ensures the full document is cached and meets the minimum 4096 token requirement
-        cache = caching.CachedContent.create(
-            model='models/gemini-2.0-flash',
-            display_name='intro_cs_curriculum',
-            system_instruction="""You are an expert in educational differentiation for students with IEPs, 504 plans, and special accommodations.
+    model_name = f'models/{GEMINI_MODEL}'
+    return _cache_registry.get(
+        client, model_name, index.content_hash,
+        lambda: _create_curriculum_cache(client, model_name, index.text)
+    )
+
+def _create_curriculum_cache(client, model_name, curriculum_text):
+    """Create the curriculum CachedContent on the server under client's key"""
+    # Cache will expire after CACHE_TTL unless extended by the registry
+    # NOTE: The curriculum content must be in 'contents' parameter, not in system_instruction
+    # This ensures the full document is cached and meets the minimum 4096 token requirement
+    return client.create_cached_content(
+        model=model_name,
+        display_name='intro_cs_curriculum',
+        system_instruction="""You are an expert in educational differentiation for students with IEPs, 504 plans, and special accommodations.
 
 You have deep knowledge of the Introduction to Computer Science curriculum standards that have been provided to you. Use this curriculum knowledge to inform all differentiation suggestions and ensure they align with course objectives and standards.
 
@@ -186,12 +801,12 @@ When generating differentiation suggestions:
 - Consider how modifications support students in meeting the learning objectives
 - Balance accessibility with maintaining the integrity of the standards
 """,
-            contents=[
-                {
-                    'role': 'user',
-                    'parts': [
-                        {
-                            'text': f"""Below are the Introduction to Computer Science curriculum standards. Please familiarize yourself with these standards as you will use them to inform differentiation suggestions.
+        contents=[
+            {
+                'role': 'user',
+                'parts': [
+                    {
+                        'text': f"""Below are the Introduction to Computer Science curriculum standards. Please familiarize yourself with these standards as you will use them to inform differentiation suggestions.
 
 INTRODUCTION TO COMPUTER SCIENCE CURRICULUM STANDARDS:
 
@@ -432,14 +1047,14 @@ The goal is to maintain high expectations while providing multiple pathways to s
 - Challenge all students: provide extension activities for advanced learners simultaneously
 
 Please confirm you have reviewed these comprehensive standards and guidelines and are ready to provide high-quality differentiation suggestions that are specific, actionable, and maintain academic rigor."""
-                        }
-                    ]
-                },
-                {
-                    'role': 'model',
-                    'parts': [
-                        {
-                            'text': """I have thoroughly reviewed the Introduction to Computer Science curriculum standards and the comprehensive differentiation best practices guide. I understand:
+                    }
+                ]
+            },
+            {
+                'role': 'model',
+                'parts': [
+                    {
+                        'text': """I have thoroughly reviewed the Introduction to Computer Science curriculum standards and the comprehensive differentiation best practices guide. I understand:
 
 **Curriculum Standards - Five Main Domains:**
 1. Careers and Professionalism (Domain 1)
@@ -480,117 +1095,232 @@ I'm ready to provide high-quality differentiation suggestions that:
 7. Recommend specific tools, formats, and implementation strategies
 
 I will ensure all suggestions are feasible to implement, support student independence and growth, align with curriculum standards, and maintain high expectations for all students while providing necessary support."""
-                        }
-                    ]
-                }
-            ],
-            ttl=datetime.timedelta(hours=1),
-        )
+                    }
+                ]
+            }
+        ],
+        ttl=CACHE_TTL,
+    )
 
-        _curriculum_cache = cache
-        _cache_created_at = datetime.datetime.now()
+def usage_metadata(response, model, cache, latency):
+    """
+    What a call cost, in the form db.track_api_usage() stores
 
-        print(f"Created curriculum cache: {cache.name}")
-        return cache
+    Args:
+        response: The response (or, when streaming, the last chunk), whose
+                  usage_metadata carries the token counts
+        model: GenerativeModel the call went to
+        cache: CachedContent it used, or None
+        latency: Seconds the call took
+    """
+    usage = getattr(response, 'usage_metadata', None)
+    return {
+        'model': getattr(model, 'model_name', None),
+        'cache_name': cache.name if cache is not None else None,
+        'prompt_tokens': getattr(usage, 'prompt_token_count', None),
+        'cached_tokens': getattr(usage, 'cached_content_token_count', None),
+        'output_tokens': getattr(usage, 'candidates_token_count', None),
+        'latency_ms': int(latency * 1000),
+    }
+
+def record_usage(user_id, endpoint, metadata):
+    """Record a Gemini call for a user's statistics (nothing is recorded without a user)"""
+    if user_id is not None:
+        db.track_api_usage(user_id, endpoint, 'Gemini API', metadata)
+
+def _generate_content(prompt, api_key=None, user_id=None, endpoint=None):
+    """
+    Run a prompt against the curriculum-cached model using a key-bound client
 
-    except Exception as e:
-        print(f"Error creating cache: {e}")
-        print("Falling back to non-cached mode")
-        return None
+    Falls back to the plain model when no curriculum cache is available. The
+    call's tokens and latency are recorded against user_id as endpoint.
+    """
+    with gemini_client(api_key) as client:
+        # Try to use cached curriculum context
+        cache = get_or_create_curriculum_cache(client=client)
+        model = client.model(cached_content=cache)
 
-def markdown_to_html(text):
+        def call():
+            started = time.perf_counter()
+            response = model.generate_content(prompt)
+            return response, time.perf_counter() - started
+
+        response, latency = call_with_retry(client, call)
+        record_usage(user_id, endpoint, usage_metadata(response, model, cache, latency))
+        return response
+
+def split_material(text, max_chars=None):
     """
-    Convert markdown text to clean, formatted HTML
+    Split lesson material into chunks of at most max_chars characters
 
-    Args:
-        text: Markdown formatted text
+    Material that fits is returned whole. Otherwise it is split at markdown
+    headings (levels 1-3), then sections that are still too long are split
+    at blank lines, and lines only as a last resort; a single line longer
+    than max_chars (e.g. one huge paragraph) is cut at spaces. Fenced code
+    blocks are never split at headings or blank lines. Consecutive short
+    sections share a chunk.
 
     Returns:
-        Clean HTML string with proper formatting
-    """
-    text = text.strip()
-
-    # Only remove outer markdown code fence wrapper if the ENTIRE response is wrapped
-    # This handles cases where Gemini wraps the whole output in ```markdown...```
-    # But preserves code blocks within the content
-    if text.startswith('```') and text.endswith('```'):
-        lines = text.split('\n')
-        # Remove first line (opening fence) and last line (closing fence)
-        if len(lines) > 2:
-            # Check if first line is just a fence (possibly with language identifier)
-            if lines[0].strip().startswith('```'):
-                lines = lines[1:]
-            # Check if last line is just a closing fence
-            if lines and lines[-1].strip() == '```':
-                lines = lines[:-1]
-            text = '\n'.join(lines)
-
-    # Convert markdown to HTML with extensions for better formatting
-    html = markdown.markdown(
-        text,
-        extensions=[
-            'fenced_code',
-            'codehilite',
-            'tables',
-            'nl2br',
-            'sane_lists'
+        List of (label, text) pairs, where label names the headings the
+        chunk covers ('' when it has none)
+    """
+    max_chars = max_chars or CHUNK_MAX_CHARS
+    if len(text) <= max_chars:
+        return [('', text)]
+
+    # Sections start at headings outside code fences
+    sections = []
+    title, lines, in_fence = '', [], False
+    for line in text.splitlines(keepends=True):
+        if line.lstrip().startswith(('```', '~~~')):
+            in_fence = not in_fence
+        heading = None if in_fence else _HEADING_RE.match(line)
+        if heading and ''.join(lines).strip():
+            sections.append((title, ''.join(lines)))
+            lines = []
+        if heading:
+            title = heading.group(2)
+        lines.append(line)
+    sections.append((title, ''.join(lines)))
+
+    pieces = []
+    for title, body in sections:
+        for part in _split_blocks(body, max_chars):
+            pieces.append((title, part))
+
+    # Pack neighbouring pieces up to the budget
+    chunks = []
+    for title, body in pieces:
+        if chunks and len(chunks[-1][1]) + len(body) <= max_chars:
+            titles, packed = chunks[-1]
+            if title and title not in titles:
+                titles.append(title)
+            chunks[-1] = (titles, packed + body)
+        else:
+            chunks.append(([title] if title else [], body))
+    return [(' / '.join(titles), body) for titles, body in chunks]
+
+def suggestion_request_count(original_material):
+    """Gemini requests generate_suggestions() makes for this material: one per chunk"""
+    return len(split_material(original_material))
+
+def _split_blocks(body, max_chars):
+    """Split a section at blank lines outside code fences, then at lines (cutting overlong ones), into pieces of at most max_chars"""
+    if len(body) <= max_chars:
+        return [body]
+
+    blocks, lines, in_fence = [], [], False
+    for line in body.splitlines(keepends=True):
+        if line.lstrip().startswith(('```', '~~~')):
+            in_fence = not in_fence
+        lines.append(line)
+        if not in_fence and not line.strip():
+            blocks.append(''.join(lines))
+            lines = []
+    if lines:
+        blocks.append(''.join(lines))
+
+    pieces = ['']
+    for block in blocks:
+        parts = [block] if len(block) <= max_chars else [
+            cut for line in block.splitlines(keepends=True) for cut in _cut_line(line, max_chars)
         ]
-    )
+        for part in parts:
+            if pieces[-1] and len(pieces[-1]) + len(part) > max_chars:
+                pieces.append('')
+            pieces[-1] += part
+    return [piece for piece in pieces if piece.strip()]
+
+def _cut_line(line, max_chars):
+    """Cut a line into pieces of at most max_chars, after the last space before the limit if there is one"""
+    pieces = []
+    while len(line) > max_chars:
+        cut = line.rfind(' ', 0, max_chars) + 1 or max_chars
+        pieces.append(line[:cut])
+        line = line[cut:]
+    pieces.append(line)
+    return pieces
+
+def _normalize_suggestion(text):
+    return ' '.join(re.sub(r'[\W_]+', ' ', text.lower()).split())
+
+def merge_suggestions(suggestion_lists, similarity=SUGGESTION_SIMILARITY):
+    """
+    Merge per-chunk suggestion lists, dropping duplicates
 
-    return html
+    Suggestions whose text is the same, or nearly the same, once case and
+    punctuation are ignored are combined: the first wording is kept and
+    the students and sections of both are joined.
 
-def generate_suggestions(original_material, students_data, selected_standards=None, api_key=None):
+    Args:
+        suggestion_lists: Lists of suggestion dicts, in document order
+        similarity: difflib ratio at or above which two texts are duplicates
     """
-    Generate differentiation suggestions based on material and student profiles
+    merged = []
+    for suggestions in suggestion_lists:
+        for suggestion in suggestions:
+            key = _normalize_suggestion(suggestion['text'])
+            for existing in merged:
+                matcher = difflib.SequenceMatcher(None, existing['key'], key)
+                if existing['key'] == key or (matcher.real_quick_ratio() >= similarity
+                                              and matcher.quick_ratio() >= similarity
+                                              and matcher.ratio() >= similarity):
+                    break
+            else:
+                existing = {'key': key, 'text': suggestion['text'], 'applies_to': [], 'sections': []}
+                merged.append(existing)
+            for name in suggestion.get('applies_to') or []:
+                if name not in existing['applies_to']:
+                    existing['applies_to'].append(name)
+            section = suggestion.get('section')
+            if section and section not in existing['sections']:
+                existing['sections'].append(section)
+
+    return [
+        {'text': s['text'], 'applies_to': s['applies_to'], 'section': ', '.join(s['sections'])}
+        for s in merged
+    ]
+
+def suggestion_for_prompt(text, section=None):
+    """A suggestion as given to the final content prompt, tagged with its section if it has one"""
+    return f'[{section}] {text}' if section else text
+
+def _students_text(students_data):
+    """Student profiles as a bulleted list for the suggestions prompt"""
+    student_profiles = []
+    for student in students_data:
+        profile = f"- {student['name']}"
+        if student.get('accommodations'):
+            profile += f"\n  Accommodations: {student['accommodations']}"
+        if student.get('needs'):
+            profile += f"\n  Needs: {student['needs']}"
+        student_profiles.append(profile)
+
+    return "\n".join(student_profiles)
+
+def _suggestions_prompt(material, students_text, standards_context, part=None):
+    """
+    Build the prompt for differentiation suggestions
 
     Args:
-        original_material: The lesson/assignment text
-        students_data: List of dicts with student info (name, accommodations, needs)
-        selected_standards: Optional list of standard codes to focus on (e.g., ['1.1.1', '2.3.4'])
-        api_key: User's API key. If None, uses the default key.
-
-    Returns:
-        List of suggestion dicts with structure:
-        {
-            'text': 'suggestion text',
-            'applies_to': ['Student Name 1', 'Student Name 2']
-        }
+        part: For one chunk of long material, (number, total, label,
+              outline of all chunk labels); None for the whole lesson
     """
-    try:
-        # Try to use cached curriculum context
-        cache = get_or_create_curriculum_cache(api_key)
+    material_header = "ORIGINAL LESSON/ASSIGNMENT:"
+    section_field = ""
+    if part:
+        number, total, label, outline = part
+        material_header = (
+            f"This lesson is long, so you are given one part of it at a time. "
+            f"Its parts are: {outline}. Only suggest modifications for this part.\n\n"
+            f"ORIGINAL LESSON/ASSIGNMENT (part {number} of {total}{': ' + label if label else ''}):"
+        )
+        section_field = '\n- "section": the heading of the section of this part the suggestion targets'
 
-        if cache:
-            # Use model with cached curriculum context
-            model = genai.GenerativeModel.from_cached_content(cached_content=cache)
-        else:
-            # Fall back to non-cached model
-            configure_gemini(api_key)
-            model = genai.GenerativeModel('gemini-2.0-flash')
-
-        # Build student profiles text
-        student_profiles = []
-        for student in students_data:
-            profile = f"- {student['name']}"
-            if student.get('accommodations'):
-                profile += f"\n  Accommodations: {student['accommodations']}"
-            if student.get('needs'):
-                profile += f"\n  Needs: {student['needs']}"
-            student_profiles.append(profile)
-
-        students_text = "\n".join(student_profiles)
-
-        # Add selected standards context if provided
-        standards_context = ""
-        if selected_standards:
-            standards_text = get_selected_standards_text(selected_standards)
-            if standards_text:
-                standards_context = f"\n\n{standards_text}\n\nIMPORTANT: Focus your differentiation suggestions on helping students meet these specific standards. Reference the standard codes (e.g., 2.1.1) in your suggestions when relevant.\n"
-
-        prompt = f"""You are an expert in educational differentiation for students with IEPs, 504 plans, and special accommodations.
-
-ORIGINAL LESSON/ASSIGNMENT:
-{original_material}
+    return f"""You are an expert in educational differentiation for students with IEPs, 504 plans, and special accommodations.
+
+{material_header}
+{material}
 
 STUDENT PROFILES:
 {students_text}
@@ -602,7 +1332,7 @@ Your task is to analyze this lesson and the student profiles, then generate spec
 
 Format your response as a JSON array of objects, where each object has:
 - "text": the suggestion text
-- "applies_to": array of student names this applies to
+- "applies_to": array of student names this applies to{section_field}
 
 Example format:
 [
@@ -621,63 +1351,100 @@ Focus on practical, concrete modifications that address the specific needs liste
 
 Return ONLY the JSON array, no other text."""
 
-        response = model.generate_content(prompt)
-
-        # Parse the JSON response
-        try:
-            # Clean the response text
-            response_text = response.text.strip()
-            # Remove markdown code blocks if present
-            if response_text.startswith('```'):
-                response_text = response_text.split('```')[1]
-                if response_text.startswith('json'):
-                    response_text = response_text[4:]
-                response_text = response_text.strip()
-
-            suggestions = json.loads(response_text)
-            return suggestions
-        except json.JSONDecodeError:
-            # If JSON parsing fails, return a basic structure
-            return [{
-                'text': response.text,
-                'applies_to': [s['name'] for s in students_data]
-            }]
-
-    except Exception as e:
-        print(f"Error generating suggestions: {e}")
-        # Return a fallback suggestion
+def _parse_suggestions(response_text, students_data):
+    """Parse the model's JSON array of suggestions (or wrap plain text as one)"""
+    try:
+        # Clean the response text
+        cleaned = response_text.strip()
+        # Remove markdown code blocks if present
+        if cleaned.startswith('```'):
+            cleaned = cleaned.split('```')[1]
+            if cleaned.startswith('json'):
+                cleaned = cleaned[4:]
+            cleaned = cleaned.strip()
+
+        suggestions = json.loads(cleaned)
+    except json.JSONDecodeError:
+        # If JSON parsing fails, return a basic structure
         return [{
-            'text': f"Error generating suggestions: {str(e)}. Please check your API key and try again.",
-            'applies_to': []
+            'text': response_text,
+            'applies_to': [s['name'] for s in students_data]
         }]
 
-def generate_differentiated_content(original_material, approved_suggestions, api_key=None):
+    # Skip anything in the array that is not a suggestion object (e.g. a
+    # stray string or null)
+    if not isinstance(suggestions, list):
+        suggestions = [suggestions]
+    return [s for s in suggestions if isinstance(s, dict) and s.get('text')]
+
+def generate_suggestions(original_material, students_data, selected_standards=None, api_key=None, user_id=None):
     """
-    Generate the final differentiated content incorporating all approved suggestions
+    Generate differentiation suggestions based on material and student profiles
+
+    Material longer than CHUNK_MAX_CHARS is split with split_material() and
+    each chunk gets its own call, up to CHUNK_WORKERS at once, so a long
+    unit takes about as long as its largest chunk. The results are merged
+    with merge_suggestions().
 
     Args:
-        original_material: The original lesson text
-        approved_suggestions: List of approved suggestion texts
+        original_material: The lesson/assignment text
+        students_data: List of dicts with student info (name, accommodations, needs)
+        selected_standards: Optional list of standard codes to focus on (e.g., ['1.1.1', '2.3.4'])
         api_key: User's API key. If None, uses the default key.
+        user_id: User the call's usage is recorded against
 
     Returns:
-        HTML string containing the formatted differentiated content
-    """
-    try:
-        # Try to use cached curriculum context
-        cache = get_or_create_curriculum_cache(api_key)
-
-        if cache:
-            # Use model with cached curriculum context
-            model = genai.GenerativeModel.from_cached_content(cached_content=cache)
-        else:
-            # Fall back to non-cached model
-            configure_gemini(api_key)
-            model = genai.GenerativeModel('gemini-2.0-flash')
-
-        suggestions_text = "\n".join([f"- {s}" for s in approved_suggestions])
+        List of suggestion dicts with structure:
+        {
+            'text': 'suggestion text',
+            'applies_to': ['Student Name 1', 'Student Name 2'],
+            'section': 'Part 2: Loops'  # chunked material only
+        }
 
-        prompt = f"""You are an expert in educational differentiation. Create a final, polished version of this lesson that incorporates all the approved modifications.
+    Raises:
+        GeminiBusyError: if Gemini stayed rate-limited or unavailable
+        Exception: other API errors (e.g. an invalid key), unchanged
+    """
+    students_text = _students_text(students_data)
+
+    # Add selected standards context if provided
+    standards_context = ""
+    if selected_standards:
+        standards_text = get_selected_standards_text(selected_standards)
+        if standards_text:
+            standards_context = f"\n\n{standards_text}\n\nIMPORTANT: Focus your differentiation suggestions on helping students meet these specific standards. Reference the standard codes (e.g., 2.1.1) in your suggestions when relevant.\n"
+
+    chunks = split_material(original_material)
+    if len(chunks) == 1:
+        prompt = _suggestions_prompt(original_material, students_text, standards_context)
+        response = _generate_content(prompt, api_key, user_id, 'generate_suggestions')
+        return _parse_suggestions(response.text, students_data)
+
+    labels = [label or f'Part {number}' for number, (label, _) in enumerate(chunks, start=1)]
+    outline = '; '.join(dict.fromkeys(labels))
+
+    def suggest(number):
+        label, text = chunks[number - 1]
+        prompt = _suggestions_prompt(text, students_text, standards_context,
+                                     part=(number, len(chunks), label, outline))
+        response = _generate_content(prompt, api_key, user_id, 'generate_suggestions')
+        suggestions = _parse_suggestions(response.text, students_data)
+        for suggestion in suggestions:
+            if not suggestion.get('section'):
+                suggestion['section'] = labels[number - 1]
+        return suggestions
+
+    with ThreadPoolExecutor(max_workers=min(CHUNK_WORKERS, len(chunks)),
+                            thread_name_prefix='diff-chunk') as executor:
+        results = list(executor.map(suggest, range(1, len(chunks) + 1)))
+
+    return merge_suggestions(results)
+
+def _final_content_prompt(original_material, approved_suggestions):
+    """Build the prompt for the final differentiated lesson"""
+    suggestions_text = "\n".join([f"- {s}" for s in approved_suggestions])
+
+    prompt = f"""You are an expert in educational differentiation. Create a final, polished version of this lesson that incorporates all the approved modifications.
 
 ORIGINAL LESSON:
 {original_material}
@@ -706,15 +1473,74 @@ IMPORTANT: Format your response in clean markdown. Use:
 - Bold and italic for emphasis where appropriate
 
 Provide the formatted content directly as markdown (do NOT wrap the entire response in outer code fences)."""
+    return prompt
 
-        response = model.generate_content(prompt)
+def generate_differentiated_content(original_material, approved_suggestions, api_key=None, user_id=None):
+    """
+    Generate the final differentiated content incorporating all approved suggestions
+
+    Args:
+        original_material: The original lesson text
+        approved_suggestions: List of approved suggestion texts
+        api_key: User's API key. If None, uses the default key.
+        user_id: User the call's usage is recorded against
+
+    Returns:
+        HTML string containing the formatted differentiated content
+
+    Raises:
+        GeminiBusyError: if Gemini stayed rate-limited or unavailable
+        Exception: other API errors (e.g. an invalid key), unchanged
+    """
+    prompt = _final_content_prompt(original_material, approved_suggestions)
 
-        # Convert markdown to HTML
-        html_content = markdown_to_html(response.text)
+    response = _generate_content(prompt, api_key, user_id, 'generate_differentiated_content')
 
-        return html_content
+    # Convert markdown to HTML
+    html_content = rendering.markdown_to_html(response.text)
 
-    except Exception as e:
-        print(f"Error generating differentiated content: {e}")
-        error_html = f"<div class='error'><h3>Error Generating Content</h3><p>{str(e)}</p><p>Please check your API configuration and try again.</p></div>"
-        return error_html
+    return html_content
+
+def stream_differentiated_content(original_material, approved_suggestions, api_key=None, user_id=None):
+    """
+    Stream the final differentiated content as it is generated
+
+    Rate-limit and transient errors are retried like other calls as long as
+    nothing has been yielded yet; after that they are raised, since the
+    client already has part of the lesson.
+
+    Args:
+        original_material: The original lesson text
+        approved_suggestions: List of approved suggestion texts
+        api_key: User's API key. If None, uses the default key.
+        user_id: User the call's usage is recorded against
+
+    Yields:
+        Markdown text chunks in the order the model produces them
+    """
+    prompt = _final_content_prompt(original_material, approved_suggestions)
+
+    with gemini_client(api_key) as client:
+        cache = get_or_create_curriculum_cache(client=client)
+        model = client.model(cached_content=cache)
+
+        # Start the stream and wait for its first chunk under the retry
+        # policy; the response iterator raises on errors from the server
+        def first_chunk():
+            started = time.perf_counter()
+            chunks = iter(model.generate_content(prompt, stream=True))
+            return chunks, next(chunks, None), started
+
+        chunks, chunk, started = call_with_retry(client, first_chunk)
+        # The last chunk carries the usage totals; record them even if the
+        # client goes away mid-stream
+        last = chunk
+        try:
+            while chunk is not None:
+                last = chunk
+                if chunk.candidates and chunk.candidates[0].content.parts:
+                    yield chunk.text
+                chunk = next(chunks, None)
+        finally:
+            record_usage(user_id, 'generate_differentiated_content',
+                         usage_metadata(last, model, cache, time.perf_counter() - started))
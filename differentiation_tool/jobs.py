@@ -0,0 +1,151 @@
+"""
+In-process background jobs for the long-running Gemini phases
+
+Suggestion and final-content generation take 10-40 seconds. Running them on
+a small thread pool lets the request return immediately while the page polls
+a status endpoint, instead of holding a WSGI worker for the whole call.
+"""
+import os
+import logging
+import threading
+import time
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Number of generation jobs that may run at once in this process
+JOB_WORKERS = int(os.environ.get('DIFF_JOB_WORKERS', '4'))
+
+# Seconds after which a session stuck in the 'generating' phase is considered
+# abandoned (e.g. the worker that owned the job was restarted)
+JOB_STALE_AFTER = 300
+
+# Seconds between heartbeats for running jobs. A job can outlast
+# JOB_STALE_AFTER (rate-limit retries, chunked suggestions), so while it runs
+# the heartbeat keeps its session looking alive; keep this well below it.
+JOB_HEARTBEAT_INTERVAL = 60
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# job key -> Future for jobs queued or running in this process (None for
+# work running outside the pool, see running())
+_running = {}
+_running_lock = threading.Lock()
+
+# Called with the keys of running jobs on every heartbeat (see on_heartbeat)
+_heartbeat_callback = None
+_heartbeat_thread = None
+
+
+def _get_executor():
+    """Create the shared executor on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS,
+                                           thread_name_prefix='diff-job')
+        return _executor
+
+
+def _run(job_key, fn, args, kwargs):
+    try:
+        fn(*args, **kwargs)
+    except Exception:
+        logger.exception("Background job %s failed", job_key)
+    finally:
+        with _running_lock:
+            _running.pop(job_key, None)
+
+
+def _heartbeat():
+    while True:
+        time.sleep(JOB_HEARTBEAT_INTERVAL)
+        with _running_lock:
+            job_keys = list(_running)
+        if job_keys and _heartbeat_callback is not None:
+            try:
+                _heartbeat_callback(job_keys)
+            except Exception:
+                logger.exception("Job heartbeat failed")
+
+
+def _start_heartbeat():
+    """Start the heartbeat thread on first use (call with _running_lock held)"""
+    global _heartbeat_thread
+    if _heartbeat_thread is None:
+        _heartbeat_thread = threading.Thread(target=_heartbeat, name='diff-job-heartbeat', daemon=True)
+        _heartbeat_thread.start()
+
+
+def on_heartbeat(callback):
+    """
+    Call callback(job_keys) every JOB_HEARTBEAT_INTERVAL seconds
+
+    job_keys lists the jobs queued or running in this process at the time,
+    e.g. so their sessions can be marked as still alive. Exceptions are
+    logged, not raised.
+    """
+    global _heartbeat_callback
+    _heartbeat_callback = callback
+
+
+def submit(job_key, fn, *args, **kwargs):
+    """
+    Run fn(*args, **kwargs) in the background
+
+    Args:
+        job_key: Hashable identifier, e.g. ('suggestions', session_id)
+        fn: Callable to run; exceptions are logged, not raised
+
+    Returns:
+        True if the job was queued, False if one with the same key is
+        already queued or running in this process
+    """
+    with _running_lock:
+        if job_key in _running:
+            return False
+        _running[job_key] = _get_executor().submit(_run, job_key, fn, args, kwargs)
+        _start_heartbeat()
+        return True
+
+
+@contextmanager
+def running(job_key):
+    """
+    Mark work done outside the pool as running under job_key
+
+    For generation that runs on the request thread, such as a streamed
+    response, so is_running() and the heartbeat see it like a pooled job.
+    """
+    with _running_lock:
+        owned = job_key not in _running
+        if owned:
+            _running[job_key] = None
+            _start_heartbeat()
+    try:
+        yield
+    finally:
+        if owned:
+            with _running_lock:
+                _running.pop(job_key, None)
+
+
+def is_running(job_key):
+    """Check whether a job with this key is queued or running in this process"""
+    with _running_lock:
+        return job_key in _running
+
+
+def shutdown(wait=True):
+    """Stop accepting jobs and optionally wait for in-flight ones"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=wait)
+            _executor = None
+
+
+atexit.register(shutdown)
@@ -0,0 +1,263 @@
+"""
+Markdown rendering for generated content
+
+Building a markdown.Markdown pipeline is not free, and the codehilite
+extension runs Pygments over every code block, guessing the lexer when no
+language is given. CS lessons are full of code, and the same blocks get
+rendered repeatedly (streamed fragments, then the full document; suggestion
+rows; re-generated lessons). So:
+
+- each thread keeps one Markdown instance and reset()s it between documents
+- fenced code blocks are highlighted once and cached by a hash of their
+  language and source
+"""
+import hashlib
+import html
+import re
+import threading
+from collections import OrderedDict
+
+import markdown
+from markdown.extensions import Extension
+from markdown.extensions.codehilite import CodeHilite, CodeHiliteExtension
+from markdown.extensions.fenced_code import FencedBlockPreprocessor
+
+# Number of highlighted code blocks kept in memory
+CODE_CACHE_SIZE = 512
+
+MARKDOWN_EXTENSIONS = [
+    'fenced_code',
+    'codehilite',
+    'tables',
+    'nl2br',
+    'sane_lists'
+]
+
+# Opening lines treated as a whole-response wrapper when streaming
+_WRAPPER_FENCES = ('```', '```markdown', '```md')
+
+_TAG_RE = re.compile(r'<[^>]*>')
+_SPACE_RE = re.compile(r'\s+')
+
+
+class CodeBlockCache:
+    """Thread-safe LRU of highlighted code block HTML keyed by content hash"""
+
+    def __init__(self, max_size=CODE_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(lang, code):
+        return hashlib.sha256(f"{lang or ''}\0{code}".encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return html
+
+    def put(self, key, html):
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+code_block_cache = CodeBlockCache()
+
+
+class CachedFencedBlockPreprocessor(FencedBlockPreprocessor):
+    """
+    Highlight plain ```lang fences through code_block_cache
+
+    Runs just before fenced_code and produces the same markup. Fences with
+    {attrs} or hl_lines are left for fenced_code to handle uncached.
+    """
+
+    def run(self, lines):
+        if not self.checked_for_deps:
+            for ext in self.md.registeredExtensions:
+                if isinstance(ext, CodeHiliteExtension):
+                    self.codehilite_conf = ext.getConfigs()
+            self.checked_for_deps = True
+
+        if not self.codehilite_conf or not self.codehilite_conf['use_pygments']:
+            return lines
+
+        text = "\n".join(lines)
+        index = 0
+        while True:
+            m = self.FENCED_BLOCK_RE.search(text, index)
+            if not m:
+                break
+            if m.group('attrs') or m.group('hl_lines'):
+                index = m.end()
+                continue
+
+            lang = m.group('lang') or None
+            code = m.group('code')
+            key = CodeBlockCache.key(lang, code)
+            html = code_block_cache.get(key)
+            if html is None:
+                local_config = self.codehilite_conf.copy()
+                html = CodeHilite(
+                    code,
+                    lang=lang,
+                    style=local_config.pop('pygments_style', 'default'),
+                    **local_config
+                ).hilite(shebang=False)
+                code_block_cache.put(key, html)
+
+            placeholder = self.md.htmlStash.store(html)
+            text = f'{text[:m.start()]}\n{placeholder}\n{text[m.end():]}'
+            index = m.start() + 1 + len(placeholder)
+
+        return text.split("\n")
+
+
+class CachedCodeBlockExtension(Extension):
+    """Register CachedFencedBlockPreprocessor ahead of fenced_code"""
+
+    def extendMarkdown(self, md):
+        md.preprocessors.register(CachedFencedBlockPreprocessor(md, {}), 'cached_fenced_code_block', 26)
+
+
+_local = threading.local()
+
+
+def _get_markdown():
+    """This thread's Markdown instance, reset and ready for a new document"""
+    md = getattr(_local, 'md', None)
+    if md is None:
+        md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS + [CachedCodeBlockExtension()])
+        _local.md = md
+    return md.reset()
+
+
+def render_markdown(text):
+    """Run the markdown pipeline used for all generated content"""
+    return _get_markdown().convert(text)
+
+
+def markdown_to_html(text):
+    """
+    Convert markdown text to clean, formatted HTML
+
+    Args:
+        text: Markdown formatted text
+
+    Returns:
+        Clean HTML string with proper formatting
+    """
+    text = text.strip()
+
+    # Only remove outer markdown code fence wrapper if the ENTIRE response is wrapped
+    # This handles cases where Gemini wraps the whole output in ```markdown...```
+    # But preserves code blocks within the content
+    if text.startswith('```') and text.endswith('```'):
+        lines = text.split('\n')
+        # Remove first line (opening fence) and last line (closing fence)
+        if len(lines) > 2:
+            # Check if first line is just a fence (possibly with language identifier)
+            if lines[0].strip().startswith('```'):
+                lines = lines[1:]
+            # Check if last line is just a closing fence
+            if lines and lines[-1].strip() == '```':
+                lines = lines[:-1]
+            text = '\n'.join(lines)
+
+    return render_markdown(text)
+
+
+class IncrementalMarkdownRenderer:
+    """
+    Render a markdown stream to HTML one completed block at a time
+
+    Text is buffered until a block boundary is seen: a blank line outside
+    any fenced code block that is followed by an unindented line. Everything
+    before the last such boundary is rendered and returned; the rest waits
+    for more input. Fragments may differ slightly from rendering the whole
+    document at once (e.g. a list split across fragments), so callers should
+    use markdown_to_html() on the full text for the stored result.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+        self._started = False
+        self._wrapped = False
+
+    def feed(self, chunk):
+        """Add streamed text; return HTML for any newly completed blocks"""
+        self.text += chunk
+
+        if not self._started:
+            # Wait for the full first line to detect a ```markdown wrapper
+            newline = self.text.find('\n')
+            if newline == -1:
+                return ""
+            self._started = True
+            if self.text[:newline].strip() in _WRAPPER_FENCES:
+                self._wrapped = True
+                self._pos = newline + 1
+
+        pending = self.text[self._pos:]
+        lines = pending.split('\n')
+        in_fence = False
+        offset = 0
+        cut = None
+        # The last element is an incomplete line; only scan complete ones
+        for i, line in enumerate(lines[:-1]):
+            stripped = line.strip()
+            if stripped.startswith('```') or stripped.startswith('~~~'):
+                in_fence = not in_fence
+            elif not stripped and not in_fence and offset > 0:
+                next_line = lines[i + 1]
+                if next_line and not next_line[0].isspace():
+                    cut = offset
+            offset += len(line) + 1
+
+        if cut is None:
+            return ""
+
+        block = pending[:cut]
+        self._pos += cut
+        return render_markdown(block) if block.strip() else ""
+
+    def finish(self):
+        """Render whatever is left once the stream has ended"""
+        rest = self.text[self._pos:].rstrip()
+        if self._wrapped and rest.endswith('```'):
+            rest = rest[:-3]
+        self._pos = len(self.text)
+        return render_markdown(rest) if rest.strip() else ""
+
+    def full_html(self):
+        """Render the complete streamed text as a single document"""
+        return markdown_to_html(self.text)
+
+
+def html_to_text(content):
+    """Plain text of rendered HTML (for search indexing), tags and entities removed"""
+    if not content:
+        return ''
+    return _SPACE_RE.sub(' ', html.unescape(_TAG_RE.sub(' ', content))).strip()
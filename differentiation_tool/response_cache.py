@@ -0,0 +1,182 @@
+"""
+Content-addressed cache of Gemini responses
+
+Teachers in the same department often differentiate the same assignment for
+similar accommodations. Responses are stored in SQLite keyed by a hash of the
+normalized prompt inputs (material, student profiles, selected standards,
+model, prompt version and curriculum version), so a repeat request is served
+without an API call. Users can opt out in their dashboard; opted-out users
+neither read from nor write to the cache.
+"""
+import json
+import hashlib
+import threading
+
+from . import db
+from . import gemini_api
+
+# Total size of cached responses before least-recently-used entries are evicted
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Entries older than this are evicted regardless of use
+RESPONSE_CACHE_MAX_AGE_DAYS = 30
+
+# Run eviction after this many stores
+EVICT_EVERY = 50
+
+_stores_since_evict = 0
+_evict_lock = threading.Lock()
+
+
+def _normalize_text(text):
+    """Normalize line endings and surrounding/trailing whitespace"""
+    text = (text or '').replace('\r\n', '\n').replace('\r', '\n').strip()
+    return '\n'.join(line.rstrip() for line in text.split('\n'))
+
+
+def _make_key(endpoint, inputs):
+    payload = {
+        'endpoint': endpoint,
+        'model': gemini_api.GEMINI_MODEL,
+        'prompt_version': gemini_api.PROMPT_VERSION,
+        'curriculum': gemini_api.get_standards_index().content_hash,
+        'inputs': inputs
+    }
+    encoded = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def suggestions_key(original_material, students_data, selected_standards=None):
+    """Cache key for a generate_suggestions call"""
+    students = sorted(
+        (_normalize_text(s['name']),
+         _normalize_text(s.get('accommodations')),
+         _normalize_text(s.get('needs')))
+        for s in students_data
+    )
+    return _make_key('generate_suggestions', {
+        'material': _normalize_text(original_material),
+        'students': students,
+        'standards': sorted(set(selected_standards or []))
+    })
+
+
+def final_content_key(original_material, approved_suggestions):
+    """Cache key for a generate_differentiated_content call"""
+    return _make_key('generate_differentiated_content', {
+        'material': _normalize_text(original_material),
+        'suggestions': [_normalize_text(s) for s in approved_suggestions]
+    })
+
+
+def lookup(user_id, cache_key, endpoint):
+    """
+    Fetch a cached response and record the hit or miss
+
+    Returns:
+        The cached value (as passed to store()), or None on a miss or when
+        the user has opted out
+    """
+    if not db.get_response_cache_enabled(user_id):
+        return None
+
+    conn = db.get_db()
+    row = conn.execute(
+        'SELECT response FROM response_cache WHERE cache_key = ?',
+        (cache_key,)
+    ).fetchone()
+
+    if row:
+        conn.execute('''
+            UPDATE response_cache SET hit_count = hit_count + 1, last_used_at = CURRENT_TIMESTAMP
+            WHERE cache_key = ?
+        ''', (cache_key,))
+
+    conn.execute(f'''
+        INSERT INTO response_cache_stats (endpoint, {'hits' if row else 'misses'})
+        VALUES (?, 1)
+        ON CONFLICT(endpoint) DO UPDATE SET {'hits = hits' if row else 'misses = misses'} + 1
+    ''', (endpoint,))
+    conn.commit()
+    conn.close()
+
+    return json.loads(row['response']) if row else None
+
+
+def store(user_id, cache_key, endpoint, value):
+    """Cache a successful response (skipped for opted-out users)"""
+    global _stores_since_evict
+
+    if not db.get_response_cache_enabled(user_id):
+        return
+
+    response = json.dumps(value)
+    conn = db.get_db()
+    conn.execute('''
+        INSERT INTO response_cache (cache_key, endpoint, response, size_bytes)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(cache_key) DO UPDATE SET
+            response = excluded.response,
+            size_bytes = excluded.size_bytes,
+            created_at = CURRENT_TIMESTAMP,
+            last_used_at = CURRENT_TIMESTAMP
+    ''', (cache_key, endpoint, response, len(response.encode('utf-8'))))
+    conn.commit()
+    conn.close()
+
+    with _evict_lock:
+        _stores_since_evict += 1
+        run_evict = _stores_since_evict >= EVICT_EVERY
+        if run_evict:
+            _stores_since_evict = 0
+    if run_evict:
+        evict()
+
+
+def evict(max_bytes=RESPONSE_CACHE_MAX_BYTES, max_age_days=RESPONSE_CACHE_MAX_AGE_DAYS):
+    """
+    Drop expired entries, then least-recently-used ones until under max_bytes
+
+    Returns:
+        Number of entries removed
+    """
+    conn = db.get_db()
+    removed = conn.execute(
+        "DELETE FROM response_cache WHERE created_at < datetime('now', ?)",
+        (f'-{max_age_days} days',)
+    ).rowcount
+
+    removed += conn.execute('''
+        DELETE FROM response_cache WHERE cache_key IN (
+            SELECT cache_key FROM (
+                SELECT cache_key,
+                       SUM(size_bytes) OVER (ORDER BY last_used_at DESC, cache_key) AS running_bytes
+                FROM response_cache
+            ) WHERE running_bytes > ?
+        )
+    ''', (max_bytes,)).rowcount
+
+    conn.commit()
+    conn.close()
+    return removed
+
+
+def get_stats():
+    """Hit/miss counters per endpoint plus overall cache size"""
+    conn = db.get_db()
+    endpoints = conn.execute('''
+        SELECT endpoint, hits, misses,
+               CASE WHEN hits + misses > 0 THEN ROUND(100.0 * hits / (hits + misses), 1) ELSE 0 END AS hit_rate
+        FROM response_cache_stats
+        ORDER BY endpoint
+    ''').fetchall()
+    totals = conn.execute(
+        'SELECT COUNT(*) AS entries, COALESCE(SUM(size_bytes), 0) AS size_bytes FROM response_cache'
+    ).fetchone()
+    conn.close()
+
+    return {
+        'endpoints': endpoints,
+        'entries': totals['entries'],
+        'size_bytes': totals['size_bytes']
+    }
@@ -1,17 +1,58 @@
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Blueprint, current_app, render_template, request, redirect, url_for, session, flash, jsonify, Response, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
+import os
 import json
+import logging
+import zipfile
 from datetime import datetime
 
 from . import db
 from . import gemini_api
+from . import rendering
+from . import jobs
+from . import response_cache
 
 bp = Blueprint('differentiation', __name__,
                template_folder='templates',
                static_folder='static',
                url_prefix='/diff')
 
+logger = logging.getLogger(__name__)
+
+# Hand the request's pooled database connection back when the request ends
+bp.teardown_app_request(db.close_db)
+
+@bp.record_once
+def init_database(state):
+    """Set up the database when the blueprint is registered on an app"""
+    db_path = state.app.config.get('DIFF_DB_PATH')
+    if db_path:
+        db.configure(db_path)
+    db.init_db()
+    # Refuse oversized uploads before Flask buffers them, unless the host
+    # app already sets its own limit
+    if state.app.config.get('MAX_CONTENT_LENGTH') is None:
+        state.app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
+# Stream final lesson generation over Server-Sent Events (set DIFF_STREAM_FINAL=0
+# to use the background job and polling instead)
+STREAM_FINAL_CONTENT = os.environ.get('DIFF_STREAM_FINAL', '1') != '0'
+
+# Most lessons a library search returns
+LIBRARY_SEARCH_LIMIT = 50
+
+# Unit imports: how many of an import's lessons generate at once, and which
+# files in the zip are read
+IMPORT_CONCURRENCY = int(os.environ.get('DIFF_IMPORT_CONCURRENCY', '2'))
+IMPORT_EXTENSIONS = ('.md', '.markdown', '.txt')
+MAX_IMPORT_FILES = 40
+MAX_IMPORT_FILE_BYTES = 200 * 1024
+# Limits on the whole zip: uncompressed size of its lesson files, and size
+# of the upload itself (the app's MAX_CONTENT_LENGTH, if it sets none)
+MAX_IMPORT_TOTAL_BYTES = 2 * 1024 * 1024
+MAX_UPLOAD_BYTES = 16 * 1024 * 1024
+
 def login_required(f):
     """Decorator to require login for routes"""
     @wraps(f)
@@ -42,10 +83,14 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def get_user_api_key_or_default(user_id):
+def get_user_api_key_or_default(user_id, requests=1):
     """
     Get user's API key or default key, checking request limits
 
+    Args:
+        requests: Number of Gemini requests about to be made with the key;
+                  all of them are counted against the free limit up front
+
     Returns:
         tuple: (api_key, error_message)
         If error_message is not None, the request should be denied
@@ -65,9 +110,17 @@ def get_user_api_key_or_default(user_id):
             'You can get a free API key at https://aistudio.google.com/app/apikey'
         )
         return (None, error_msg)
+    if default_requests + requests > 4:
+        error_msg = (
+            f'This needs {requests} requests, but only {4 - default_requests} of your 4 free requests '
+            'using the default API key are left. '
+            'Please add your own Google Gemini API key to continue. '
+            'You can get a free API key at https://aistudio.google.com/app/apikey'
+        )
+        return (None, error_msg)
 
     # Increment the counter and return default key
-    db.increment_default_key_requests(user_id)
+    db.increment_default_key_requests(user_id, requests)
     return (None, None)  # None means use default key from environment
 
 # ============= LANDING AND AUTH ROUTES =============
@@ -165,39 +218,53 @@ def dashboard():
     user_id = session['user_id']
     conn = db.get_db()
 
-    # Get counts
-    student_count = conn.execute('SELECT COUNT(*) as count FROM students WHERE user_id = ?', (user_id,)).fetchone()['count']
-    group_count = conn.execute('SELECT COUNT(*) as count FROM groups WHERE user_id = ?', (user_id,)).fetchone()['count']
-    lesson_count = conn.execute('SELECT COUNT(*) as count FROM lessons WHERE user_id = ?', (user_id,)).fetchone()['count']
+    # Get trigger-maintained counts and API key settings in one lookup
+    user = conn.execute('''
+        SELECT u.gemini_api_key, u.default_key_requests, u.response_cache_enabled,
+               COALESCE(s.students_count, 0) as students_count,
+               COALESCE(s.groups_count, 0) as groups_count,
+               COALESCE(s.lessons_created_count, 0) as lessons_count
+        FROM users u
+        LEFT JOIN user_stats s ON s.user_id = u.id
+        WHERE u.id = ?
+    ''', (user_id,)).fetchone()
+
+    if not user:
+        conn.close()
+        session.clear()
+        flash('Please log in to access this page.', 'warning')
+        return redirect(url_for('differentiation.login'))
 
     # Get recent lessons
     recent_lessons = conn.execute(
-        'SELECT * FROM lessons WHERE user_id = ? ORDER BY created_at DESC LIMIT 5',
+        'SELECT id, title, created_at FROM lessons WHERE user_id = ? ORDER BY created_at DESC LIMIT 5',
         (user_id,)
     ).fetchall()
 
     # Get active sessions
     active_sessions = conn.execute(
-        'SELECT * FROM diff_sessions WHERE user_id = ? AND phase != "completed" ORDER BY updated_at DESC',
+        '''SELECT ds.*, EXISTS(
+               SELECT 1 FROM session_suggestions ss WHERE ss.session_id = ds.id AND ss.approved = 1
+           ) AS has_approved
+           FROM diff_sessions ds WHERE ds.user_id = ? AND ds.phase != "completed" ORDER BY ds.updated_at DESC''',
         (user_id,)
     ).fetchall()
 
-    # Get API key information
-    api_key_info = db.get_user_api_key(user_id)
-    has_own_key = api_key_info and api_key_info['api_key'] is not None
-    default_requests = api_key_info['default_key_requests'] if api_key_info else 0
-    requests_remaining = max(0, 4 - default_requests) if not has_own_key else None
-
     conn.close()
 
+    # API key information
+    has_own_key = user['gemini_api_key'] is not None
+    requests_remaining = max(0, 4 - (user['default_key_requests'] or 0)) if not has_own_key else None
+
     return render_template('differentiation_tool/dashboard.html',
-                         student_count=student_count,
-                         group_count=group_count,
-                         lesson_count=lesson_count,
+                         student_count=user['students_count'],
+                         group_count=user['groups_count'],
+                         lesson_count=user['lessons_count'],
                          recent_lessons=recent_lessons,
                          active_sessions=active_sessions,
                          has_own_key=has_own_key,
-                         requests_remaining=requests_remaining)
+                         requests_remaining=requests_remaining,
+                         response_cache_enabled=bool(user['response_cache_enabled']))
 
 # ============= API KEY MANAGEMENT =============
 
@@ -243,18 +310,40 @@ def get_api_key_status():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@bp.route('/api/response-cache', methods=['POST'])
+@login_required
+def save_response_cache_setting():
+    """Opt in to or out of the shared response cache"""
+    try:
+        data = request.get_json()
+        enabled = bool(data.get('enabled'))
+
+        db.set_response_cache_enabled(session['user_id'], enabled)
+
+        return jsonify({'success': True, 'enabled': enabled})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 # ============= STUDENT MANAGEMENT =============
 
 @bp.route('/students')
 @login_required
 def students():
-    """List all students"""
+    """List students by name, a page at a time"""
     user_id = session['user_id']
     conn = db.get_db()
-    students = conn.execute(
-        'SELECT * FROM students WHERE user_id = ? ORDER BY last_name, first_name',
-        (user_id,)
-    ).fetchall()
+    # The list shows at most 50 characters of the needs description
+    students = db.fetch_page(
+        conn,
+        'id, first_name, last_name, accommodations, substr(needs_description, 1, 51) AS needs_description',
+        'students',
+        keys=(('last_name', 'last_name'), ('first_name', 'first_name'), ('id', 'id')),
+        where='user_id = ?', params=(user_id,),
+        after=request.args.get('after'),
+        per_page=request.args.get('per_page', db.PAGE_SIZE),
+        descending=False
+    )
     conn.close()
     return render_template('differentiation_tool/students.html', students=students)
 
@@ -337,15 +426,11 @@ def groups():
     user_id = session['user_id']
     conn = db.get_db()
 
-    # Get groups with member counts
-    groups = conn.execute('''
-        SELECT g.*, COUNT(gm.student_id) as member_count
-        FROM groups g
-        LEFT JOIN group_members gm ON g.id = gm.group_id
-        WHERE g.user_id = ?
-        GROUP BY g.id
-        ORDER BY g.name
-    ''', (user_id,)).fetchall()
+    # Get groups (member_count is kept up to date by triggers)
+    groups = conn.execute(
+        'SELECT * FROM groups WHERE user_id = ? ORDER BY name',
+        (user_id,)
+    ).fetchall()
 
     conn.close()
     return render_template('differentiation_tool/groups.html', groups=groups)
@@ -369,15 +454,7 @@ def add_group():
                 'INSERT INTO groups (user_id, name, description) VALUES (?, ?, ?)',
                 (user_id, name, description)
             )
-            group_id = cursor.lastrowid
-
-            # Add members
-            for student_id in student_ids:
-                conn.execute(
-                    'INSERT INTO group_members (group_id, student_id) VALUES (?, ?)',
-                    (group_id, student_id)
-                )
-
+            db.add_group_members(conn, cursor.lastrowid, user_id, student_ids)
             conn.commit()
             conn.close()
             flash('Group created successfully!', 'success')
@@ -404,19 +481,16 @@ def edit_group(group_id):
         description = request.form.get('description')
         student_ids = request.form.getlist('students')
 
+        # Only changed memberships are written
+        if db.set_group_members(conn, group_id, user_id, student_ids) is None:
+            flash('Group not found.', 'error')
+            conn.close()
+            return redirect(url_for('differentiation.groups'))
+
         conn.execute(
             'UPDATE groups SET name = ?, description = ? WHERE id = ? AND user_id = ?',
             (name, description, group_id, user_id)
         )
-
-        # Update members - delete all and re-add
-        conn.execute('DELETE FROM group_members WHERE group_id = ?', (group_id,))
-        for student_id in student_ids:
-            conn.execute(
-                'INSERT INTO group_members (group_id, student_id) VALUES (?, ?)',
-                (group_id, student_id)
-            )
-
         conn.commit()
         conn.close()
         flash('Group updated successfully!', 'success')
@@ -479,27 +553,13 @@ def new_differentiation():
         else:
             # Create session with selected standards
             cursor = conn.execute(
-                'INSERT INTO diff_sessions (user_id, original_material, title, phase, selected_standards) VALUES (?, ?, ?, ?, ?)',
-                (user_id, material, title, 'select_students', json.dumps(selected_standards))
+                'INSERT INTO diff_sessions (user_id, original_material_hash, title, phase, selected_standards) VALUES (?, ?, ?, ?, ?)',
+                (user_id, db.put_content(conn, material), title, 'select_students', json.dumps(selected_standards))
             )
             session_id = cursor.lastrowid
 
-            # Add selected students
-            all_student_ids = set(selected_students)
-
-            # Add students from groups
-            for group_id in selected_groups:
-                member_ids = conn.execute(
-                    'SELECT student_id FROM group_members WHERE group_id = ?', (group_id,)
-                ).fetchall()
-                all_student_ids.update([str(row['student_id']) for row in member_ids])
-
-            # Insert into session_students
-            for student_id in all_student_ids:
-                conn.execute(
-                    'INSERT INTO session_students (session_id, student_id) VALUES (?, ?)',
-                    (session_id, student_id)
-                )
+            # Add the selected students and the members of the selected groups
+            db.add_session_students(conn, session_id, user_id, selected_students, selected_groups)
 
             conn.commit()
             conn.close()
@@ -513,17 +573,169 @@ def new_differentiation():
     ).fetchall()
 
     groups = conn.execute(
-        'SELECT g.*, COUNT(gm.student_id) as member_count FROM groups g LEFT JOIN group_members gm ON g.id = gm.group_id WHERE g.user_id = ? GROUP BY g.id ORDER BY g.name',
+        'SELECT * FROM groups WHERE user_id = ? ORDER BY name',
         (user_id,)
     ).fetchall()
 
-    # Get parsed curriculum standards for selection
-    curriculum_standards = gemini_api.parse_curriculum_standards()
+    # Get curriculum standards grouped by domain/standard for selection
+    standards_tree = gemini_api.get_standards_tree()
 
     conn.close()
 
     return render_template('differentiation_tool/new_differentiation.html',
-                         students=students, groups=groups, curriculum_standards=curriculum_standards)
+                         students=students, groups=groups, standards_tree=standards_tree)
+
+def build_students_data(students):
+    """Student profiles in the shape the Gemini prompts expect"""
+    return [
+        {
+            'name': f"{student['first_name']} {student['last_name']}",
+            'accommodations': student['accommodations'] or '',
+            'needs': student['needs_description'] or ''
+        }
+        for student in students
+    ]
+
+def store_suggestions(conn, session_id, suggestions, approved_texts=()):
+    """
+    Replace a session's suggestions with one row each
+
+    Markdown is rendered here, once, so viewing the suggestions page is a
+    plain read. The caller commits.
+    """
+    rows = [
+        (session_id, position, s['text'], rendering.markdown_to_html(s['text']),
+         json.dumps(s.get('applies_to', [])), int(s['text'] in approved_texts), s.get('section'))
+        for position, s in enumerate(suggestions)
+    ]
+    conn.execute('DELETE FROM session_suggestions WHERE session_id = ?', (session_id,))
+    conn.executemany('''
+        INSERT INTO session_suggestions (session_id, position, text, text_html, applies_to, approved, section)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+
+def get_suggestion_rows(conn, sess):
+    """
+    Load a session's suggestions in display order
+
+    Sessions created before suggestions had their own table still carry them
+    as JSON on diff_sessions; those are converted on first access.
+    """
+    query = 'SELECT * FROM session_suggestions WHERE session_id = ? ORDER BY position'
+    rows = conn.execute(query, (sess['id'],)).fetchall()
+
+    if not rows and sess['suggestions']:
+        approved_texts = [s['text'] for s in json.loads(sess['approved_suggestions'] or '[]')]
+        store_suggestions(conn, sess['id'], json.loads(sess['suggestions']), approved_texts)
+        conn.commit()
+        rows = conn.execute(query, (sess['id'],)).fetchall()
+
+    return rows
+
+def get_approved_suggestion_texts(conn, sess):
+    """
+    Texts of the suggestions the teacher approved, in display order
+
+    Suggestions for one section of chunked material are tagged with it so
+    the final prompt knows where each applies.
+    """
+    return [gemini_api.suggestion_for_prompt(row['text'], row['section'])
+            for row in get_suggestion_rows(conn, sess) if row['approved']]
+
+def claim_generation(conn, session_id):
+    """
+    Atomically move a session into the 'generating' phase
+
+    Succeeds if the session is not already generating, or if its job has
+    been stuck for longer than jobs.JOB_STALE_AFTER (e.g. after a restart).
+    Jobs that are still running keep their session fresh through
+    refresh_running_sessions(), however long Gemini makes them wait.
+
+    Returns:
+        The phase the session was in before the claim, or None if another
+        job already owns it or the session no longer exists
+    """
+    row = conn.execute('SELECT phase FROM diff_sessions WHERE id = ?', (session_id,)).fetchone()
+    if row is None:
+        # Deleted since the caller looked it up
+        return None
+    cursor = conn.execute('''
+        UPDATE diff_sessions SET phase = 'generating', job_error = NULL, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND phase = ? AND (phase != 'generating' OR updated_at < datetime('now', ?))
+    ''', (session_id, row['phase'], f'-{jobs.JOB_STALE_AFTER} seconds'))
+    conn.commit()
+    if cursor.rowcount == 0:
+        return None
+    return row['phase']
+
+def refresh_running_sessions(job_keys):
+    """Job heartbeat: mark the sessions of running jobs as still generating"""
+    session_ids = [session_id for _, session_id in job_keys]
+    conn = db.get_db()
+    conn.execute('''
+        UPDATE diff_sessions SET updated_at = CURRENT_TIMESTAMP
+        WHERE id IN (SELECT value FROM json_each(?)) AND phase = 'generating'
+    ''', (json.dumps(session_ids),))
+    conn.commit()
+    conn.close()
+
+jobs.on_heartbeat(refresh_running_sessions)
+
+def fail_generation(session_id, phase, error):
+    """Return a session to its previous phase and record the job error"""
+    conn = db.get_db()
+    conn.execute(
+        'UPDATE diff_sessions SET phase = ?, job_error = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+        (phase, error, session_id)
+    )
+    conn.commit()
+    conn.close()
+
+def run_suggestions_job(session_id, user_id, original_material, students_data, selected_standards, api_key, previous_phase, cache_key):
+    """Background job: generate suggestions and store them on the session"""
+    try:
+        suggestions = gemini_api.generate_suggestions(
+            original_material,
+            students_data,
+            selected_standards=selected_standards,
+            api_key=api_key,
+            user_id=user_id
+        )
+
+        response_cache.store(user_id, cache_key, 'generate_suggestions', suggestions)
+
+        conn = db.get_db()
+        store_suggestions(conn, session_id, suggestions)
+        conn.execute(
+            'UPDATE diff_sessions SET phase = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+            ('review_suggestions', session_id)
+        )
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        fail_generation(session_id, previous_phase, f'Error generating suggestions: {str(e)}')
+
+def run_final_content_job(session_id, user_id, original_material, suggestion_texts, api_key, previous_phase, cache_key):
+    """Background job: generate the final differentiated content"""
+    try:
+        final_content = gemini_api.generate_differentiated_content(
+            original_material,
+            suggestion_texts,
+            api_key=api_key,
+            user_id=user_id
+        )
+
+        response_cache.store(user_id, cache_key, 'generate_differentiated_content', final_content)
+
+        conn = db.get_db()
+        conn.execute(
+            'UPDATE diff_sessions SET final_content_hash = ?, phase = ?, updated_at = ? WHERE id = ?',
+            (db.put_content(conn, final_content), 'completed', datetime.now(), session_id)
+        )
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        fail_generation(session_id, previous_phase, f'Error generating content: {str(e)}')
 
 @bp.route('/differentiate/<int:session_id>/suggestions')
 @login_required
@@ -533,10 +745,7 @@ def generate_suggestions(session_id):
     conn = db.get_db()
 
     # Get session
-    sess = conn.execute(
-        'SELECT * FROM diff_sessions WHERE id = ? AND user_id = ?',
-        (session_id, user_id)
-    ).fetchone()
+    sess = db.get_session(conn, session_id, user_id)
 
     if not sess:
         flash('Session not found.', 'error')
@@ -550,66 +759,104 @@ def generate_suggestions(session_id):
         WHERE ss.session_id = ?
     ''', (session_id,)).fetchall()
 
-    # Prepare student data
-    students_data = []
-    for student in students:
-        students_data.append({
-            'name': f"{student['first_name']} {student['last_name']}",
-            'accommodations': student['accommodations'] or '',
-            'needs': student['needs_description'] or ''
-        })
-
-    # Generate suggestions if not already done
-    if not sess['suggestions']:
-        try:
-            # Check API key and request limits
-            api_key, error_msg = get_user_api_key_or_default(user_id)
-            if error_msg:
-                flash(error_msg, 'error')
-                conn.close()
-                return redirect(url_for('differentiation.dashboard'))
+    suggestion_rows = get_suggestion_rows(conn, sess)
 
-            # Get selected standards if any
-            selected_standards = []
-            if sess['selected_standards']:
-                selected_standards = json.loads(sess['selected_standards'])
+    if not suggestion_rows and sess['phase'] not in ('review_suggestions', 'ready_to_generate', 'completed'):
+        students_data = build_students_data(students)
 
-            suggestions = gemini_api.generate_suggestions(
-                sess['original_material'],
-                students_data,
-                selected_standards=selected_standards,
-                api_key=api_key
-            )
-            suggestions_json = json.dumps(suggestions)
+        # Get selected standards if any
+        selected_standards = []
+        if sess['selected_standards']:
+            selected_standards = json.loads(sess['selected_standards'])
 
-            # Track API usage
-            db.track_api_usage(user_id, 'generate_suggestions', 'Gemini API')
+        # Serve identical requests from the shared response cache
+        cache_key = response_cache.suggestions_key(sess['original_material'], students_data, selected_standards)
+        suggestions = None
+        if sess['phase'] != 'generating':
+            suggestions = response_cache.lookup(user_id, cache_key, 'generate_suggestions')
 
+        if suggestions is not None:
+            store_suggestions(conn, session_id, suggestions)
             conn.execute(
-                'UPDATE diff_sessions SET suggestions = ?, phase = ? WHERE id = ?',
-                (suggestions_json, 'review_suggestions', session_id)
+                'UPDATE diff_sessions SET phase = ?, job_error = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+                ('review_suggestions', session_id)
             )
             conn.commit()
-        except Exception as e:
-            flash(f'Error generating suggestions: {str(e)}', 'error')
-            suggestions = []
-            suggestions_json = '[]'
-    else:
-        suggestions_json = sess['suggestions']
-        suggestions = json.loads(suggestions_json)
+            suggestion_rows = get_suggestion_rows(conn, sess)
+        else:
+            # Start a background job to generate the suggestions
+            job_key = ('suggestions', session_id)
+            previous_phase = None
+            if not jobs.is_running(job_key):
+                previous_phase = claim_generation(conn, session_id)
+
+            if previous_phase is not None:
+                # Check API key and request limits (long material takes one
+                # request per chunk)
+                api_key, error_msg = get_user_api_key_or_default(
+                    user_id, requests=gemini_api.suggestion_request_count(sess['original_material'])
+                )
+                if error_msg:
+                    conn.execute(
+                        'UPDATE diff_sessions SET phase = ? WHERE id = ?',
+                        (previous_phase, session_id)
+                    )
+                    conn.commit()
+                    flash(error_msg, 'error')
+                    conn.close()
+                    return redirect(url_for('differentiation.dashboard'))
+
+                jobs.submit(job_key, run_suggestions_job, session_id, user_id,
+                            sess['original_material'], students_data, selected_standards,
+                            api_key, previous_phase, cache_key)
 
-    # Convert suggestion text from markdown to HTML for display
-    for suggestion in suggestions:
-        suggestion['text_html'] = gemini_api.markdown_to_html(suggestion['text'])
+            conn.close()
+            return render_template('differentiation_tool/generating.html',
+                                 session_id=session_id,
+                                 session=sess,
+                                 stage='suggestions')
 
     conn.close()
 
+    suggestions = [
+        {'id': row['id'], 'text_html': row['text_html'], 'applies_to': json.loads(row['applies_to'] or '[]'),
+         'section': row['section']}
+        for row in suggestion_rows
+    ]
+
     return render_template('differentiation_tool/suggestions.html',
                          session_id=session_id,
                          session=sess,
                          suggestions=suggestions,
                          students=students)
 
+@bp.route('/differentiate/<int:session_id>/status')
+@login_required
+def generation_status(session_id):
+    """Poll the state of a session's background generation job"""
+    conn = db.get_db()
+    sess = conn.execute(
+        'SELECT phase, job_error FROM diff_sessions WHERE id = ? AND user_id = ?',
+        (session_id, session['user_id'])
+    ).fetchone()
+    conn.close()
+
+    if not sess:
+        return jsonify({'success': False, 'error': 'Session not found'}), 404
+
+    if sess['phase'] in ('ready_to_generate', 'completed'):
+        next_url = url_for('differentiation.generate_final', session_id=session_id)
+    else:
+        next_url = url_for('differentiation.generate_suggestions', session_id=session_id)
+
+    return jsonify({
+        'success': True,
+        'phase': sess['phase'],
+        'ready': sess['phase'] != 'generating' and not sess['job_error'],
+        'error': sess['job_error'],
+        'redirect_url': next_url
+    })
+
 @bp.route('/differentiate/<int:session_id>/refine', methods=['POST'])
 @login_required
 def refine_suggestions(session_id):
@@ -628,15 +875,29 @@ def refine_suggestions(session_id):
         conn.close()
         return redirect(url_for('differentiation.dashboard'))
 
-    # Get all suggestions
-    all_suggestions = json.loads(sess['suggestions'])
-
-    # Filter to approved ones
-    approved_suggestions = [all_suggestions[int(i)] for i in approved]
+    # The form only sends this session's suggestion row ids, so anything else
+    # was tampered with
+    session_ids = {row['id'] for row in conn.execute(
+        'SELECT id FROM session_suggestions WHERE session_id = ?', (session_id,)
+    )}
+    try:
+        suggestion_ids = [int(suggestion_id) for suggestion_id in approved]
+    except ValueError:
+        suggestion_ids = None
+    if suggestion_ids is None or not session_ids.issuperset(suggestion_ids):
+        flash('Invalid suggestion selection. Please choose again.', 'error')
+        conn.close()
+        return redirect(url_for('differentiation.generate_suggestions', session_id=session_id))
 
+    # Mark the approved suggestion rows
+    conn.execute('UPDATE session_suggestions SET approved = 0 WHERE session_id = ?', (session_id,))
+    conn.executemany(
+        'UPDATE session_suggestions SET approved = 1 WHERE id = ? AND session_id = ?',
+        [(suggestion_id, session_id) for suggestion_id in suggestion_ids]
+    )
     conn.execute(
-        'UPDATE diff_sessions SET approved_suggestions = ?, phase = ? WHERE id = ?',
-        (json.dumps(approved_suggestions), 'ready_to_generate', session_id)
+        'UPDATE diff_sessions SET phase = ? WHERE id = ?',
+        ('ready_to_generate', session_id)
     )
     conn.commit()
     conn.close()
@@ -650,48 +911,69 @@ def generate_final(session_id):
     user_id = session['user_id']
     conn = db.get_db()
 
-    sess = conn.execute(
-        'SELECT * FROM diff_sessions WHERE id = ? AND user_id = ?',
-        (session_id, user_id)
-    ).fetchone()
+    sess = db.get_session(conn, session_id, user_id)
 
     if not sess:
         flash('Session not found.', 'error')
         conn.close()
         return redirect(url_for('differentiation.dashboard'))
 
-    # Generate content if not already done
-    if not sess['final_content']:
-        # Check API key and request limits
-        api_key, error_msg = get_user_api_key_or_default(user_id)
-        if error_msg:
-            flash(error_msg, 'error')
-            conn.close()
-            return redirect(url_for('differentiation.dashboard'))
-
-        approved_suggestions = json.loads(sess['approved_suggestions'])
-        suggestion_texts = [s['text'] for s in approved_suggestions]
-
-        try:
-            final_content = gemini_api.generate_differentiated_content(
-                sess['original_material'],
-                suggestion_texts,
-                api_key=api_key
-            )
-
-            # Track API usage
-            db.track_api_usage(user_id, 'generate_differentiated_content', 'Gemini API')
+    final_content = sess['final_content']
 
+    # Serve identical requests from the shared response cache
+    if not final_content and sess['phase'] != 'generating':
+        cache_key = response_cache.final_content_key(
+            sess['original_material'], get_approved_suggestion_texts(conn, sess)
+        )
+        final_content = response_cache.lookup(user_id, cache_key, 'generate_differentiated_content')
+        if final_content is not None:
             conn.execute(
-                'UPDATE diff_sessions SET final_content = ?, phase = ?, updated_at = ? WHERE id = ?',
-                (final_content, 'completed', datetime.now(), session_id)
+                'UPDATE diff_sessions SET final_content_hash = ?, phase = ?, job_error = NULL, updated_at = ? WHERE id = ?',
+                (db.put_content(conn, final_content), 'completed', datetime.now(), session_id)
             )
             conn.commit()
-        except Exception as e:
-            flash(f'Error generating content: {str(e)}', 'error')
-            final_content = f"Error: {str(e)}"
-    else:
-        final_content = sess['final_content']
+
+    # Let the page stream the content unless a background job already owns it
+    if not final_content and STREAM_FINAL_CONTENT and request.args.get('stream') != '0':
+        conn.close()
+        return render_template('differentiation_tool/generating.html',
+                             session_id=session_id,
+                             session=sess,
+                             stage='final',
+                             stream_url=url_for('differentiation.stream_final', session_id=session_id))
+
+    # Start a background job if content has not been generated yet
+    if not final_content:
+        job_key = ('final', session_id)
+        previous_phase = None
+        if not jobs.is_running(job_key):
+            previous_phase = claim_generation(conn, session_id)
+
+        if previous_phase is not None:
+            # Check API key and request limits
+            api_key, error_msg = get_user_api_key_or_default(user_id)
+            if error_msg:
+                conn.execute(
+                    'UPDATE diff_sessions SET phase = ? WHERE id = ?',
+                    (previous_phase, session_id)
+                )
+                conn.commit()
+                flash(error_msg, 'error')
+                conn.close()
+                return redirect(url_for('differentiation.dashboard'))
+
+            suggestion_texts = get_approved_suggestion_texts(conn, sess)
+            cache_key = response_cache.final_content_key(sess['original_material'], suggestion_texts)
+
+            jobs.submit(job_key, run_final_content_job, session_id, user_id,
+                        sess['original_material'], suggestion_texts,
+                        api_key, previous_phase, cache_key)
+
+        conn.close()
+        return render_template('differentiation_tool/generating.html',
+                             session_id=session_id,
+                             session=sess,
+                             stage='final')
 
     conn.close()
 
@@ -700,6 +982,128 @@ def generate_final(session_id):
                          session=sess,
                          final_content=final_content)
 
+def sse_event(event, data):
+    """Format one Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@bp.route('/differentiate/<int:session_id>/stream')
+@login_required
+def stream_final(session_id):
+    """Phase 4 (streaming): send the lesson as HTML fragments while it is generated"""
+    user_id = session['user_id']
+    conn = db.get_db()
+
+    sess = db.get_session(conn, session_id, user_id)
+
+    if not sess:
+        conn.close()
+        return jsonify({'success': False, 'error': 'Session not found'}), 404
+
+    final_url = url_for('differentiation.generate_final', session_id=session_id)
+    sse_headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+    if sess['final_content']:
+        conn.close()
+        return Response(sse_event('done', {'redirect_url': final_url}),
+                        mimetype='text/event-stream', headers=sse_headers)
+
+    previous_phase = None
+    if not jobs.is_running(('final', session_id)):
+        previous_phase = claim_generation(conn, session_id)
+
+    if previous_phase is None:
+        # Another request or job is already generating; the page falls back to polling
+        conn.close()
+        return Response(sse_event('pending', {}), mimetype='text/event-stream', headers=sse_headers)
+
+    # Check API key and request limits
+    api_key, error_msg = get_user_api_key_or_default(user_id)
+    if error_msg:
+        conn.execute(
+            'UPDATE diff_sessions SET phase = ? WHERE id = ?',
+            (previous_phase, session_id)
+        )
+        conn.commit()
+        conn.close()
+        return Response(sse_event('failed', {'error': error_msg, 'redirect_url': final_url}),
+                        mimetype='text/event-stream', headers=sse_headers)
+
+    suggestion_texts = get_approved_suggestion_texts(conn, sess)
+    conn.close()
+
+    def generate():
+        renderer = rendering.IncrementalMarkdownRenderer()
+        finished = False
+        try:
+            # Flush headers right away so the browser knows the stream is open
+            yield ': generating\n\n'
+
+            # Registered like a job, so the heartbeat keeps the session claimed
+            with jobs.running(('final', session_id)):
+                for chunk in gemini_api.stream_differentiated_content(
+                        sess['original_material'], suggestion_texts, api_key=api_key, user_id=user_id):
+                    html = renderer.feed(chunk)
+                    if html:
+                        yield sse_event('chunk', {'html': html})
+
+            html = renderer.finish()
+            if html:
+                yield sse_event('chunk', {'html': html})
+
+            final_content = renderer.full_html()
+
+            response_cache.store(user_id, response_cache.final_content_key(sess['original_material'], suggestion_texts),
+                                 'generate_differentiated_content', final_content)
+
+            conn = db.get_db()
+            conn.execute(
+                'UPDATE diff_sessions SET final_content_hash = ?, phase = ?, updated_at = ? WHERE id = ?',
+                (db.put_content(conn, final_content), 'completed', datetime.now(), session_id)
+            )
+            conn.commit()
+            conn.close()
+            finished = True
+
+            yield sse_event('done', {'redirect_url': final_url})
+        except Exception as e:
+            logger.exception("Error streaming differentiated content for session %s", session_id)
+            finished = True
+            fail_generation(session_id, previous_phase, f'Error generating content: {str(e)}')
+            yield sse_event('failed', {'error': f'Error generating content: {str(e)}',
+                                      'redirect_url': final_url})
+        finally:
+            if not finished:
+                # Client went away mid-stream; release the session for a retry
+                fail_generation(session_id, previous_phase, 'Generation was interrupted. Please try again.')
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=sse_headers)
+
+def save_session_lesson(conn, sess):
+    """
+    Save a completed session (as returned by db.get_session) to the library
+
+    The lesson shares the session's stored text. The caller commits.
+
+    Returns:
+        The new lesson's id
+    """
+    students = conn.execute('''
+        SELECT s.first_name, s.last_name FROM students s
+        JOIN session_students ss ON s.id = ss.student_id
+        WHERE ss.session_id = ?
+    ''', (sess['id'],)).fetchall()
+
+    students_text = ', '.join([f"{s['first_name']} {s['last_name']}" for s in students])
+
+    cursor = conn.execute('''
+        INSERT INTO lessons (user_id, session_id, title, original_material_hash, content_hash, students_involved)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (sess['user_id'], sess['id'], sess['title'], sess['original_material_hash'],
+          sess['final_content_hash'], students_text))
+    db.index_lesson(conn, cursor.lastrowid, sess['user_id'], sess['title'], sess['original_material'],
+                    sess['final_content'], students_text)
+    return cursor.lastrowid
+
 @bp.route('/differentiate/<int:session_id>/save', methods=['POST'])
 @login_required
 def save_to_library(session_id):
@@ -707,38 +1111,502 @@ def save_to_library(session_id):
     user_id = session['user_id']
     conn = db.get_db()
 
-    sess = conn.execute(
-        'SELECT * FROM diff_sessions WHERE id = ? AND user_id = ?',
-        (session_id, user_id)
-    ).fetchone()
+    sess = db.get_session(conn, session_id, user_id)
 
     if not sess:
         flash('Session not found.', 'error')
         conn.close()
         return redirect(url_for('differentiation.dashboard'))
 
-    # Get students involved
+    if not sess['final_content_hash']:
+        flash('Generate the differentiated lesson before saving it.', 'error')
+        conn.close()
+        return redirect(url_for('differentiation.generate_final', session_id=session_id))
+
+    save_session_lesson(conn, sess)
+
+    conn.commit()
+    conn.close()
+
+    flash('Lesson saved to your library!', 'success')
+    return redirect(url_for('differentiation.lesson_library'))
+
+# ============= BATCH DIFFERENTIATION =============
+
+# Per-group progress shown on the batch page, derived from the session
+BATCH_STAGES = {
+    'queued': 'Waiting to start',
+    'suggesting': 'Writing suggestions',
+    'writing': 'Writing lesson',
+    'done': 'Ready',
+    'saved': 'Saved to library',
+    'failed': 'Failed',
+    'interrupted': 'Interrupted',
+    'manual': 'Continued by hand',
+}
+
+def run_batch_session_job(batch_id, session_id, user_id, original_material, students_data, selected_standards, api_key, previous_phase):
+    """
+    Background job: take one session in a batch from material to lesson
+
+    Every suggestion is approved, so no teacher input is needed between the
+    two Gemini calls. Each call is served from the response cache when it
+    can be. On failure the session is returned to the phase it reached, so
+    the teacher can retry or finish it in the normal workflow. Either way
+    the next queued session of the batch, if any, is started.
+    """
+    try:
+        conn = db.get_db()
+        sess = conn.execute('SELECT * FROM diff_sessions WHERE id = ?', (session_id,)).fetchone()
+        suggestion_texts = get_approved_suggestion_texts(conn, sess) if previous_phase == 'ready_to_generate' else []
+        conn.close()
+
+        if not suggestion_texts:
+            cache_key = response_cache.suggestions_key(original_material, students_data, selected_standards)
+            suggestions = response_cache.lookup(user_id, cache_key, 'generate_suggestions')
+            if suggestions is None:
+                suggestions = gemini_api.generate_suggestions(
+                    original_material,
+                    students_data,
+                    selected_standards=selected_standards,
+                    api_key=api_key,
+                    user_id=user_id
+                )
+                response_cache.store(user_id, cache_key, 'generate_suggestions', suggestions)
+
+            conn = db.get_db()
+            store_suggestions(conn, session_id, suggestions, [s['text'] for s in suggestions])
+            conn.execute('UPDATE diff_sessions SET updated_at = CURRENT_TIMESTAMP WHERE id = ?', (session_id,))
+            conn.commit()
+            conn.close()
+            previous_phase = 'ready_to_generate'
+            suggestion_texts = [gemini_api.suggestion_for_prompt(s['text'], s.get('section')) for s in suggestions]
+
+        cache_key = response_cache.final_content_key(original_material, suggestion_texts)
+        final_content = response_cache.lookup(user_id, cache_key, 'generate_differentiated_content')
+        if final_content is None:
+            final_content = gemini_api.generate_differentiated_content(
+                original_material,
+                suggestion_texts,
+                api_key=api_key,
+                user_id=user_id
+            )
+            response_cache.store(user_id, cache_key, 'generate_differentiated_content', final_content)
+
+        conn = db.get_db()
+        conn.execute(
+            'UPDATE diff_sessions SET final_content_hash = ?, phase = ?, updated_at = ? WHERE id = ?',
+            (db.put_content(conn, final_content), 'completed', datetime.now(), session_id)
+        )
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        fail_generation(session_id, previous_phase, str(e))
+    finally:
+        advance_batch(batch_id, user_id, api_key)
+
+def start_batch_session(conn, session_id, user_id, api_key, previous_phase):
+    """Queue the pipeline for one session of a batch (already claimed as 'generating')"""
+    sess = db.get_session(conn, session_id, user_id)
     students = conn.execute('''
-        SELECT s.first_name, s.last_name FROM students s
+        SELECT s.* FROM students s
         JOIN session_students ss ON s.id = ss.student_id
         WHERE ss.session_id = ?
     ''', (session_id,)).fetchall()
 
-    students_text = ', '.join([f"{s['first_name']} {s['last_name']}" for s in students])
+    jobs.submit(('batch', session_id), run_batch_session_job, sess['batch_id'], session_id, user_id,
+                sess['original_material'], build_students_data(students),
+                json.loads(sess['selected_standards'] or '[]'), api_key, previous_phase)
 
-    # Save to library
-    conn.execute('''
-        INSERT INTO lessons (user_id, session_id, title, original_material, differentiated_content, students_involved)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, session_id, sess['title'], sess['original_material'], sess['final_content'], students_text))
+def advance_batch(batch_id, user_id, api_key):
+    """
+    Start queued sessions of a batch until IMPORT_CONCURRENCY are generating
 
+    The claim is a single UPDATE, so jobs finishing at the same moment
+    cannot start more than the limit between them.
+    """
+    conn = db.get_db()
+    claimed = conn.execute('''
+        UPDATE diff_sessions SET phase = 'generating', job_error = NULL, updated_at = CURRENT_TIMESTAMP
+        WHERE id IN (
+            SELECT id FROM diff_sessions
+            WHERE batch_id = ? AND phase = 'queued'
+            ORDER BY id
+            LIMIT max(0, ? - (SELECT COUNT(*) FROM diff_sessions WHERE batch_id = ? AND phase = 'generating'))
+        )
+        RETURNING id
+    ''', (batch_id, IMPORT_CONCURRENCY, batch_id)).fetchall()
     conn.commit()
+
+    # A queued session that fails goes back to 'select_students', not to the
+    # queue, so it is not picked up again until the teacher retries it
+    for row in sorted(claimed, key=lambda row: row['id']):
+        start_batch_session(conn, row['id'], user_id, api_key, 'select_students')
     conn.close()
 
-    # Update user statistics
-    db.update_user_stats(user_id)
+def get_batch_sessions(conn, batch_id):
+    """A batch's sessions, one per group or imported lesson, with the stage each has reached"""
+    rows = conn.execute('''
+        SELECT ds.id, ds.title, ds.phase, ds.job_error, g.name AS group_name,
+               ds.updated_at < datetime('now', ?) AS stale,
+               EXISTS(SELECT 1 FROM session_suggestions ss WHERE ss.session_id = ds.id) AS has_suggestions,
+               EXISTS(SELECT 1 FROM lessons l WHERE l.session_id = ds.id) AS saved
+        FROM diff_sessions ds
+        LEFT JOIN groups g ON g.id = ds.group_id
+        WHERE ds.batch_id = ?
+        ORDER BY ds.id
+    ''', (f'-{jobs.JOB_STALE_AFTER} seconds', batch_id)).fetchall()
+
+    sessions = []
+    for row in rows:
+        if row['phase'] == 'completed':
+            stage = 'saved' if row['saved'] else 'done'
+            url = url_for('differentiation.generate_final', session_id=row['id'])
+        elif row['phase'] == 'generating':
+            stage = 'writing' if row['has_suggestions'] else 'suggesting'
+            if row['stale'] and not jobs.is_running(('batch', row['id'])):
+                stage = 'interrupted'
+            url = None
+        elif row['phase'] == 'queued':
+            stage = 'queued'
+            url = None
+        else:
+            stage = 'failed' if row['job_error'] else 'manual'
+            if row['phase'] == 'ready_to_generate':
+                url = url_for('differentiation.generate_final', session_id=row['id'])
+            else:
+                url = url_for('differentiation.generate_suggestions', session_id=row['id'])
+
+        sessions.append({
+            'session_id': row['id'],
+            'title': row['title'],
+            'name': row['group_name'] or row['title'] or 'Untitled Session',
+            'stage': stage,
+            'label': BATCH_STAGES[stage],
+            'error': row['job_error'],
+            'url': url,
+        })
+    return sessions
+
+def get_batch(conn, batch_id, user_id):
+    return conn.execute(
+        'SELECT * FROM batches WHERE id = ? AND user_id = ?',
+        (batch_id, user_id)
+    ).fetchone()
 
-    flash('Lesson saved to your library!', 'success')
+@bp.route('/differentiate/batch/new', methods=['GET', 'POST'])
+@login_required
+def new_batch():
+    """Differentiate one lesson for several groups at once"""
+    user_id = session['user_id']
+    conn = db.get_db()
+
+    groups = conn.execute(
+        'SELECT * FROM groups WHERE user_id = ? ORDER BY name',
+        (user_id,)
+    ).fetchall()
+
+    if request.method == 'POST':
+        title = request.form.get('title')
+        material = request.form.get('material')
+        selected_groups = set(request.form.getlist('groups'))
+        selected_standards = request.form.getlist('standards')
+        batch_groups = [g for g in groups if str(g['id']) in selected_groups]
+        empty_groups = [g['name'] for g in batch_groups if not g['member_count']]
+
+        if not material:
+            flash('Please enter the lesson material.', 'error')
+        elif not batch_groups:
+            flash('Please select at least one group.', 'error')
+        elif empty_groups:
+            flash(f"These groups have no students: {', '.join(empty_groups)}", 'error')
+        else:
+            # Suggestions (one request per chunk) and the final lesson for
+            # each group, counted before anything starts
+            requests = len(batch_groups) * (gemini_api.suggestion_request_count(material) + 1)
+            api_key, error_msg = get_user_api_key_or_default(user_id, requests=requests)
+            if error_msg:
+                flash(error_msg, 'error')
+            else:
+                cursor = conn.execute('INSERT INTO batches (user_id, title) VALUES (?, ?)', (user_id, title))
+                batch_id = cursor.lastrowid
+                material_hash = db.put_content(conn, material)
+
+                # One session per group, claimed for generation from the start
+                session_ids = []
+                for group in batch_groups:
+                    cursor = conn.execute('''
+                        INSERT INTO diff_sessions
+                            (user_id, batch_id, group_id, original_material_hash, title, phase, selected_standards)
+                        VALUES (?, ?, ?, ?, ?, 'generating', ?)
+                    ''', (user_id, batch_id, group['id'], material_hash,
+                          f"{title or 'Untitled Session'} ({group['name']})", json.dumps(selected_standards)))
+                    db.add_session_students(conn, cursor.lastrowid, user_id, group_ids=[group['id']])
+                    session_ids.append(cursor.lastrowid)
+                conn.commit()
+
+                for session_id in session_ids:
+                    start_batch_session(conn, session_id, user_id, api_key, 'select_students')
+                conn.close()
+
+                return redirect(url_for('differentiation.batch_progress', batch_id=batch_id))
+
+    standards_tree = gemini_api.get_standards_tree()
+
+    conn.close()
+
+    return render_template('differentiation_tool/new_batch.html',
+                         groups=groups, standards_tree=standards_tree)
+
+def list_import_files(archive):
+    """
+    The lesson files in an uploaded zip, in name order
+
+    Folders, hidden files (including macOS resource forks), empty files and
+    files without a text extension are ignored.
+
+    Returns:
+        tuple: (zip_file, members, error_message)
+        If error_message is not None, the import should be refused
+    """
+    try:
+        zip_file = zipfile.ZipFile(archive.stream)
+    except zipfile.BadZipFile:
+        return (None, [], 'That file is not a zip archive.')
+
+    members = [
+        info for info in zip_file.infolist()
+        if not info.is_dir() and info.file_size > 0
+        and info.filename.lower().endswith(IMPORT_EXTENSIONS)
+        and not any(part.startswith(('.', '__MACOSX')) for part in info.filename.split('/'))
+    ]
+    members.sort(key=lambda info: info.filename.lower())
+
+    if not members:
+        return (zip_file, [], 'The zip has no .md or .txt lesson files.')
+    if len(members) > MAX_IMPORT_FILES:
+        return (zip_file, [], f'The zip has {len(members)} lesson files; import at most {MAX_IMPORT_FILES} at a time.')
+    too_large = [info.filename for info in members if info.file_size > MAX_IMPORT_FILE_BYTES]
+    if too_large:
+        return (zip_file, [], f"These files are larger than {MAX_IMPORT_FILE_BYTES // 1024} KB: {', '.join(too_large)}")
+    if sum(info.file_size for info in members) > MAX_IMPORT_TOTAL_BYTES:
+        return (zip_file, [], f'The lesson files add up to more than {MAX_IMPORT_TOTAL_BYTES // (1024 * 1024)} MB; split the unit into smaller zips.')
+    return (zip_file, members, None)
+
+def import_file_title(filename):
+    """Session title for an imported file, e.g. '03_for-loops.md' -> '03 for loops'"""
+    stem = os.path.splitext(filename.rsplit('/', 1)[-1])[0]
+    return ' '.join(stem.replace('_', ' ').replace('-', ' ').split()) or filename
+
+@bp.errorhandler(413)
+def upload_too_large(error):
+    """An upload over MAX_CONTENT_LENGTH, refused before it was read"""
+    limit = current_app.config.get('MAX_CONTENT_LENGTH') or MAX_UPLOAD_BYTES
+    flash(f'That upload is larger than {limit // (1024 * 1024)} MB.', 'error')
+    return redirect(request.url)
+
+@bp.route('/differentiate/import', methods=['GET', 'POST'])
+@login_required
+def import_unit():
+    """Differentiate every lesson in a zip for the same students"""
+    user_id = session['user_id']
+    conn = db.get_db()
+
+    if request.method == 'POST':
+        title = request.form.get('title')
+        archive = request.files.get('archive')
+        selected_students = request.form.getlist('students')
+        selected_groups = request.form.getlist('groups')
+        selected_standards = request.form.getlist('standards')
+
+        if not archive or not archive.filename:
+            flash('Please choose a zip file of lessons.', 'error')
+        elif not selected_students and not selected_groups:
+            flash('Please select at least one student or group.', 'error')
+        else:
+            zip_file, members, error_msg = list_import_files(archive)
+            lessons = []
+            if not error_msg:
+                # The entries' sizes were checked above, so reading them all
+                # is bounded by MAX_IMPORT_TOTAL_BYTES
+                for info in members:
+                    with zip_file.open(info) as f:
+                        lessons.append((info, f.read(MAX_IMPORT_FILE_BYTES).decode('utf-8-sig', errors='replace')))
+                # Suggestions (one request per chunk) and the final lesson
+                # for each file, counted before anything starts
+                requests = sum(gemini_api.suggestion_request_count(material) + 1 for _, material in lessons)
+                api_key, error_msg = get_user_api_key_or_default(user_id, requests=requests)
+            if error_msg:
+                flash(error_msg, 'error')
+            else:
+                cursor = conn.execute(
+                    'INSERT INTO batches (user_id, title) VALUES (?, ?)',
+                    (user_id, title or import_file_title(archive.filename))
+                )
+                batch_id = cursor.lastrowid
+
+                # Each lesson waits in the queue until advance_batch() starts it
+                for info, material in lessons:
+                    cursor = conn.execute('''
+                        INSERT INTO diff_sessions
+                            (user_id, batch_id, original_material_hash, title, phase, selected_standards)
+                        VALUES (?, ?, ?, ?, 'queued', ?)
+                    ''', (user_id, batch_id, db.put_content(conn, material),
+                          import_file_title(info.filename), json.dumps(selected_standards)))
+                    db.add_session_students(conn, cursor.lastrowid, user_id, selected_students, selected_groups)
+                conn.commit()
+                conn.close()
+
+                advance_batch(batch_id, user_id, api_key)
+                return redirect(url_for('differentiation.batch_progress', batch_id=batch_id))
+
+    students = conn.execute(
+        'SELECT * FROM students WHERE user_id = ? ORDER BY last_name, first_name',
+        (user_id,)
+    ).fetchall()
+
+    groups = conn.execute(
+        'SELECT * FROM groups WHERE user_id = ? ORDER BY name',
+        (user_id,)
+    ).fetchall()
+
+    standards_tree = gemini_api.get_standards_tree()
+
+    conn.close()
+
+    return render_template('differentiation_tool/import_unit.html',
+                         students=students, groups=groups, standards_tree=standards_tree,
+                         max_files=MAX_IMPORT_FILES, max_file_kb=MAX_IMPORT_FILE_BYTES // 1024)
+
+@bp.route('/differentiate/batch/<int:batch_id>')
+@login_required
+def batch_progress(batch_id):
+    """Per-group progress of a batch, with save-all once versions are ready"""
+    conn = db.get_db()
+    batch = get_batch(conn, batch_id, session['user_id'])
+
+    if not batch:
+        flash('Batch not found.', 'error')
+        conn.close()
+        return redirect(url_for('differentiation.dashboard'))
+
+    sessions = get_batch_sessions(conn, batch_id)
+    conn.close()
+
+    return render_template('differentiation_tool/batch_progress.html',
+                         batch=batch, sessions=sessions)
+
+@bp.route('/differentiate/batch/<int:batch_id>/status')
+@login_required
+def batch_status(batch_id):
+    """Poll the per-group progress of a batch"""
+    conn = db.get_db()
+    batch = get_batch(conn, batch_id, session['user_id'])
+
+    if not batch:
+        conn.close()
+        return jsonify({'success': False, 'error': 'Batch not found'}), 404
+
+    sessions = get_batch_sessions(conn, batch_id)
+    conn.close()
+
+    return jsonify({
+        'success': True,
+        'sessions': sessions,
+        'running': any(s['stage'] in ('queued', 'suggesting', 'writing') for s in sessions),
+        'resumable': any(s['stage'] in ('queued', 'interrupted', 'failed') for s in sessions),
+        'unsaved': sum(1 for s in sessions if s['stage'] == 'done'),
+    })
+
+@bp.route('/differentiate/batch/<int:batch_id>/retry', methods=['POST'])
+@login_required
+def retry_batch(batch_id):
+    """
+    Restart failed sessions from the stage they reached and resume the queue
+
+    Sessions whose job was lost (e.g. the worker restarted mid-import) go
+    back to the queue, and queued sessions are started again up to the
+    import limit.
+    """
+    user_id = session['user_id']
+    conn = db.get_db()
+    batch = get_batch(conn, batch_id, user_id)
+
+    if not batch:
+        flash('Batch not found.', 'error')
+        conn.close()
+        return redirect(url_for('differentiation.dashboard'))
+
+    for sess in get_batch_sessions(conn, batch_id):
+        if sess['stage'] == 'interrupted':
+            conn.execute(
+                "UPDATE diff_sessions SET phase = 'queued' WHERE id = ? AND phase = 'generating'",
+                (sess['session_id'],)
+            )
+    conn.commit()
+
+    failed = conn.execute('''
+        SELECT id, phase, original_material_hash FROM diff_sessions
+        WHERE batch_id = ? AND job_error IS NOT NULL AND phase IN ('select_students', 'ready_to_generate')
+    ''', (batch_id,)).fetchall()
+
+    if failed:
+        # The final lesson, plus suggestions (one request per chunk) for
+        # sessions that failed before they had any
+        requests = sum(
+            1 if row['phase'] == 'ready_to_generate'
+            else gemini_api.suggestion_request_count(db.get_content(conn, row['original_material_hash'])) + 1
+            for row in failed
+        )
+        api_key, error_msg = get_user_api_key_or_default(user_id, requests=requests)
+        if error_msg:
+            flash(error_msg, 'error')
+        else:
+            for row in failed:
+                previous_phase = claim_generation(conn, row['id'])
+                if previous_phase is not None:
+                    start_batch_session(conn, row['id'], user_id, api_key, previous_phase)
+    conn.close()
+
+    # Requests for queued sessions were counted when they were imported
+    api_key_info = db.get_user_api_key(user_id)
+    advance_batch(batch_id, user_id, api_key_info['api_key'] if api_key_info else None)
+
+    return redirect(url_for('differentiation.batch_progress', batch_id=batch_id))
+
+@bp.route('/differentiate/batch/<int:batch_id>/save', methods=['POST'])
+@login_required
+def save_batch(batch_id):
+    """Save every finished version in a batch to the library together"""
+    user_id = session['user_id']
+    conn = db.get_db()
+    batch = get_batch(conn, batch_id, user_id)
+
+    if not batch:
+        flash('Batch not found.', 'error')
+        conn.close()
+        return redirect(url_for('differentiation.dashboard'))
+
+    ready = conn.execute('''
+        SELECT ds.id FROM diff_sessions ds
+        WHERE ds.batch_id = ? AND ds.phase = 'completed' AND ds.final_content_hash IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM lessons l WHERE l.session_id = ds.id)
+        ORDER BY ds.id
+    ''', (batch_id,)).fetchall()
+
+    if not ready:
+        flash('There are no finished lessons to save yet.', 'error')
+        conn.close()
+        return redirect(url_for('differentiation.batch_progress', batch_id=batch_id))
+
+    # One transaction, so the versions land in the library together
+    for row in ready:
+        save_session_lesson(conn, db.get_session(conn, row['id'], user_id))
+    conn.execute('UPDATE batches SET saved_at = CURRENT_TIMESTAMP WHERE id = ?', (batch_id,))
+    conn.commit()
+    conn.close()
+
+    flash(f"Saved {len(ready)} lesson{'s' if len(ready) != 1 else ''} to your library!", 'success')
     return redirect(url_for('differentiation.lesson_library'))
 
 # ============= LESSON LIBRARY =============
@@ -746,18 +1614,42 @@ def save_to_library(session_id):
 @bp.route('/library')
 @login_required
 def lesson_library():
-    """View saved lessons"""
+    """View saved lessons, or search them with ?q="""
     user_id = session['user_id']
+    query = request.args.get('q', '').strip()
     conn = db.get_db()
 
-    lessons = conn.execute(
-        'SELECT * FROM lessons WHERE user_id = ? ORDER BY created_at DESC',
-        (user_id,)
-    ).fetchall()
+    if query:
+        lessons = db.search_lessons(conn, user_id, query, limit=LIBRARY_SEARCH_LIMIT)
+    else:
+        lessons = db.fetch_page(
+            conn,
+            'id, title, students_involved, created_at',
+            'lessons',
+            keys=(('created_at', 'created_at'), ('id', 'id')),
+            where='user_id = ?', params=(user_id,),
+            after=request.args.get('after'),
+            per_page=request.args.get('per_page', db.PAGE_SIZE)
+        )
 
     conn.close()
 
-    return render_template('differentiation_tool/library.html', lessons=lessons)
+    return render_template('differentiation_tool/library.html', lessons=lessons, query=query)
+
+@bp.route('/library/search')
+@login_required
+def search_library():
+    """Search saved lessons (JSON)"""
+    query = request.args.get('q', '').strip()
+    conn = db.get_db()
+    results = db.search_lessons(conn, session['user_id'], query, limit=LIBRARY_SEARCH_LIMIT)
+    conn.close()
+
+    return jsonify({
+        'query': query,
+        'results': [dict(result, url=url_for('differentiation.view_lesson', lesson_id=result['id']))
+                    for result in results]
+    })
 
 @bp.route('/library/<int:lesson_id>')
 @login_required
@@ -766,10 +1658,7 @@ def view_lesson(lesson_id):
     user_id = session['user_id']
     conn = db.get_db()
 
-    lesson = conn.execute(
-        'SELECT * FROM lessons WHERE id = ? AND user_id = ?',
-        (lesson_id, user_id)
-    ).fetchone()
+    lesson = db.get_lesson(conn, lesson_id, user_id)
 
     conn.close()
 
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Remove rows whose parent row no longer exists, after backing up the database
+
+Databases from before foreign keys were enforced can hold, for example, the
+students, sessions and API usage of deleted teachers, and the app refuses to
+start on them. This backs the database up next to itself, then deletes each
+orphan (or clears its reference, for ON DELETE SET NULL keys) as the parent's
+delete would have done with enforcement on.
+
+It works on the file directly and does not import the app, so it runs even
+when the app will not start. Stop the app before running it.
+
+Usage: python purge_orphans.py [DB_PATH] [--dry-run]
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+from datetime import datetime
+
+DEFAULT_DB_PATH = os.environ.get('DIFF_DB_PATH') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'differentiation_tool', 'differentiation.db')
+
+
+def violations(conn):
+    """Count of orphaned rows per (table, parent)"""
+    counts = {}
+    for table, _, parent, _ in conn.execute('PRAGMA foreign_key_check'):
+        counts[(table, parent)] = counts.get((table, parent), 0) + 1
+    return counts
+
+
+def backup(conn, path):
+    """Copy the database to <path>.bak-<timestamp> and return the copy's path"""
+    target = f"{path}.bak-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    dest = sqlite3.connect(target)
+    try:
+        conn.backup(dest)
+    finally:
+        dest.close()
+    return target
+
+
+def purge(conn):
+    """
+    Delete or clear orphaned rows until no foreign key violations remain
+
+    Returns:
+        The number of rows removed or cleared
+    """
+    fixed = 0
+    while True:
+        # (table, rowid, parent, fk id); rowid is NULL for WITHOUT ROWID tables
+        keys = {(row[0], row[3]) for row in conn.execute('PRAGMA foreign_key_check')}
+        if not keys:
+            return fixed
+        for table, fk_id in sorted(keys):
+            fk = next(row for row in conn.execute(f'PRAGMA foreign_key_list({table})') if row[0] == fk_id)
+            parent, column, parent_column, on_delete = fk[2], fk[3], fk[4] or 'rowid', fk[6]
+            missing = f'{column} IS NOT NULL AND {column} NOT IN (SELECT {parent_column} FROM {parent})'
+            if on_delete == 'SET NULL':
+                cursor = conn.execute(f'UPDATE {table} SET {column} = NULL WHERE {missing}')
+            else:
+                # Cascades take the orphan's own children with it
+                cursor = conn.execute(f'DELETE FROM {table} WHERE {missing}')
+            fixed += cursor.rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('db_path', nargs='?', default=DEFAULT_DB_PATH)
+    parser.add_argument('--dry-run', action='store_true', help='list the orphans without changing anything')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db_path):
+        sys.exit(f"No database at {args.db_path}")
+
+    conn = sqlite3.connect(args.db_path, isolation_level=None)
+    try:
+        counts = violations(conn)
+        if not counts:
+            print("No orphaned rows")
+            return
+        for (table, parent), count in sorted(counts.items()):
+            print(f"{table}: {count} rows reference missing {parent} rows")
+        if args.dry_run:
+            return
+
+        print(f"Backed up to {backup(conn, args.db_path)}")
+        conn.execute('PRAGMA foreign_keys = ON')
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            fixed = purge(conn)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        print(f"Removed or cleared {fixed} rows")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import os
+import re
+import sys
+import threading
+
+import pytest
+
+# Never touch the package's default database file
+os.environ.setdefault('DIFF_DB_PATH', ':memory:')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'differentiation_tool')
+
+# Schema setup is not a request-path query
+SCHEMA_FUNCTIONS = {'init_db', 'check_foreign_keys'}
+
+LITERAL = re.compile(r"X'[0-9A-Fa-f]*'|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+STATEMENT_TYPES = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+
+def shape(sql):
+    """The statement with literals replaced by ?, for grouping and reporting"""
+    return ' '.join(LITERAL.sub('?', sql).split())
+
+
+class StatementCollector:
+    """Statement tracer keeping one example of each distinct app query"""
+
+    def __init__(self):
+        self.statements = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, sql):
+        sql = sql.strip()
+        # Statements run by triggers are reported as "-- TRIGGER name"
+        if not sql.upper().startswith(STATEMENT_TYPES):
+            return
+        # FTS5 reads and writes its shadow tables as 'main'.'<table>_...'
+        if "'main'." in sql:
+            return
+        frame = sys._getframe(1)
+        if not frame.f_code.co_filename.startswith(PACKAGE_DIR):
+            return
+        while frame is not None:
+            if frame.f_code.co_name in SCHEMA_FUNCTIONS or frame.f_code.co_name.startswith('_migration_'):
+                return
+            frame = frame.f_back
+        with self._lock:
+            self.statements.setdefault(shape(sql), sql)
+
+
+@pytest.fixture(scope='session', autouse=True)
+def traced_statements():
+    """Every distinct statement the package runs during the session (see test_query_plans.py)"""
+    from differentiation_tool import db
+
+    collector = StatementCollector()
+    db.trace_statements(collector)
+    yield collector.statements
+    db.trace_statements(None)
+
+
+def pytest_collection_modifyitems(items):
+    # The query plan checks read what every other test traced, so run them last
+    items.sort(key=lambda item: item.module.__name__.startswith('test_query_plans'))
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """A fresh database file the pool points at for one test"""
+    from differentiation_tool import db
+
+    path = str(tmp_path / 'test.db')
+    db.configure(path)
+    yield path
+    db.configure(db.MEMORY_DB)
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """The blueprint on a bare app with its own database, and Gemini replaced by canned responses"""
+    from flask import Flask
+    from differentiation_tool import bp, db, gemini_api
+
+    db.configure(str(tmp_path / 'app.db'))
+    db.init_db()
+
+    def generate_suggestions(material, students, selected_standards=None, api_key=None, **kwargs):
+        return [
+            {'text': '**Chunk** the task into steps', 'applies_to': [s['name'] for s in students]},
+            {'text': 'Add a glossary of terms', 'applies_to': []},
+        ]
+
+    def generate_differentiated_content(material, suggestions, api_key=None, **kwargs):
+        return f'<h1>Differentiated</h1>\n<p>{material}</p>'
+
+    def stream_differentiated_content(material, suggestions, api_key=None, **kwargs):
+        yield '# Differentiated\n\n'
+        yield material
+
+    monkeypatch.setattr(gemini_api, 'generate_suggestions', generate_suggestions)
+    monkeypatch.setattr(gemini_api, 'generate_differentiated_content', generate_differentiated_content)
+    monkeypatch.setattr(gemini_api, 'stream_differentiated_content', stream_differentiated_content)
+
+    app = Flask(__name__)
+    app.config.update(SECRET_KEY='test')
+    app.register_blueprint(bp)
+    yield app
+    # Writes any buffered usage events to this test's database
+    db.configure(db.MEMORY_DB)
+
+
+@pytest.fixture
+def client(app):
+    """A client logged in as an admin teacher with their own API key"""
+    from werkzeug.security import generate_password_hash
+    from differentiation_tool import db
+
+    conn = db.get_db()
+    conn.execute('''
+        INSERT INTO users (email, password_hash, first_name, last_name, is_admin, is_active, gemini_api_key)
+        VALUES ('admin@example.com', ?, 'Ada', 'Admin', 1, 1, 'key')
+    ''', (generate_password_hash('pw'),))
+    conn.commit()
+    conn.close()
+
+    client = app.test_client()
+    client.post('/diff/login', data={'email': 'admin@example.com', 'password': 'pw'})
+    return client
@@ -0,0 +1,206 @@
+import io
+import time
+import zipfile
+
+from differentiation_tool import db, gemini_api, jobs, routes
+from test_routes import add_roster, ok
+
+
+def wait_for_batch(client, batch_id):
+    for _ in range(200):
+        status = client.get(f'/diff/differentiate/batch/{batch_id}/status').get_json()
+        if not status['running']:
+            return status
+        time.sleep(0.02)
+    raise AssertionError('batch never finished')
+
+
+def zip_of(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, text in files.items():
+            archive.writestr(name, text)
+    buffer.seek(0)
+    return buffer
+
+
+def add_groups(client):
+    add_roster(client)
+    ok(client.post('/diff/groups/add', data={'name': 'IEP', 'students': ['1']}), 302)
+
+
+def start_batch(client, material='Trace the loop.', groups=('1', '2')):
+    response = client.post('/diff/differentiate/batch/new', data={
+        'title': 'Loops', 'material': material, 'groups': list(groups),
+    })
+    ok(response, 302)
+    return int(response.headers['Location'].split('/')[-1])
+
+
+def test_batch_for_several_groups(client):
+    add_groups(client)
+    ok(client.get('/diff/differentiate/batch/new'))
+    batch_id = start_batch(client)
+    ok(client.get(f'/diff/differentiate/batch/{batch_id}'))
+    status = wait_for_batch(client, batch_id)
+    assert [(s['name'], s['stage']) for s in status['sessions']] == [('ELL', 'done'), ('IEP', 'done')]
+    assert status['unsaved'] == 2
+
+    # Nothing failed, so a retry starts nothing
+    ok(client.post(f'/diff/differentiate/batch/{batch_id}/retry'), 302)
+    ok(client.post(f'/diff/differentiate/batch/{batch_id}/save'), 302)
+    status = wait_for_batch(client, batch_id)
+    assert status['unsaved'] == 0 and {s['stage'] for s in status['sessions']} == {'saved'}
+
+    conn = db.get_db()
+    try:
+        rows = conn.execute('SELECT l.students_involved FROM lessons l ORDER BY l.id').fetchall()
+        assert [row[0] for row in rows] == ['Sam Lee, Ana Diaz', 'Sam Lee']
+        # Every suggestion was applied
+        assert conn.execute('SELECT COUNT(*) FROM session_suggestions WHERE approved = 0').fetchone()[0] == 0
+    finally:
+        conn.close()
+
+
+def test_failed_group_is_retried_from_its_phase(client, monkeypatch):
+    add_groups(client)
+    generate = gemini_api.generate_differentiated_content
+    calls = []
+
+    def flaky(material, suggestions, api_key=None, **kwargs):
+        calls.append(material)
+        if len(calls) == 1:
+            raise RuntimeError('overloaded')
+        return generate(material, suggestions, api_key=api_key)
+
+    monkeypatch.setattr(gemini_api, 'generate_differentiated_content', flaky)
+    batch_id = start_batch(client)
+    status = wait_for_batch(client, batch_id)
+    assert sorted(s['stage'] for s in status['sessions']) == ['done', 'failed']
+
+    conn = db.get_db()
+    failed = conn.execute('SELECT phase, job_error FROM diff_sessions WHERE job_error IS NOT NULL').fetchone()
+    conn.close()
+    # The suggestions were kept, so the retry only writes the lesson
+    assert tuple(failed) == ('ready_to_generate', 'overloaded')
+
+    ok(client.post(f'/diff/differentiate/batch/{batch_id}/retry'), 302)
+    assert [s['stage'] for s in wait_for_batch(client, batch_id)['sessions']] == ['done', 'done']
+    # Both groups got the same suggestions, so the retry is answered from
+    # the response cache the other group filled
+    assert len(calls) == 2
+
+
+def test_batch_reserves_free_requests_up_front(client):
+    conn = db.get_db()
+    conn.execute('UPDATE users SET gemini_api_key = NULL, default_key_requests = 1')
+    conn.commit()
+    conn.close()
+    add_groups(client)
+
+    page = ok(client.post('/diff/differentiate/batch/new', data={'title': 'Loops', 'material': 'Trace the loop.',
+                                                                 'groups': ['1', '2']}, follow_redirects=True))
+    assert 'This needs 4 requests, but only 3' in page
+    conn = db.get_db()
+    try:
+        assert conn.execute('SELECT COUNT(*) FROM batches').fetchone()[0] == 0
+        assert conn.execute('SELECT default_key_requests FROM users').fetchone()[0] == 1
+    finally:
+        conn.close()
+
+    wait_for_batch(client, start_batch(client, groups=['2']))
+    conn = db.get_db()
+    try:
+        assert conn.execute('SELECT default_key_requests FROM users').fetchone()[0] == 3
+    finally:
+        conn.close()
+
+
+def test_batch_rejects_empty_groups(client):
+    add_groups(client)
+    ok(client.post('/diff/groups/add', data={'name': 'Empty'}), 302)
+    page = ok(client.post('/diff/differentiate/batch/new', data={'title': 'Loops', 'material': 'Trace the loop.',
+                                                                 'groups': ['3']}, follow_redirects=True))
+    assert 'These groups have no students: Empty' in page
+    assert client.get('/diff/differentiate/batch/99/status').status_code == 404
+
+
+def test_import_unit(client):
+    add_groups(client)
+    ok(client.get('/diff/differentiate/import'))
+    files = {f'unit/{i:02d}_loop-basics.md': f'# Lesson {i}\n\nPractice {i}.' for i in range(3)}
+    # Not lessons: resource forks, hidden files, other types and empty files
+    files.update({'__MACOSX/unit/._00_loop-basics.md': 'x', 'unit/.notes.md': 'x', 'unit/cover.png': 'x',
+                  'unit/empty.txt': ''})
+    response = client.post('/diff/differentiate/import', data={
+        'archive': (zip_of(files), 'unit.zip'), 'groups': ['1'],
+    })
+    ok(response, 302)
+    batch_id = int(response.headers['Location'].split('/')[-1])
+    status = wait_for_batch(client, batch_id)
+    assert [(s['title'], s['stage']) for s in status['sessions']] == [
+        (f'{i:02d} loop basics', 'done') for i in range(3)]
+
+    ok(client.post(f'/diff/differentiate/batch/{batch_id}/save'), 302)
+    conn = db.get_db()
+    try:
+        assert db.get_lesson(conn, 3, 1)['original_material'] == '# Lesson 2\n\nPractice 2.'
+    finally:
+        conn.close()
+
+
+def test_interrupted_import_resumes(client):
+    add_groups(client)
+    files = {f'{i}.md': f'Lesson {i}' for i in range(2)}
+    response = client.post('/diff/differentiate/import', data={'archive': (zip_of(files), 'unit.zip'),
+                                                               'students': ['1']})
+    batch_id = int(response.headers['Location'].split('/')[-1])
+    wait_for_batch(client, batch_id)
+
+    # As if the worker died mid-generation: the job is gone and the row is stale
+    conn = db.get_db()
+    conn.execute("UPDATE diff_sessions SET phase = 'generating', updated_at = datetime('now', ?) WHERE id = 2",
+                 (f'-{jobs.JOB_STALE_AFTER + 60} seconds',))
+    conn.commit()
+    conn.close()
+    status = client.get(f'/diff/differentiate/batch/{batch_id}/status').get_json()
+    assert status['resumable'] and [s['stage'] for s in status['sessions']] == ['done', 'interrupted']
+
+    ok(client.post(f'/diff/differentiate/batch/{batch_id}/retry'), 302)
+    assert [s['stage'] for s in wait_for_batch(client, batch_id)['sessions']] == ['done', 'done']
+
+
+def test_import_refuses_oversized_uploads(client, app, monkeypatch):
+    add_groups(client)
+    assert app.config['MAX_CONTENT_LENGTH'] == routes.MAX_UPLOAD_BYTES
+
+    monkeypatch.setattr(routes, 'MAX_IMPORT_FILE_BYTES', 500)
+    page = ok(client.post('/diff/differentiate/import', data={'archive': (zip_of({'big.md': 'x' * 600}), 'unit.zip'),
+                                                              'groups': ['1']}, follow_redirects=True))
+    assert 'These files are larger than' in page
+
+    # Over the lesson files' uncompressed total, checked from the zip's
+    # directory before any file is read
+    monkeypatch.setattr(routes, 'MAX_IMPORT_TOTAL_BYTES', 1024)
+    files = {f'{i}.md': 'x' * 400 for i in range(3)}
+    page = ok(client.post('/diff/differentiate/import', data={'archive': (zip_of(files), 'unit.zip'), 'groups': ['1']},
+                          follow_redirects=True))
+    assert 'add up to more than' in page
+
+    page = ok(client.post('/diff/differentiate/import', data={'archive': (io.BytesIO(b'not a zip'), 'unit.zip'),
+                                                              'groups': ['1']}, follow_redirects=True))
+    assert 'not a zip archive' in page
+
+    # Over the request size limit, refused before the upload is parsed
+    app.config['MAX_CONTENT_LENGTH'] = 1024
+    response = client.post('/diff/differentiate/import',
+                           data={'archive': (io.BytesIO(b'x' * 4096), 'unit.zip'), 'groups': ['1']})
+    ok(response, 302)
+    assert response.headers['Location'].endswith('/diff/differentiate/import')
+    assert 'larger than' in ok(client.get('/diff/differentiate/import'))
+
+    conn = db.get_db()
+    try:
+        assert conn.execute('SELECT COUNT(*) FROM batches').fetchone()[0] == 0
+    finally:
+        conn.close()
@@ -0,0 +1,93 @@
+import pytest
+
+from differentiation_tool import db
+from test_routes import ok
+
+
+@pytest.fixture
+def roster(db_path):
+    """Teacher 1 owns students 1-3 and group 1; teacher 2 owns student 4 and group 2"""
+    db.init_db()
+    conn = db.get_db()
+    conn.executemany("INSERT INTO users (id, email, password_hash, first_name, last_name) VALUES (?, ?, 'x', 'T', 'T')",
+                     [(1, 'a@example.com'), (2, 'b@example.com'), (3, 'c@example.com')])
+    conn.executemany('INSERT INTO students (id, user_id, first_name, last_name) VALUES (?, ?, ?, ?)',
+                     [(1, 1, 'A', 'A'), (2, 1, 'B', 'B'), (3, 1, 'C', 'C'), (4, 2, 'D', 'D')])
+    conn.executemany("INSERT INTO groups (id, user_id, name) VALUES (?, ?, 'G')", [(1, 1), (2, 2)])
+    yield conn
+    conn.close()
+
+
+def members(conn, group_id):
+    return {row[0] for row in conn.execute('SELECT student_id FROM group_members WHERE group_id = ?', (group_id,))}
+
+
+def member_count(conn, group_id):
+    return conn.execute('SELECT member_count FROM groups WHERE id = ?', (group_id,)).fetchone()[0]
+
+
+def test_group_members(roster):
+    conn = roster
+    # Another teacher's student, junk and a repeat are skipped
+    assert db.add_group_members(conn, 1, 1, ['1', '2', '4', 'x', '2']) == 2
+    assert db.add_group_members(conn, 1, 1, ['1']) == 0
+    assert members(conn, 1) == {1, 2}
+
+    first_row = conn.execute('SELECT id FROM group_members WHERE student_id = 2').fetchone()[0]
+    assert db.set_group_members(conn, 1, 1, ['2', '3']) == (1, 1)
+    assert members(conn, 1) == {2, 3} and member_count(conn, 1) == 2
+    # Unchanged memberships are not rewritten
+    assert conn.execute('SELECT id FROM group_members WHERE student_id = 2').fetchone()[0] == first_row
+
+    assert db.set_group_members(conn, 2, 1, ['1']) is None
+    assert db.set_group_members(conn, 1, 1, []) == (0, 2) and member_count(conn, 1) == 0
+
+
+def test_session_students(roster):
+    conn = roster
+    db.add_group_members(conn, 1, 1, [2, 3])
+    conn.execute("INSERT INTO group_members (group_id, student_id) VALUES (2, 4)")
+    conn.execute('INSERT INTO diff_sessions (id, user_id) VALUES (1, 1)')
+
+    # Student 2 is picked directly and through group 1; group 2 is not the teacher's
+    assert db.add_session_students(conn, 1, 1, ['1', '2', '4'], ['1', '2']) == 3
+    assert {row[0] for row in conn.execute('SELECT student_id FROM session_students')} == {1, 2, 3}
+    assert db.add_session_students(conn, 1, 1) == 0
+
+
+def test_delete_users(roster):
+    conn = roster
+    assert db.delete_users(conn, ['1', '2', 'x'], keep_user_id=1) == 1
+    assert [row[0] for row in conn.execute('SELECT id FROM users ORDER BY id')] == [1, 3]
+    assert conn.execute('SELECT COUNT(*) FROM students WHERE user_id = 2').fetchone()[0] == 0
+    assert db.delete_users(conn, [3]) == 1
+
+
+def test_group_routes_only_touch_own_groups(client):
+    conn = db.get_db()
+    conn.execute("INSERT INTO users (id, email, password_hash, first_name, last_name) VALUES (2, 'b@example.com', 'x', 'B', 'B')")
+    conn.execute("INSERT INTO students (id, user_id, first_name, last_name) VALUES (1, 2, 'D', 'D')")
+    conn.execute("INSERT INTO groups (id, user_id, name) VALUES (1, 2, 'Theirs')")
+    conn.execute('INSERT INTO group_members (group_id, student_id) VALUES (1, 1)')
+    conn.commit()
+    conn.close()
+
+    response = client.post('/diff/groups/edit/1', data={'name': 'Mine', 'students': []})
+    ok(response, 302)
+    assert 'Group not found.' in ok(client.get(response.headers['Location']))
+    conn = db.get_db()
+    try:
+        assert tuple(conn.execute('SELECT name, member_count FROM groups WHERE id = 1').fetchone()) == ('Theirs', 1)
+    finally:
+        conn.close()
+
+
+def test_bulk_delete_users(client):
+    for i in range(3):
+        ok(client.post('/diff/admin/users/create', data={'email': f'u{i}@example.com', 'password': 'pw',
+                                                         'first_name': 'U', 'last_name': 'U'}), 302)
+    response = client.post('/diff/admin/users/bulk-delete', data={'user_ids': ['2', '3', '99']})
+    ok(response, 302)
+    assert '2 user(s) deleted' in ok(client.get(response.headers['Location']))
+    page = ok(client.get('/diff/admin/users'))
+    assert 'u2@example.com' in page and 'u0@example.com' not in page
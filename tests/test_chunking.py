@@ -0,0 +1,109 @@
+from differentiation_tool import db, gemini_api, routes
+from test_batches import add_groups
+from test_routes import ok, ready_to_generate, start_session, wait_for_session
+
+
+class Response:
+    def __init__(self, text):
+        self.text = text
+
+
+STUDENTS = [{'name': 'Sam L.', 'accommodations': 'Extended time'}, {'name': 'Ana D.'}]
+
+
+def test_long_material_is_split_at_headings():
+    material = ''.join(f'## Lesson {i}\n' + 'Trace the loop. ' * 40 + '\n\n' for i in range(6))
+    chunks = gemini_api.split_material(material, 1500)
+
+    assert len(chunks) > 1
+    assert all(len(text) <= 1500 for _, text in chunks)
+    assert ''.join(text for _, text in chunks) == material
+    assert chunks[0][0].startswith('Lesson 0')
+
+
+def test_single_huge_paragraph_is_hard_split():
+    material = 'Trace the loop and record each value. ' * 2000
+    chunks = gemini_api.split_material(material, 8000)
+
+    assert len(chunks) == len(material) // 8000 + 1
+    assert all(len(text) <= 8000 for _, text in chunks)
+    assert ''.join(text for _, text in chunks) == material
+
+    unbroken = 'x' * 20000
+    assert [len(text) for _, text in gemini_api.split_material(unbroken, 8000)] == [8000, 8000, 4000]
+
+
+def test_chunked_suggestions_skip_items_that_are_not_objects(monkeypatch):
+    def generate_content(prompt, *args):
+        return Response('[null, "Use a graphic organizer", {"text": "Add a glossary", "applies_to": ["Sam L."]}, 3]')
+
+    monkeypatch.setattr(gemini_api, 'CHUNK_MAX_CHARS', 1500)
+    monkeypatch.setattr(gemini_api, '_generate_content', generate_content)
+    material = ''.join(f'## Lesson {i}\n' + 'Trace the loop. ' * 40 + '\n\n' for i in range(4))
+
+    suggestions = gemini_api.generate_suggestions(material, STUDENTS)
+    assert [s['text'] for s in suggestions] == ['Add a glossary']
+    assert suggestions[0]['applies_to'] == ['Sam L.']
+    assert suggestions[0]['section'].startswith('Lesson 0')
+
+    # The single-request path skips them the same way
+    assert [s['text'] for s in gemini_api.generate_suggestions('Trace the loop.', STUDENTS)] == ['Add a glossary']
+
+
+def test_duplicate_suggestions_are_merged():
+    merged = gemini_api.merge_suggestions([
+        [{'text': 'Add a glossary of loop terms.', 'applies_to': ['Sam L.'], 'section': 'Lesson 1'}],
+        [{'text': 'add a glossary of loop terms', 'applies_to': ['Ana D.'], 'section': 'Lesson 2'},
+         {'text': 'Provide a trace table', 'applies_to': [], 'section': 'Lesson 2'}],
+    ])
+    assert merged == [
+        {'text': 'Add a glossary of loop terms.', 'applies_to': ['Sam L.', 'Ana D.'], 'section': 'Lesson 1, Lesson 2'},
+        {'text': 'Provide a trace table', 'applies_to': [], 'section': 'Lesson 2'},
+    ]
+
+
+def test_sections_reach_the_review_page_and_the_prompt(client, monkeypatch):
+    def generate_suggestions(material, students, selected_standards=None, api_key=None, **kwargs):
+        return [{'text': 'Add a trace table', 'applies_to': [], 'section': 'Lesson 2'}]
+
+    prompts = []
+
+    def generate_differentiated_content(material, suggestions, api_key=None, **kwargs):
+        prompts.append(suggestions)
+        return '<p>Done</p>'
+
+    monkeypatch.setattr(gemini_api, 'generate_suggestions', generate_suggestions)
+    monkeypatch.setattr(gemini_api, 'generate_differentiated_content', generate_differentiated_content)
+    monkeypatch.setattr(routes, 'STREAM_FINAL_CONTENT', False)
+    session_id = ready_to_generate(client)
+    assert 'Section: Lesson 2' in ok(client.get(f'/diff/differentiate/{session_id}/suggestions'))
+
+    client.get(f'/diff/differentiate/{session_id}/generate')
+    wait_for_session(client, session_id)
+    assert prompts == [[gemini_api.suggestion_for_prompt('Add a trace table', 'Lesson 2')]]
+
+
+def test_free_requests_count_each_chunk(client, monkeypatch):
+    monkeypatch.setattr(gemini_api, 'CHUNK_MAX_CHARS', 1000)
+    conn = db.get_db()
+    conn.execute('UPDATE users SET gemini_api_key = NULL')
+    conn.commit()
+    conn.close()
+    add_groups(client)
+    material = ''.join(f'## Lesson {i}\n' + 'Trace the loop. ' * 40 + '\n\n' for i in range(3))
+    assert gemini_api.suggestion_request_count(material) == 3
+    assert gemini_api.suggestion_request_count('Trace the loop.') == 1
+
+    # A batch for two groups needs 2 x (3 + 1) requests
+    page = ok(client.post('/diff/differentiate/batch/new', data={'title': 'Loops', 'material': material,
+                                                                 'groups': ['1', '2']}, follow_redirects=True))
+    assert 'This needs 8 requests' in page
+
+    session_id = start_session(client, material=material)
+    client.get(f'/diff/differentiate/{session_id}/suggestions')
+    wait_for_session(client, session_id)
+    conn = db.get_db()
+    try:
+        assert conn.execute('SELECT default_key_requests FROM users WHERE id = 1').fetchone()[0] == 3
+    finally:
+        conn.close()
@@ -0,0 +1,126 @@
+import hashlib
+import zlib
+
+from differentiation_tool import db
+from test_migrations import create_baseline
+from test_routes import ok, ready_to_generate
+
+SHARED = '# Fractions\n\n' + 'Halves, thirds and quarters. ' * 40
+LESSON = '<h1>Fractions</h1>\n' + '<p>Cut the pizza into equal slices.</p>\n' * 30
+
+
+def sha(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def refs(conn):
+    return dict(conn.execute('SELECT hash, refs FROM content_blobs').fetchall())
+
+
+def test_put_content_dedupes_and_compresses(db_path):
+    db.init_db()
+    conn = db.get_db()
+    digest = db.put_content(conn, SHARED)
+    assert digest == sha(SHARED) and db.put_content(conn, SHARED) == digest
+    compression, size, data = conn.execute('SELECT compression, size, data FROM content_blobs').fetchone()
+    assert compression == 'zlib' and size == len(SHARED) and zlib.decompress(data).decode() == SHARED
+
+    # Compressing a short string makes it longer, so it is stored as is
+    short = db.put_content(conn, 'é')
+    assert conn.execute('SELECT compression FROM content_blobs WHERE hash = ?', (short,)).fetchone()[0] is None
+    assert db.get_content(conn, short) == 'é'
+    assert db.put_content(conn, None) is None and db.get_content(conn, None) is None
+    conn.close()
+
+
+def test_reference_counts_follow_rows(db_path):
+    db.init_db()
+    conn = db.get_db()
+    conn.execute("INSERT INTO users (id, email, password_hash, first_name, last_name) VALUES (1, 't@example.com', 'x', 'T', 'T')")
+    material, content = db.put_content(conn, SHARED), db.put_content(conn, LESSON)
+    conn.execute('INSERT INTO diff_sessions (id, user_id, original_material_hash, final_content_hash) VALUES (1, 1, ?, ?)',
+                 (material, content))
+    conn.execute('''INSERT INTO lessons (id, user_id, session_id, title, original_material_hash, content_hash)
+                    VALUES (1, 1, 1, 'Fractions', ?, ?)''', (material, content))
+    assert refs(conn) == {material: 2, content: 2}
+
+    replacement = db.put_content(conn, 'Rewritten')
+    conn.execute('UPDATE diff_sessions SET final_content_hash = ? WHERE id = 1', (replacement,))
+    assert refs(conn) == {material: 2, content: 1, replacement: 1}
+
+    conn.execute('DELETE FROM lessons WHERE id = 1')
+    assert refs(conn) == {material: 1, replacement: 1}
+    # Cascades release their blobs too
+    conn.execute('DELETE FROM users WHERE id = 1')
+    assert refs(conn) == {}
+    conn.close()
+
+
+def test_upgrade_populated_version_6(db_path, monkeypatch):
+    create_baseline(db_path)
+    migrations = db.MIGRATIONS
+    monkeypatch.setattr(db, 'MIGRATIONS', migrations[:6])
+    assert db.init_db() == 6
+
+    conn = db.get_db()
+    sessions, lessons = {1: ('Loops', None)}, {1: ('Loops', '<p>Loops</p>')}
+    for i in range(2, 8):
+        material = SHARED if i % 2 else f'Material {i}'
+        final = LESSON if i % 3 else None
+        conn.execute('INSERT INTO diff_sessions (id, user_id, original_material, final_content) VALUES (?, 1, ?, ?)',
+                     (i, material, final))
+        sessions[i] = (material, final)
+        if final:
+            # Saved lessons copied their session's text
+            conn.execute('''INSERT INTO lessons (id, user_id, session_id, title, original_material, differentiated_content)
+                            VALUES (?, 1, ?, 'Copy', ?, ?)''', (i, i, material, final))
+            lessons[i] = (material, final)
+    conn.commit()
+    conn.close()
+
+    # Several batches, with a partial last one
+    monkeypatch.setattr(db, 'CONTENT_MIGRATION_BATCH_SIZE', 3)
+    monkeypatch.setattr(db, 'MIGRATIONS', migrations)
+    db.init_db()
+
+    conn = db.get_db()
+    try:
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(diff_sessions)')]
+        assert 'original_material' not in columns and 'final_content' not in columns
+        for session_id, (material, final) in sessions.items():
+            row = db.get_session(conn, session_id, 1)
+            assert (row['original_material'], row['final_content']) == (material, final)
+            assert row['original_material_hash'] == sha(material)
+            assert row['final_content_hash'] == (final and sha(final))
+        for lesson_id, (material, content) in lessons.items():
+            row = db.get_lesson(conn, lesson_id, 1)
+            assert (row['original_material'], row['differentiated_content']) == (material, content)
+            assert (row['original_material_hash'], row['content_hash']) == (sha(material), sha(content))
+
+        expected = {}
+        for texts in [*sessions.values(), *lessons.values()]:
+            for text in texts:
+                if text is not None:
+                    expected[sha(text)] = expected.get(sha(text), 0) + 1
+        assert refs(conn) == expected
+        # Text shared by sessions and their lessons is stored once
+        assert expected[sha(SHARED)] == 5 and expected[sha(LESSON)] == 8
+    finally:
+        conn.close()
+
+
+def test_saved_lesson_shares_the_session_blobs(client):
+    session_id = ready_to_generate(client)
+    response = client.post(f'/diff/differentiate/{session_id}/save')
+    assert ok(response, 302) and response.headers['Location'].endswith(f'/differentiate/{session_id}/generate')
+
+    ok(client.get(f'/diff/differentiate/{session_id}/stream'))
+    ok(client.post(f'/diff/differentiate/{session_id}/save'), 302)
+    conn = db.get_db()
+    try:
+        session_row = conn.execute('SELECT original_material_hash, final_content_hash FROM diff_sessions').fetchone()
+        lesson_row = conn.execute('SELECT original_material_hash, content_hash FROM lessons').fetchone()
+        assert tuple(session_row) == tuple(lesson_row)
+        assert 'Trace the loop' in db.get_lesson(conn, 1, 1)['differentiated_content']
+    finally:
+        conn.close()
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from differentiation_tool import gemini_api
+
+CURRICULUM = '''# Introduction to Computer Science
+
+## Domain 1 – Careers and Professionalism
+
+### Standard 1.1 – Demonstrate professional readiness
+
+* **1.1.1** Describe career paths in computer science.
+* **1.1.2** Practice professional communication.
+
+## Domain 2 – Computational Thinking
+
+### Standard 2.1 – Apply computational thinking
+
+* **2.1.1** Recognize computational approaches.
+'''
+
+
+@pytest.fixture
+def index(tmp_path):
+    path = tmp_path / 'curriculum.md'
+    path.write_text(CURRICULUM, encoding='utf-8')
+    return gemini_api.StandardsIndex(str(path), check_interval=0)
+
+
+def test_index_is_built_once(index, monkeypatch):
+    builds = []
+    build = index._build
+    monkeypatch.setattr(index, '_build', lambda text: builds.append(text) or build(text))
+
+    for _ in range(3):
+        assert index.get('1.1.2')['standard_title'] == 'Demonstrate professional readiness'
+    assert len(builds) == 1
+
+    assert [d['heading'] for d in index.tree] == ['Domain 1 – Careers and Professionalism',
+                                                  'Domain 2 – Computational Thinking']
+    assert [i['code'] for i in index.tree[0]['standards'][0]['indicators']] == ['1.1.1', '1.1.2']
+
+
+def test_index_reloads_when_the_file_changes(index):
+    index.refresh()
+    standards = index.standards
+
+    # Touched but identical: the index is kept
+    stat = os.stat(index.path)
+    os.utime(index.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    index.refresh()
+    assert index.standards is standards
+
+    with open(index.path, 'a', encoding='utf-8') as f:
+        f.write('* **2.1.2** Apply abstraction and decomposition.\n')
+    index.refresh()
+    assert index.get('2.1.2')['text'] == 'Apply abstraction and decomposition.'
+
+
+def test_selected_standards_in_document_order(index):
+    text = index.format_selected(['2.1.1', '1.1.1', '9.9.9'])
+    assert text.index('1.1.1') < text.index('2.1.1')
+    assert '9.9.9' not in text
+    assert 'Domain 1 – Careers and Professionalism' in text
+    assert index.format_selected(['9.9.9']) == ''
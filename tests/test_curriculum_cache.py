@@ -0,0 +1,97 @@
+import datetime
+
+from differentiation_tool import gemini_api
+
+
+class FakeCache:
+    """Stands in for a CachedContent: a name and a server-side expiry"""
+
+    def __init__(self, name, ttl):
+        self.name = name
+        self.expire_time = datetime.datetime.now(datetime.timezone.utc) + ttl
+        self.updates = 0
+
+    def update(self, ttl):
+        self.updates += 1
+        self.expire_time = datetime.datetime.now(datetime.timezone.utc) + ttl
+
+
+class FakeClient:
+    """A GeminiClient that only knows its key"""
+
+    def __init__(self, api_key):
+        self.fingerprint = gemini_api.key_fingerprint(api_key)
+
+    def extend_cached_content(self, cache, ttl):
+        cache.update(ttl)
+        return cache
+
+
+KEY_A, KEY_B = FakeClient('key-a'), FakeClient('key-b')
+
+
+class Creator:
+    def __init__(self, ttl=gemini_api.CACHE_TTL, fail=False):
+        self.ttl = ttl
+        self.fail = fail
+        self.created = []
+
+    def __call__(self):
+        if self.fail:
+            raise RuntimeError('quota exceeded')
+        cache = FakeCache(f'cachedContents/{len(self.created)}', self.ttl)
+        self.created.append(cache)
+        return cache
+
+
+def test_caches_are_kept_per_key():
+    registry = gemini_api.CurriculumCacheRegistry()
+    create = Creator()
+
+    teacher_a = registry.get(KEY_A, 'models/m', 'hash', create)
+    assert registry.get(KEY_A, 'models/m', 'hash', create) is teacher_a
+    teacher_b = registry.get(KEY_B, 'models/m', 'hash', create)
+    assert teacher_b is not teacher_a
+    # New curriculum content gets a new cache
+    assert registry.get(KEY_A, 'models/m', 'new-hash', create) not in (teacher_a, teacher_b)
+    assert len(create.created) == 3
+
+
+def test_cache_close_to_server_expiry_is_extended():
+    registry = gemini_api.CurriculumCacheRegistry(refresh_margin=300)
+    create = Creator(ttl=datetime.timedelta(seconds=60))
+
+    cache = registry.get(KEY_A, 'models/m', 'hash', create)
+    assert registry.get(KEY_A, 'models/m', 'hash', create) is cache
+    assert cache.updates == 1
+    assert len(create.created) == 1
+
+
+def test_expired_cache_is_recreated():
+    registry = gemini_api.CurriculumCacheRegistry()
+    create = Creator(ttl=datetime.timedelta(seconds=-1))
+
+    first = registry.get(KEY_A, 'models/m', 'hash', create)
+    second = registry.get(KEY_A, 'models/m', 'hash', create)
+    assert second is not first
+    assert first.updates == 0
+
+
+def test_least_recently_used_cache_is_evicted():
+    registry = gemini_api.CurriculumCacheRegistry(max_entries=2)
+    create = Creator()
+
+    oldest = registry.get(KEY_A, 'models/m', 'hash', create)
+    registry.get(KEY_B, 'models/m', 'hash', create)
+    registry.get(FakeClient('key-c'), 'models/m', 'hash', create)
+    assert registry.get(KEY_A, 'models/m', 'hash', create) is not oldest
+
+
+def test_failed_creation_is_not_retried_immediately():
+    registry = gemini_api.CurriculumCacheRegistry(retry_after=300)
+    create = Creator(fail=True)
+
+    assert registry.get(KEY_A, 'models/m', 'hash', create) is None
+    create.fail = False
+    assert registry.get(KEY_A, 'models/m', 'hash', create) is None
+    assert create.created == []
@@ -0,0 +1,97 @@
+import threading
+
+import pytest
+
+from differentiation_tool import gemini_api
+
+
+class Response:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeClient:
+    """A GeminiClient whose model answers with the key it was built for"""
+
+    def __init__(self, api_key):
+        self.api_key = api_key
+        self.fingerprint = gemini_api.key_fingerprint(api_key)
+
+    def model(self, model_name=gemini_api.GEMINI_MODEL, cached_content=None):
+        client = self
+
+        class Model:
+            def generate_content(self, prompt):
+                return Response(client.api_key)
+        return Model()
+
+
+@pytest.fixture
+def fake_clients(monkeypatch):
+    def configure(**kwargs):
+        raise AssertionError('genai.configure() swaps credentials for every thread')
+
+    monkeypatch.setattr(gemini_api.genai, 'configure', configure)
+    monkeypatch.setattr(gemini_api, 'GeminiClient', FakeClient)
+    monkeypatch.setattr(gemini_api, '_client_pool', gemini_api.GeminiClientPool(size=2, max_keys=2))
+    monkeypatch.setattr(gemini_api, 'get_or_create_curriculum_cache', lambda api_key=None, client=None: None)
+    monkeypatch.setattr(gemini_api, 'rate_limiter', gemini_api.RateLimiter(rate=6000, burst=100))
+
+
+def test_concurrent_calls_use_their_own_keys(fake_clients):
+    results = {}
+    start = threading.Barrier(8)
+
+    def call(key):
+        start.wait()
+        results[key] = [gemini_api._generate_content('prompt', key).text for _ in range(20)]
+
+    threads = [threading.Thread(target=call, args=(f'key-{i}',)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {f'key-{i}': [f'key-{i}'] * 20 for i in range(8)}
+
+
+def test_pool_reuses_clients_per_key(fake_clients):
+    pool = gemini_api.GeminiClientPool(size=1, max_keys=2)
+    first = pool.acquire('key-a')
+    second = pool.acquire('key-a')
+    assert first is not second
+    pool.release(first)
+    pool.release(second)
+    # Only `size` idle clients are kept per key
+    assert pool.acquire('key-a') is first
+    assert pool.acquire('key-a') is not second
+
+    # and only for the max_keys most recently used keys
+    clients = {key: pool.acquire(key) for key in ('key-a', 'key-b', 'key-c')}
+    for client in clients.values():
+        pool.release(client)
+    assert pool.acquire('key-a') is not clients['key-a']
+    assert pool.acquire('key-c') is clients['key-c']
+
+
+def test_missing_key_is_refused(fake_clients, monkeypatch):
+    monkeypatch.setattr(gemini_api, 'DEFAULT_API_KEY', '')
+    with pytest.raises(ValueError):
+        gemini_api._client_pool.acquire(None)
+
+
+def test_model_is_bound_to_the_client_key():
+    client = gemini_api.GeminiClient('key-a')
+    model = client.model()
+    assert model._client is client.generative_client
+
+    cache = gemini_api.caching.CachedContent._from_obj(
+        gemini_api.protos.CachedContent(name='cachedContents/abc', model=f'models/{gemini_api.GEMINI_MODEL}'))
+    assert client.model(cached_content=cache).cached_content == 'cachedContents/abc'
+
+
+def test_sdk_check_names_missing_internals(monkeypatch):
+    gemini_api.check_sdk()
+    monkeypatch.delattr(gemini_api.caching.CachedContent, '_from_obj')
+    with pytest.raises(ImportError, match=r'CachedContent\._from_obj'):
+        gemini_api.check_sdk()
@@ -0,0 +1,98 @@
+import logging
+import threading
+
+from differentiation_tool import db, jobs, routes
+
+
+def finish(job_key):
+    """Wait for a submitted job to end"""
+    with jobs._running_lock:
+        future = jobs._running.get(job_key)
+    if future is not None:
+        future.result(5)
+
+
+def test_duplicate_job_is_not_queued():
+    release = threading.Event()
+    calls = []
+    assert jobs.submit(('suggestions', 1), lambda: calls.append(release.wait(5)))
+    try:
+        assert jobs.is_running(('suggestions', 1))
+        assert not jobs.submit(('suggestions', 1), calls.append, 'again')
+    finally:
+        release.set()
+    finish(('suggestions', 1))
+    assert calls == [True]
+    assert not jobs.is_running(('suggestions', 1))
+
+
+def test_failed_job_is_logged_and_released(caplog):
+    def fail():
+        raise RuntimeError('quota exceeded')
+
+    with caplog.at_level(logging.ERROR, logger='differentiation_tool.jobs'):
+        assert jobs.submit(('final', 2), fail)
+        finish(('final', 2))
+    assert not jobs.is_running(('final', 2))
+    assert 'quota exceeded' in caplog.text
+
+
+def make_session(phase, age=0):
+    conn = db.get_db()
+    conn.execute("INSERT INTO users (id, email, password_hash, first_name, last_name) VALUES (1, 't@example.com', 'x', 'T', 'T') "
+                 "ON CONFLICT(id) DO NOTHING")
+    cursor = conn.execute('''
+        INSERT INTO diff_sessions (user_id, original_material_hash, title, phase, updated_at)
+        VALUES (1, ?, 'Loops', ?, datetime('now', ?))
+    ''', (db.put_content(conn, 'Trace the loop.'), phase, f'-{age} seconds'))
+    conn.commit()
+    conn.close()
+    return cursor.lastrowid
+
+
+def claim(session_id):
+    conn = db.get_db()
+    try:
+        return routes.claim_generation(conn, session_id)
+    finally:
+        conn.close()
+
+
+def test_session_is_claimed_once(app):
+    session_id = make_session('select_students')
+    assert claim(session_id) == 'select_students'
+    assert claim(session_id) is None
+    assert claim(make_session('generating')) is None
+
+
+def test_abandoned_session_can_be_reclaimed(app):
+    session_id = make_session('generating', jobs.JOB_STALE_AFTER + 60)
+    assert claim(session_id) == 'generating'
+
+
+def test_deleted_session_is_not_claimed(app):
+    assert claim(12345) is None
+
+
+def test_heartbeat_keeps_long_job_claimed(app):
+    session_id = make_session('generating', jobs.JOB_STALE_AFTER + 60)
+    release = threading.Event()
+    assert jobs.submit(('suggestions', session_id), release.wait)
+    try:
+        # A job stuck in rate-limit backoff past JOB_STALE_AFTER
+        with jobs._running_lock:
+            job_keys = list(jobs._running)
+        jobs._heartbeat_callback(job_keys)
+        assert claim(session_id) is None
+    finally:
+        release.set()
+
+
+def test_streamed_generation_counts_as_running(app):
+    session_id = make_session('generating', jobs.JOB_STALE_AFTER + 60)
+    with jobs.running(('final', session_id)):
+        assert jobs.is_running(('final', session_id))
+        routes.refresh_running_sessions([('final', session_id)])
+        assert claim(session_id) is None
+    assert not jobs.is_running(('final', session_id))
+
@@ -0,0 +1,81 @@
+from differentiation_tool import db, rendering
+from test_migrations import create_baseline
+from test_routes import ok
+
+
+def add_lesson(conn, user_id, title, content, material='', students=''):
+    cursor = conn.execute('''
+        INSERT INTO lessons (user_id, title, original_material_hash, content_hash, students_involved)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (user_id, title, db.put_content(conn, material), db.put_content(conn, content), students))
+    db.index_lesson(conn, cursor.lastrowid, user_id, title, material, content, students)
+    return cursor.lastrowid
+
+
+def teachers(conn):
+    conn.execute("INSERT INTO users (id, email, password_hash, first_name, last_name) VALUES (1, 'a@example.com', 'x', 'A', 'A')")
+    conn.execute("INSERT INTO users (id, email, password_hash, first_name, last_name) VALUES (2, 'b@example.com', 'x', 'B', 'B')")
+
+
+def test_html_to_text():
+    assert rendering.html_to_text('<h1>Loops</h1>\n<p>Fish &amp; <em>chips</em></p>') == 'Loops Fish & chips'
+    assert rendering.html_to_text(None) == ''
+
+
+def test_search_is_ranked_marked_and_private(db_path):
+    db.init_db()
+    conn = db.get_db()
+    teachers(conn)
+    photo = add_lesson(conn, 1, 'Photosynthesis', '<p>Plants turn <strong>light</strong> into sugar.</p>')
+    add_lesson(conn, 1, 'Cells', '<p>Chloroplasts carry out photosynthesis.</p>')
+    add_lesson(conn, 2, 'Photosynthesis for B', '<p>Other teacher</p>')
+    xss = add_lesson(conn, 1, '<script>alert(1)</script> lab', '<p>Safety</p>', students='Sam Li')
+    conn.commit()
+
+    results = db.search_lessons(conn, 1, 'photo')
+    # Title matches are weighted above content matches; teacher 2 is not searched
+    assert [r['title'] for r in results] == ['Photosynthesis', 'Cells']
+    assert results[0]['title_html'] == '<mark>Photosynthesis</mark>'
+    assert '<mark>photosynthesis</mark>' in results[1]['snippet_html']
+    assert db.search_lessons(conn, 1, 'sugar')[0]['id'] == photo
+    # Tags are not indexed
+    assert db.search_lessons(conn, 1, 'strong') == []
+
+    result, = db.search_lessons(conn, 1, 'lab')
+    assert result['id'] == xss and '<script>' not in result['title_html']
+    # The best snippet comes from whichever column matched
+    assert '<mark>Sam</mark>' in db.search_lessons(conn, 1, 'sam')[0]['snippet_html']
+    assert db.search_lessons(conn, 1, '"(') == []
+
+    conn.execute('DELETE FROM lessons WHERE id = ?', (photo,))
+    conn.execute('DELETE FROM users WHERE id = 2')
+    assert conn.execute('SELECT COUNT(*) FROM lessons_fts').fetchone()[0] == 2
+    conn.commit()
+    conn.close()
+
+
+def test_migration_indexes_existing_lessons(db_path):
+    create_baseline(db_path)
+    db.init_db()
+    conn = db.get_db()
+    try:
+        result, = db.search_lessons(conn, 1, 'loops')
+        assert result['title_html'] == '<mark>Loops</mark>'
+    finally:
+        conn.close()
+
+
+def test_library_search_routes(client):
+    conn = db.get_db()
+    add_lesson(conn, 1, 'Fractions', '<p>Halves and quarters</p>')
+    add_lesson(conn, 1, 'Decimals', '<p>Tenths</p>')
+    conn.commit()
+    conn.close()
+
+    page = ok(client.get('/diff/library?q=quart'))
+    assert 'Fractions' in page and 'Decimals' not in page
+    assert 'Decimals' in ok(client.get('/diff/library'))
+
+    data = client.get('/diff/library/search?q=tenth').get_json()
+    assert data['query'] == 'tenth'
+    assert [(r['title'], r['url']) for r in data['results']] == [('Decimals', '/diff/library/2')]
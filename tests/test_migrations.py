@@ -0,0 +1,202 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from differentiation_tool import db
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Schema as created by the first release, before migrations were tracked
+# and before foreign keys were enforced
+BASELINE_SCHEMA = '''
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT UNIQUE NOT NULL,
+    password_hash TEXT NOT NULL,
+    first_name TEXT NOT NULL,
+    last_name TEXT NOT NULL,
+    is_admin INTEGER DEFAULT 0,
+    is_active INTEGER DEFAULT 0,
+    gemini_api_key TEXT,
+    default_key_requests INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE api_usage (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    endpoint TEXT NOT NULL,
+    request_type TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+);
+CREATE TABLE user_stats (
+    user_id INTEGER PRIMARY KEY,
+    api_requests_count INTEGER DEFAULT 0,
+    lessons_created_count INTEGER DEFAULT 0,
+    students_count INTEGER DEFAULT 0,
+    groups_count INTEGER DEFAULT 0,
+    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+);
+CREATE TABLE students (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    first_name TEXT NOT NULL,
+    last_name TEXT NOT NULL,
+    accommodations TEXT,
+    needs_description TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+);
+CREATE TABLE groups (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    description TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+);
+CREATE TABLE group_members (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    group_id INTEGER NOT NULL,
+    student_id INTEGER NOT NULL,
+    FOREIGN KEY (group_id) REFERENCES groups (id) ON DELETE CASCADE,
+    FOREIGN KEY (student_id) REFERENCES students (id) ON DELETE CASCADE,
+    UNIQUE(group_id, student_id)
+);
+CREATE TABLE diff_sessions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    original_material TEXT NOT NULL,
+    title TEXT,
+    phase TEXT DEFAULT 'analyze',
+    suggestions TEXT,
+    approved_suggestions TEXT,
+    final_content TEXT,
+    selected_standards TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+);
+CREATE TABLE session_students (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id INTEGER NOT NULL,
+    student_id INTEGER NOT NULL,
+    FOREIGN KEY (session_id) REFERENCES diff_sessions (id) ON DELETE CASCADE,
+    FOREIGN KEY (student_id) REFERENCES students (id) ON DELETE CASCADE
+);
+CREATE TABLE lessons (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    session_id INTEGER,
+    title TEXT NOT NULL,
+    original_material TEXT,
+    differentiated_content TEXT NOT NULL,
+    students_involved TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+    FOREIGN KEY (session_id) REFERENCES diff_sessions (id) ON DELETE SET NULL
+);
+'''
+
+
+
+
+def create_baseline(path):
+    """A database as the first release left it, with one teacher's roster"""
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute("INSERT INTO users (id, email, password_hash, first_name, last_name) VALUES (1, 't@example.com', 'x', 'T', 'T')")
+    conn.execute("INSERT INTO students (id, user_id, first_name, last_name) VALUES (1, 1, 'S', 'T')")
+    conn.execute("INSERT INTO diff_sessions (id, user_id, original_material) VALUES (1, 1, 'Loops')")
+    conn.execute('''INSERT INTO lessons (user_id, session_id, title, original_material, differentiated_content)
+                    VALUES (1, 1, 'Loops', 'Loops', '<p>Loops</p>')''')
+    conn.commit()
+    conn.close()
+
+
+def test_upgrade_baseline(db_path):
+    create_baseline(db_path)
+
+    assert db.init_db() == len(db.MIGRATIONS)
+    conn = db.get_db()
+    try:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == len(db.MIGRATIONS)
+        assert conn.execute('SELECT response_cache_enabled FROM users').fetchone()[0] == 1
+        assert conn.execute('SELECT title FROM lessons').fetchone()[0] == 'Loops'
+        assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_students_user_name'").fetchone()
+    finally:
+        conn.close()
+
+
+def test_current_schema_is_a_single_read(db_path):
+    db.init_db()
+    statements = []
+    conn = db._pool.acquire()
+    conn.set_trace_callback(statements.append)
+    db._pool.release(conn)
+
+    assert db.init_db() == len(db.MIGRATIONS)
+    assert statements == ['PRAGMA user_version']
+
+
+def test_concurrent_workers_migrate_once(db_path, monkeypatch):
+    applied = []
+    migration = db.MIGRATIONS[-1]
+
+    def counted(cursor):
+        applied.append(1)
+        migration(cursor)
+
+    monkeypatch.setattr(db, 'MIGRATIONS', db.MIGRATIONS[:-1] + [counted])
+    threads = [threading.Thread(target=db.init_db) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert applied == [1]
+
+
+def test_importing_does_not_touch_the_database(tmp_path):
+    path = tmp_path / 'never.db'
+    env = dict(os.environ, DIFF_DB_PATH=str(path))
+    subprocess.run([sys.executable, '-c', 'import differentiation_tool'], cwd=ROOT, env=env, check=True)
+    assert not path.exists()
+
+
+def test_memory_database_is_shared_by_pooled_connections():
+    db.configure(db.MEMORY_DB)
+    db.init_db()
+    first, second = db.get_db(), db.get_db()
+    try:
+        first.execute("INSERT INTO users (email, password_hash, first_name, last_name) VALUES ('a@b', 'x', 'A', 'B')")
+        first.commit()
+        assert second.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 1
+    finally:
+        first.close()
+        second.close()
+    db.configure(db.MEMORY_DB)
+
+
+def test_migration_leaving_violations_is_rolled_back(db_path, monkeypatch):
+    db.init_db()
+
+    def bad_migration(cursor):
+        # Deferred, so only the check after the migration can catch it
+        cursor.execute('PRAGMA defer_foreign_keys = ON')
+        cursor.execute("INSERT INTO students (user_id, first_name, last_name) VALUES (99, 'S', 'T')")
+
+    monkeypatch.setattr(db, 'MIGRATIONS', db.MIGRATIONS + [bad_migration])
+    with pytest.raises(sqlite3.IntegrityError, match='Migration .* left a foreign key violation'):
+        db.init_db()
+
+    conn = db.get_db()
+    try:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == len(db.MIGRATIONS) - 1
+        assert conn.execute('SELECT COUNT(*) FROM students').fetchone()[0] == 0
+    finally:
+        conn.close()
@@ -0,0 +1,85 @@
+import re
+
+from differentiation_tool import db
+from test_migrations import create_baseline
+from test_routes import ok
+
+
+def next_page(page):
+    match = re.search(r'after=([^"&]+)', page)
+    return match and match.group(1)
+
+
+def test_page_size_is_clamped():
+    assert db.page_size('10') == 10
+    assert db.page_size('0') == 1
+    assert db.page_size('100000') == db.MAX_PAGE_SIZE
+    assert db.page_size('lots') == db.PAGE_SIZE
+    assert db.page_size(None, default=7) == 7
+
+
+def test_fetch_page_walks_the_key_without_repeats(db_path):
+    db.init_db()
+    conn = db.get_db()
+    conn.execute("INSERT INTO users (id, email, password_hash, first_name, last_name) VALUES (1, 't@example.com', 'x', 'T', 'T')")
+    # Duplicate names, so only id keeps the order total
+    conn.executemany("INSERT INTO students (user_id, first_name, last_name) VALUES (1, ?, ?)",
+                     [('Ann', 'Lee'), ('Bo', 'Lee'), ('Ann', 'Lee'), ('Cy', 'Ames'), ('Di', 'Zed')])
+    keys = (('last_name', 'last_name'), ('first_name', 'first_name'), ('id', 'id'))
+
+    seen, after = [], None
+    while True:
+        page = db.fetch_page(conn, 'id, first_name, last_name', 'students', keys, where='user_id = ?',
+                             params=(1,), after=after, per_page=2, descending=False)
+        assert page.is_first == (after is None) and len(page) <= 2
+        seen += [row['id'] for row in page]
+        if not page.next_cursor:
+            break
+        after = page.next_cursor
+    assert seen == [4, 1, 3, 2, 5]
+
+    newest = db.fetch_page(conn, 'id', 'students', (('id', 'id'),), where='user_id = ?', params=(1,), per_page=3)
+    assert [row['id'] for row in newest] == [5, 4, 3]
+    # Rows are projected, not SELECT *
+    assert newest.rows[0].keys() == ['id']
+    # A cursor of the wrong shape starts over
+    restarted = db.fetch_page(conn, 'id', 'students', (('id', 'id'),), where='user_id = ?', params=(1,),
+                              after=after, per_page=3)
+    assert [row['id'] for row in restarted] == [5, 4, 3]
+    conn.close()
+
+
+def test_list_views_page_with_per_page(client):
+    conn = db.get_db()
+    conn.executemany("INSERT INTO students (user_id, first_name, last_name, needs_description) VALUES (1, ?, ?, ?)",
+                     [('Sam', 'Diaz', 'x' * 80), ('Ada', 'Byrne', ''), ('Lu', 'Chen', '')])
+    body = db.put_content(conn, '<p>Body</p>')
+    conn.executemany('INSERT INTO lessons (user_id, title, content_hash) VALUES (1, ?, ?)',
+                     [('Lesson A', body), ('Lesson B', body), ('Lesson C', body)])
+    conn.commit()
+    conn.close()
+
+    first = ok(client.get('/diff/students?per_page=2'))
+    assert 'Byrne' in first and 'Chen' in first and 'Diaz' not in first
+    second = ok(client.get(f'/diff/students?per_page=2&after={next_page(first)}'))
+    assert 'Diaz' in second and 'Byrne' not in second and 'x' * 51 not in second
+    assert 'First Page' in second and next_page(second) is None
+
+    first = ok(client.get('/diff/library?per_page=2'))
+    assert 'Lesson C' in first and 'Lesson A' not in first
+    assert 'Lesson A' in ok(client.get(f'/diff/library?per_page=2&after={next_page(first)}'))
+
+    ok(client.post('/diff/admin/users/create', data={'email': 'u@example.com', 'password': 'pw',
+                                                     'first_name': 'U', 'last_name': 'U'}), 302)
+    first = ok(client.get('/diff/admin/statistics?per_page=1'))
+    assert next_page(first)
+    ok(client.get(f'/diff/admin/statistics?per_page=1&after={next_page(first)}'))
+
+
+def test_every_user_has_stats(db_path):
+    create_baseline(db_path)
+    db.init_db()
+    conn = db.get_db()
+    conn.execute("INSERT INTO users (email, password_hash, first_name, last_name) VALUES ('n@example.com', 'x', 'N', 'N')")
+    assert conn.execute('SELECT COUNT(*) FROM users WHERE id NOT IN (SELECT user_id FROM user_stats)').fetchone()[0] == 0
+    conn.close()
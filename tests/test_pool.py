@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+from differentiation_tool import db
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, 'DB_PATH', str(tmp_path / 'pool.db'))
+    pool = db.ConnectionPool(max_idle=2)
+    monkeypatch.setattr(db, '_pool', pool)
+    yield pool
+    pool.close_all()
+
+
+def test_connections_are_reused(pool):
+    conn = db.get_db()
+    conn.close()
+    assert db.get_db() is conn
+
+
+def test_double_close_releases_once(pool):
+    conn = db.get_db()
+    conn.close()
+    conn.close()
+    assert pool._idle == [conn]
+    assert db.get_db() is conn
+    assert db.get_db() is not conn
+
+
+def test_uncommitted_work_is_rolled_back_on_release(pool):
+    conn = db.get_db()
+    conn.execute('CREATE TABLE t (x)')
+    conn.commit()
+    conn.execute('INSERT INTO t VALUES (1)')
+    conn.close()
+    conn = db.get_db()
+    assert conn.execute('SELECT COUNT(*) FROM t').fetchone()[0] == 0
+    conn.close()
+
+
+def test_idle_connections_are_capped(pool):
+    conns = [db.get_db() for _ in range(3)]
+    for conn in conns:
+        conn.close()
+    assert len(pool._idle) == 2
+
+
+def test_one_connection_per_request(pool):
+    from flask import Flask
+    app = Flask(__name__)
+    app.teardown_appcontext(db.close_db)
+
+    with app.test_request_context():
+        conn = db.get_db()
+        conn.close()
+        assert db.get_db() is conn
+        conn.execute('CREATE TABLE t (x)')
+    assert pool._idle == [conn]
+
+    # Background threads get their own connection
+    seen = []
+    thread = threading.Thread(target=lambda: seen.append(db.get_db()))
+    thread.start()
+    thread.join()
+    assert seen[0] is conn
+    seen[0].close()
+
+
+def test_foreign_keys_are_enforced(pool):
+    db.init_db()
+    conn = db.get_db()
+    try:
+        conn.execute("INSERT INTO users (email, password_hash, first_name, last_name) VALUES ('a@b', 'x', 'A', 'B')")
+        conn.execute("INSERT INTO students (user_id, first_name, last_name) VALUES (1, 'S', 'T')")
+        conn.commit()
+        conn.execute('DELETE FROM users WHERE id = 1')
+        conn.commit()
+        assert conn.execute('SELECT COUNT(*) FROM students').fetchone()[0] == 0
+    finally:
+        conn.close()
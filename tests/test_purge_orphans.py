@@ -0,0 +1,85 @@
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+from differentiation_tool import db
+from test_migrations import BASELINE_SCHEMA
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'purge_orphans.py')
+
+
+@pytest.fixture
+def orphaned_db(tmp_path, monkeypatch):
+    """A first-release database where teacher 2 and teacher 1's session were deleted without cascading"""
+    path = str(tmp_path / 'orphans.db')
+    monkeypatch.setattr(db, 'DB_PATH', path)
+
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    for user_id in (1, 2):
+        conn.execute("INSERT INTO users (id, email, password_hash, first_name, last_name) VALUES (?, ?, 'x', 'T', 'T')",
+                     (user_id, f't{user_id}@example.com'))
+        conn.execute("INSERT INTO students (id, user_id, first_name, last_name) VALUES (?, ?, 'S', 'T')",
+                     (user_id, user_id))
+        conn.execute("INSERT INTO diff_sessions (id, user_id, original_material) VALUES (?, ?, 'Loops')",
+                     (user_id, user_id))
+        conn.execute('INSERT INTO session_students (session_id, student_id) VALUES (?, ?)', (user_id, user_id))
+        conn.execute('''INSERT INTO lessons (user_id, session_id, title, differentiated_content)
+                        VALUES (?, ?, 'Loops', '<p>Loops</p>')''', (user_id, user_id))
+    conn.execute('DELETE FROM diff_sessions WHERE id = 1')
+    conn.execute('DELETE FROM users WHERE id = 2')
+    conn.commit()
+    conn.close()
+    return path
+
+
+def purge(path, *args):
+    return subprocess.run([sys.executable, SCRIPT, path, *args], capture_output=True, text=True, check=True).stdout
+
+
+def test_init_db_refuses_orphans_without_deleting_them(orphaned_db):
+    with pytest.raises(sqlite3.IntegrityError) as error:
+        db.init_db()
+    message = str(error.value)
+    assert 'students rows 2 reference missing users rows' in message
+    assert 'lessons rows 1 reference missing diff_sessions rows' in message
+    assert 'lessons rows 2 reference missing users rows' in message
+    assert 'purge_orphans.py' in message
+
+    conn = sqlite3.connect(orphaned_db)
+    assert conn.execute('SELECT COUNT(*) FROM students').fetchone()[0] == 2
+    conn.close()
+
+
+def test_dry_run_changes_nothing(orphaned_db):
+    output = purge(orphaned_db, '--dry-run')
+    assert 'students: 1 rows reference missing users rows' in output
+    assert not [name for name in os.listdir(os.path.dirname(orphaned_db)) if '.bak-' in name]
+    with pytest.raises(sqlite3.IntegrityError):
+        db.init_db()
+
+
+def test_purge_backs_up_then_cascades(orphaned_db):
+    output = purge(orphaned_db)
+    backups = [name for name in os.listdir(os.path.dirname(orphaned_db)) if '.bak-' in name]
+    assert len(backups) == 1 and backups[0] in output
+
+    backup = sqlite3.connect(os.path.join(os.path.dirname(orphaned_db), backups[0]))
+    assert backup.execute('SELECT COUNT(*) FROM students').fetchone()[0] == 2
+    backup.close()
+
+    db.init_db()
+    conn = sqlite3.connect(orphaned_db)
+    try:
+        for table in ('students', 'lessons'):
+            assert {row[0] for row in conn.execute(f'SELECT user_id FROM {table}')} == {1}, table
+        for table in ('diff_sessions', 'session_students'):
+            assert conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] == 0, table
+        # The lesson outlives its session, as ON DELETE SET NULL would have left it
+        assert conn.execute('SELECT session_id FROM lessons').fetchone()[0] is None
+    finally:
+        conn.close()
+    assert 'No orphaned rows' in purge(orphaned_db)
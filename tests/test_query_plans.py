@@ -0,0 +1,131 @@
+"""
+Check that the app's queries use indexes instead of full table scans
+
+Every distinct statement the package ran during this test session (outside
+of schema setup) is explained against a fresh database. A plan that scans
+a table not allowed below fails, as does a foreign key with no index on its
+child column (deletes would then scan the child table to cascade). Queries
+on routes without test coverage are not checked, so cover new queries in
+tests/.
+"""
+import re
+
+import pytest
+
+from differentiation_tool import db
+
+# Full scans that are intended: (pattern matched against the statement,
+# tables allowed to be scanned, named as in the plan, i.e. by alias)
+ALLOWED_SCANS = [
+    # Whole-table admin reports: these read every user (never the usage
+    # history) by design
+    (r'SUM\(lessons_created_count\)', ('user_stats',)),
+    (r'WHERE is_admin = \?', ('users',)),
+    (r'^SELECT COUNT\(\*\) as count FROM users$', ('users',)),
+    # Admin response cache panel: the cache is bounded by its size limit, and
+    # the stats table has one row per endpoint
+    (r'FROM response_cache$', ('response_cache',)),
+    (r'SUM\(size_bytes\) OVER', ('response_cache',)),
+    (r'FROM response_cache_stats ORDER BY endpoint', ('response_cache_stats',)),
+    # Bulk writes read their id lists from json_each(?), which is the
+    # parameter, not a table
+    (r'json_each\(\?\)', ('json_each',)),
+]
+
+# A virtual table "scan" with a non-empty index string is a lookup, e.g.
+# "SCAN users_fts VIRTUAL TABLE INDEX 0:M3" for an FTS5 MATCH
+VIRTUAL_LOOKUP = re.compile(r'VIRTUAL TABLE INDEX \d+:\S')
+
+# "SCAN u USING INDEX idx_users_created": walking an index in ORDER BY order
+# and stopping after LIMIT rows, as the keyset-paged lists read
+INDEX_WALK = re.compile(r'^SCAN (\S+) USING (?:COVERING )?INDEX (\S+)')
+ORDER_BY = re.compile(r'\bORDER BY\s+(?:\w+\.)?(\w+)', re.IGNORECASE)
+
+
+@pytest.fixture(scope='module')
+def conn(tmp_path_factory, traced_statements):
+    path = str(tmp_path_factory.mktemp('plans') / 'plans.db')
+    original = db.DB_PATH
+    db.DB_PATH = path
+    # Explaining does not run the statements, but keep them out of the trace
+    db.trace_statements(None)
+    db.init_db()
+    conn = db.get_db()
+    yield conn
+    conn.close()
+    db.DB_PATH = original
+
+
+def leading_column(conn, index):
+    columns = conn.execute(f"PRAGMA index_info('{index}')").fetchall()
+    return columns[0]['name'] if columns else None
+
+
+def full_scans(conn, sql):
+    """Tables the plan reads in full, with the plan lines that do so"""
+    # Traced statements show infinite float parameters as Inf
+    sql = re.sub(r'\bInf\b', '1e999', sql)
+    try:
+        plan = [row['detail'] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}')]
+    except db.sqlite3.ProgrammingError:
+        # Statements too long to expand are traced with their placeholders
+        plan = [row['detail'] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', (1,) * sql.count('?'))]
+
+    # An index walk only stops early when it yields rows in ORDER BY order
+    # (no temp b-tree sort) and the statement has a LIMIT
+    order_by = ORDER_BY.findall(sql)
+    ordered_walk = (re.search(r'\bLIMIT\b', sql, re.IGNORECASE) and order_by
+                    and not any('USE TEMP B-TREE' in detail for detail in plan))
+
+    scans = []
+    for detail in plan:
+        if VIRTUAL_LOOKUP.search(detail):
+            continue
+        walk = INDEX_WALK.match(detail)
+        if ordered_walk and walk and leading_column(conn, walk.group(2)) == order_by[-1]:
+            continue
+        # "SCAN (subquery-1)" reads a subquery's materialized result
+        if detail.startswith('SCAN ') and not detail.startswith('SCAN ('):
+            scans.append((detail.split()[1], detail))
+    return scans
+
+
+def unindexed_foreign_keys(conn):
+    """Foreign keys whose child column does not lead any index"""
+    missing = []
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND sql LIKE '%REFERENCES%'"
+    )]
+    for table in tables:
+        leading = {leading_column(conn, index['name']) for index in conn.execute(f'PRAGMA index_list({table})')}
+        leading.update(row['name'] for row in conn.execute(f'PRAGMA table_info({table})') if row['pk'] == 1)
+        for fk in conn.execute(f'PRAGMA foreign_key_list({table})').fetchall():
+            if fk['from'] not in leading:
+                missing.append(f"{table}.{fk['from']} -> {fk['table']}")
+    return missing
+
+
+def test_queries_use_indexes(conn, traced_statements):
+    if not traced_statements:
+        pytest.skip('no statements traced; run the whole suite')
+
+    failures = []
+    for query, sql in sorted(traced_statements.items()):
+        allowed = {table for pattern, tables in ALLOWED_SCANS if re.search(pattern, query) for table in tables}
+        bad = [detail for table, detail in full_scans(conn, sql) if table not in allowed]
+        if bad:
+            failures.append(f"{query[:200]}\n    " + '\n    '.join(bad))
+    assert not failures, f"{len(failures)} of {len(traced_statements)} queries scan a table:\n" + '\n'.join(failures)
+
+
+def test_foreign_keys_are_indexed(conn):
+    assert unindexed_foreign_keys(conn) == []
+
+
+def test_only_limited_ordered_walks_are_allowed(conn):
+    conn.execute('CREATE TEMP TABLE t (a, b)')
+    conn.execute('CREATE INDEX temp.t_a ON t (a)')
+    assert full_scans(conn, 'SELECT * FROM t ORDER BY a LIMIT 5') == []
+    # Ordered by a column the index does not lead with, or unbounded
+    assert full_scans(conn, 'SELECT * FROM t INDEXED BY t_a ORDER BY b LIMIT 5')
+    assert full_scans(conn, 'SELECT * FROM t INDEXED BY t_a ORDER BY a')
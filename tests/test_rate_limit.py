@@ -0,0 +1,88 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from differentiation_tool import gemini_api
+
+
+def test_retry_after_hint():
+    assert gemini_api.retry_after_hint(google_exceptions.TooManyRequests('Quota exceeded. Please retry in 12.5s.')) == 12.5
+    error = google_exceptions.ServiceUnavailable('busy', response=SimpleNamespace(headers={'retry-after': '3'}))
+    assert gemini_api.retry_after_hint(error) == 3.0
+    retry_info = SimpleNamespace(retry_delay=SimpleNamespace(seconds=7, nanos=500_000_000))
+    assert gemini_api.retry_after_hint(google_exceptions.ResourceExhausted('quota', details=[retry_info])) == 7.5
+    assert gemini_api.retry_after_hint(google_exceptions.InternalServerError('oops')) is None
+
+
+def test_backoff_delay_is_jittered_and_capped(monkeypatch):
+    monkeypatch.setattr(gemini_api.random, 'uniform', lambda low, high: high)
+    assert gemini_api.backoff_delay(1) == gemini_api.RETRY_BASE_DELAY
+    assert gemini_api.backoff_delay(3) == gemini_api.RETRY_BASE_DELAY * 4
+    assert gemini_api.backoff_delay(30) == gemini_api.RETRY_MAX_DELAY
+    # A server hint wins over the exponential schedule
+    assert gemini_api.backoff_delay(1, google_exceptions.TooManyRequests('retry in 9s')) == 10
+
+
+def test_bucket_allows_a_burst_then_paces():
+    limiter = gemini_api.RateLimiter(rate=600, burst=2)  # one token every 0.1 s
+    assert limiter.acquire('k') < 0.01 and limiter.acquire('k') < 0.01
+    assert limiter.acquire('k') > 0.05
+    # Keys have their own buckets
+    assert limiter.acquire('other') < 0.01
+
+    with pytest.raises(gemini_api.GeminiBusyError):
+        limiter.acquire('k', max_wait=0.01)
+
+
+def test_rate_limit_error_slows_the_key():
+    limiter = gemini_api.RateLimiter(rate=60, burst=5)
+    limiter.throttle('k', 30)
+    assert limiter.stats()['k']['rate_per_minute'] == 30
+    assert limiter.stats()['k']['paused_for'] > 29
+    with pytest.raises(gemini_api.GeminiBusyError):
+        limiter.acquire('k', max_wait=1)
+
+    for _ in range(10):
+        limiter.succeeded('k')
+    assert limiter.stats()['k']['rate_per_minute'] == 60
+
+
+@pytest.fixture
+def no_waiting(monkeypatch):
+    monkeypatch.setattr(gemini_api, 'rate_limiter', gemini_api.RateLimiter(rate=6000, burst=100))
+    monkeypatch.setattr(gemini_api, 'backoff_delay', lambda attempt, error=None: 0)
+
+
+def flaky(errors, result='ok'):
+    calls = []
+
+    def call():
+        calls.append(time.monotonic())
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+    return call, calls
+
+
+def test_transient_errors_are_retried(no_waiting):
+    client = SimpleNamespace(fingerprint='k')
+    call, calls = flaky([google_exceptions.TooManyRequests('slow down'), google_exceptions.ServiceUnavailable('busy')])
+    assert gemini_api.call_with_retry(client, call) == 'ok'
+    assert len(calls) == 3
+    assert gemini_api.rate_limiter.stats()['k']['rate_per_minute'] < 6000
+
+
+def test_other_errors_are_not_retried(no_waiting):
+    call, calls = flaky([google_exceptions.PermissionDenied('bad key')])
+    with pytest.raises(google_exceptions.PermissionDenied):
+        gemini_api.call_with_retry(SimpleNamespace(fingerprint='k'), call)
+    assert len(calls) == 1
+
+
+def test_gives_up_after_max_attempts(no_waiting):
+    call, calls = flaky([google_exceptions.InternalServerError('oops')] * 10)
+    with pytest.raises(gemini_api.GeminiBusyError):
+        gemini_api.call_with_retry(SimpleNamespace(fingerprint='k'), call)
+    assert len(calls) == gemini_api.GEMINI_MAX_ATTEMPTS
@@ -0,0 +1,62 @@
+import threading
+
+import markdown
+
+from differentiation_tool import rendering
+
+LESSON = '''# Loops
+
+```python
+for i in range(3):
+    print(i)
+```
+
+```{.python hl_lines="1"}
+total = 0
+```
+
+| a | b |
+|---|---|
+| 1 | 2 |
+'''
+
+
+def fresh(text):
+    return markdown.markdown(text, extensions=rendering.MARKDOWN_EXTENSIONS)
+
+
+def test_output_matches_a_fresh_pipeline():
+    rendering.code_block_cache.clear()
+    assert rendering.render_markdown(LESSON) == fresh(LESSON)
+    # Second pass is served from the code cache and a reset instance
+    assert rendering.render_markdown(LESSON) == fresh(LESSON)
+
+
+def test_code_blocks_are_highlighted_once():
+    rendering.code_block_cache.clear()
+    rendering.render_markdown(LESSON)
+    rendering.render_markdown(LESSON)
+    # The hl_lines fence bypasses the cache
+    assert rendering.code_block_cache.stats() == {'entries': 1, 'hits': 1, 'misses': 1}
+
+
+def test_cache_evicts_least_recently_used():
+    cache = rendering.CodeBlockCache(max_size=2)
+    cache.put('a', '1')
+    cache.put('b', '2')
+    cache.get('a')
+    cache.put('c', '3')
+    assert cache.get('b') is None
+    assert cache.get('a') == '1'
+
+
+def test_each_thread_gets_its_own_instance():
+    instances = []
+    thread = threading.Thread(target=lambda: instances.append(rendering._get_markdown()))
+    thread.start()
+    thread.join()
+    assert instances[0] is not rendering._get_markdown()
+
+
+def test_wrapper_fence_is_removed():
+    assert rendering.markdown_to_html('```markdown\n# Title\n```') == fresh('# Title')
@@ -0,0 +1,84 @@
+from differentiation_tool import db, gemini_api, response_cache
+from test_routes import ok, start_session, wait_for_session, add_roster
+
+STUDENTS = [
+    {'name': 'Sam Lee', 'accommodations': 'Extended time', 'needs': 'Reading support'},
+    {'name': 'Ana Diaz', 'accommodations': '', 'needs': ''},
+]
+
+
+def test_key_ignores_formatting_and_order():
+    key = response_cache.suggestions_key('Trace the loop.\n', STUDENTS, ['1.1.2', '1.1.1'])
+    assert response_cache.suggestions_key('Trace the loop.  \r\n\r\n', STUDENTS[::-1], ['1.1.1', '1.1.2']) == key
+    assert response_cache.suggestions_key('Trace the loop.', STUDENTS, ['1.1.1']) != key
+    assert response_cache.suggestions_key('Trace the loop!', STUDENTS, ['1.1.1', '1.1.2']) != key
+
+    final = response_cache.final_content_key('Trace the loop.', ['Add a glossary'])
+    assert final != response_cache.final_content_key('Trace the loop.', ['Add a glossary', 'Chunk it'])
+
+
+def test_lookup_counts_hits_and_misses(client):
+    key = response_cache.final_content_key('Trace the loop.', ['Add a glossary'])
+    endpoint = 'generate_differentiated_content'
+    assert response_cache.lookup(1, key, endpoint) is None
+    response_cache.store(1, key, endpoint, '<p>Trace the loop.</p>')
+    assert response_cache.lookup(1, key, endpoint) == '<p>Trace the loop.</p>'
+
+    stats = response_cache.get_stats()
+    assert [(row['endpoint'], row['hits'], row['misses']) for row in stats['endpoints']] == [(endpoint, 1, 1)]
+    assert stats['entries'] == 1
+
+
+def test_opted_out_teachers_neither_read_nor_write(client):
+    key = response_cache.final_content_key('Trace the loop.', [])
+    endpoint = 'generate_differentiated_content'
+    response_cache.store(1, key, endpoint, '<p>Shared</p>')
+    db.set_response_cache_enabled(1, False)
+
+    assert response_cache.lookup(1, key, endpoint) is None
+    response_cache.store(1, response_cache.final_content_key('Other', []), endpoint, '<p>Mine</p>')
+    assert response_cache.get_stats()['entries'] == 1
+
+
+def test_failed_calls_are_not_cached(client, monkeypatch):
+    def generate_suggestions(*args, **kwargs):
+        raise gemini_api.GeminiBusyError('Gemini is busy right now')
+
+    monkeypatch.setattr(gemini_api, 'generate_suggestions', generate_suggestions)
+    add_roster(client)
+    session_id = start_session(client)
+    client.get(f'/diff/differentiate/{session_id}/suggestions')
+    assert 'busy' in wait_for_session(client, session_id)['error']
+    assert response_cache.get_stats()['entries'] == 0
+
+
+def test_eviction_by_age_then_size(client):
+    for i in range(4):
+        response_cache.store(1, f'key-{i}', 'generate_differentiated_content', 'x' * 100)
+    conn = db.get_db()
+    conn.execute("UPDATE response_cache SET created_at = datetime('now', '-40 days') WHERE cache_key = 'key-0'")
+    conn.execute("UPDATE response_cache SET last_used_at = datetime('now', '-1 day') WHERE cache_key = 'key-1'")
+    conn.commit()
+    conn.close()
+
+    assert response_cache.evict(max_bytes=250, max_age_days=30) == 2
+    conn = db.get_db()
+    try:
+        assert {row[0] for row in conn.execute('SELECT cache_key FROM response_cache')} == {'key-2', 'key-3'}
+    finally:
+        conn.close()
+
+
+def test_repeat_request_is_served_from_cache(client, monkeypatch):
+    calls = []
+    generate = gemini_api.generate_suggestions
+    monkeypatch.setattr(gemini_api, 'generate_suggestions', lambda *a, **k: calls.append(1) or generate(*a, **k))
+    add_roster(client)
+
+    first = start_session(client)
+    client.get(f'/diff/differentiate/{first}/suggestions')
+    assert wait_for_session(client, first)['ready']
+
+    second = start_session(client)
+    assert '<strong>Chunk</strong>' in ok(client.get(f'/diff/differentiate/{second}/suggestions'))
+    assert calls == [1]
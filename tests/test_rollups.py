@@ -0,0 +1,78 @@
+import sqlite3
+
+import pytest
+
+from differentiation_tool import db
+from test_migrations import create_baseline
+from test_routes import ok, ready_to_generate
+
+
+def rows(sql):
+    conn = db.get_db()
+    try:
+        return [tuple(row) for row in conn.execute(sql)]
+    finally:
+        conn.close()
+
+
+def test_usage_is_rolled_up_per_day(client):
+    for endpoint in ('generate_suggestions', 'generate_suggestions', 'generate_differentiated_content'):
+        db.track_api_usage(1, endpoint, 'Gemini API')
+    db.usage_recorder.flush()
+
+    assert rows("SELECT endpoint, count FROM api_usage_daily WHERE day = DATE('now') ORDER BY endpoint") == [
+        ('generate_differentiated_content', 1), ('generate_suggestions', 2)]
+    assert rows('SELECT api_requests_count FROM user_stats WHERE user_id = 1') == [(3,)]
+    assert 'admin@example.com' in ok(client.get('/diff/admin/statistics'))
+
+
+def test_lessons_are_rolled_up_per_day(client):
+    session_id = ready_to_generate(client)
+    ok(client.get(f'/diff/differentiate/{session_id}/stream'))
+    ok(client.post(f'/diff/differentiate/{session_id}/save'), 302)
+    assert rows("SELECT count FROM lessons_daily WHERE day = DATE('now') AND user_id = 1") == [(1,)]
+
+    ok(client.post('/diff/library/1/delete'), 302)
+    assert rows("SELECT count FROM lessons_daily WHERE day = DATE('now') AND user_id = 1") == [(0,)]
+    ok(client.get('/diff/admin'))
+
+
+def test_migration_backfills_history(tmp_path):
+    path = str(tmp_path / 'baseline.db')
+    create_baseline(path)
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO api_usage (user_id, endpoint, request_type, created_at) VALUES (1, ?, 'Gemini API', ?)",
+                     [('generate_suggestions', '2024-01-01 09:00:00'), ('generate_suggestions', '2024-01-01 15:00:00'),
+                      ('generate_suggestions', '2024-01-02 09:00:00')])
+    conn.commit()
+    conn.close()
+
+    db.configure(path)
+    try:
+        db.init_db()
+        assert rows('SELECT day, count FROM api_usage_daily ORDER BY day') == [('2024-01-01', 2), ('2024-01-02', 1)]
+        assert rows('SELECT count FROM lessons_daily') == [(1,)]
+        assert rows('SELECT api_requests_count FROM user_stats') == [(3,)]
+    finally:
+        db.configure(db.MEMORY_DB)
+
+
+def test_orphaned_history_is_refused_before_backfilling(tmp_path, monkeypatch):
+    path = str(tmp_path / 'orphans.db')
+    db.configure(path)
+    try:
+        # Migrated as far as the rollups by a release that did not enforce
+        # foreign keys
+        monkeypatch.setattr(db, 'MIGRATIONS', db.MIGRATIONS[:2])
+        db.init_db()
+        monkeypatch.undo()
+        conn = sqlite3.connect(path)
+        conn.execute("INSERT INTO api_usage (user_id, endpoint, request_type) VALUES (2, 'generate_suggestions', 'Gemini API')")
+        conn.commit()
+        conn.close()
+
+        with pytest.raises(sqlite3.IntegrityError, match='api_usage rows 1 reference missing users rows'):
+            db.init_db()
+        assert rows('PRAGMA user_version') == [(2,)]
+    finally:
+        db.configure(db.MEMORY_DB)
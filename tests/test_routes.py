@@ -0,0 +1,240 @@
+import re
+import time
+
+from differentiation_tool import db, gemini_api
+
+
+def ok(response, status=200):
+    assert response.status_code == status, response.data[-2000:]
+    return response.data.decode()
+
+
+def wait_for_session(client, session_id):
+    for _ in range(200):
+        status = client.get(f'/diff/differentiate/{session_id}/status').get_json()
+        if status['ready'] or status['error']:
+            return status
+        time.sleep(0.02)
+    raise AssertionError('job never finished')
+
+
+def add_roster(client):
+    for first, last in (('Sam', 'Lee'), ('Ana', 'Diaz')):
+        ok(client.post('/diff/students/add', data={'first_name': first, 'last_name': last,
+                                                   'accommodations': 'Extended time',
+                                                   'needs_description': 'Reading support'}), 302)
+    ok(client.post('/diff/groups/add', data={'name': 'ELL', 'students': ['1', '2']}), 302)
+
+
+def start_session(client, material='# Loops\n\nTrace the loop.', **data):
+    response = client.post('/diff/differentiate/new', data={'title': 'Loops', 'material': material,
+                                                            'students': ['1'], **data})
+    return int(ok(response, 302) and response.headers['Location'].rstrip('/').split('/')[-2])
+
+
+def approved_values(page):
+    return re.findall(r'name="approved" value="(\d+)"', page)
+
+
+def test_differentiation_workflow(client):
+    add_roster(client)
+    ok(client.get('/diff/differentiate/new'))
+    session_id = start_session(client, groups=['1'], standards=['1.1.1'])
+
+    # The page returns at once and polls while the job runs
+    ok(client.get(f'/diff/differentiate/{session_id}/suggestions'))
+    assert wait_for_session(client, session_id)['ready']
+    page = ok(client.get(f'/diff/differentiate/{session_id}/suggestions'))
+    assert '<strong>Chunk</strong>' in page
+    ok(client.post(f'/diff/differentiate/{session_id}/refine', data={'approved': approved_values(page)[:1]}), 302)
+
+    # The final lesson streams to the page
+    assert '/stream' in ok(client.get(f'/diff/differentiate/{session_id}/generate'))
+    stream = ok(client.get(f'/diff/differentiate/{session_id}/stream'))
+    assert stream.index('event: chunk') < stream.index('event: done')
+    assert 'Trace the loop' in ok(client.get(f'/diff/differentiate/{session_id}/generate'))
+    ok(client.post(f'/diff/differentiate/{session_id}/save'), 302)
+
+    assert 'Loops' in ok(client.get('/diff/dashboard'))
+    assert 'Loops' in ok(client.get('/diff/library'))
+    ok(client.get('/diff/library/1'))
+
+
+def ready_to_generate(client):
+    add_roster(client)
+    session_id = start_session(client)
+    client.get(f'/diff/differentiate/{session_id}/suggestions')
+    wait_for_session(client, session_id)
+    page = ok(client.get(f'/diff/differentiate/{session_id}/suggestions'))
+    ok(client.post(f'/diff/differentiate/{session_id}/refine', data={'approved': approved_values(page)}), 302)
+    return session_id
+
+
+def test_background_final_content(client, monkeypatch):
+    from differentiation_tool import routes
+    monkeypatch.setattr(routes, 'STREAM_FINAL_CONTENT', False)
+    session_id = ready_to_generate(client)
+
+    ok(client.get(f'/diff/differentiate/{session_id}/generate'))
+    assert wait_for_session(client, session_id)['ready']
+    assert 'Trace the loop' in ok(client.get(f'/diff/differentiate/{session_id}/generate'))
+
+
+def test_failed_stream_releases_session(client, monkeypatch):
+    def stream_differentiated_content(*args, **kwargs):
+        yield '# Differentiated\n\nFirst block.\n\n'
+        raise RuntimeError('connection reset')
+
+    monkeypatch.setattr(gemini_api, 'stream_differentiated_content', stream_differentiated_content)
+    session_id = ready_to_generate(client)
+
+    stream = ok(client.get(f'/diff/differentiate/{session_id}/stream'))
+    assert 'event: failed' in stream and 'connection reset' in stream
+    status = wait_for_session(client, session_id)
+    assert status['phase'] == 'ready_to_generate'
+    assert 'connection reset' in status['error']
+
+
+def test_failed_job_reports_error(client, monkeypatch):
+    def generate_suggestions(*args, **kwargs):
+        raise RuntimeError('quota exceeded')
+
+    monkeypatch.setattr(gemini_api, 'generate_suggestions', generate_suggestions)
+    add_roster(client)
+    session_id = start_session(client)
+    ok(client.get(f'/diff/differentiate/{session_id}/suggestions'))
+    status = wait_for_session(client, session_id)
+    assert 'quota exceeded' in status['error']
+    assert status['phase'] == 'select_students'
+
+
+def test_tampered_selection_is_refused(client):
+    add_roster(client)
+    session_id = start_session(client)
+    client.get(f'/diff/differentiate/{session_id}/suggestions')
+    wait_for_session(client, session_id)
+
+    for approved in (['x'], [''], ['99']):
+        response = client.post(f'/diff/differentiate/{session_id}/refine', data={'approved': approved})
+        assert ok(response, 302) and response.headers['Location'].endswith(f'/differentiate/{session_id}/suggestions')
+    assert 'Invalid suggestion selection' in ok(client.get(f'/diff/differentiate/{session_id}/suggestions'))
+
+    conn = db.get_db()
+    try:
+        assert conn.execute('SELECT phase FROM diff_sessions WHERE id = ?', (session_id,)).fetchone()[0] == 'review_suggestions'
+    finally:
+        conn.close()
+
+
+def test_suggestions_are_stored_as_rendered_rows(client):
+    add_roster(client)
+    session_id = start_session(client)
+    client.get(f'/diff/differentiate/{session_id}/suggestions')
+    wait_for_session(client, session_id)
+    values = approved_values(ok(client.get(f'/diff/differentiate/{session_id}/suggestions')))
+    ok(client.post(f'/diff/differentiate/{session_id}/refine', data={'approved': values[1:]}), 302)
+
+    conn = db.get_db()
+    try:
+        rows = conn.execute('SELECT * FROM session_suggestions WHERE session_id = ? ORDER BY position',
+                            (session_id,)).fetchall()
+    finally:
+        conn.close()
+    assert [str(row['id']) for row in rows] == values
+    assert all(row['text_html'].startswith('<p>') for row in rows)
+    assert [row['approved'] for row in rows] == [0] + [1] * (len(rows) - 1)
+
+
+def test_legacy_json_suggestions_are_converted(client):
+    add_roster(client)
+    session_id = start_session(client)
+    conn = db.get_db()
+    conn.execute(
+        "UPDATE diff_sessions SET phase = 'review_suggestions', suggestions = ?, approved_suggestions = ? WHERE id = ?",
+        ('[{"text": "**Chunk** it", "applies_to": []}, {"text": "Add visuals", "applies_to": []}]',
+         '[{"text": "Add visuals", "applies_to": []}]', session_id)
+    )
+    conn.commit()
+    conn.close()
+
+    assert '<strong>Chunk</strong>' in ok(client.get(f'/diff/differentiate/{session_id}/suggestions'))
+    conn = db.get_db()
+    try:
+        rows = conn.execute('SELECT text, approved FROM session_suggestions WHERE session_id = ? ORDER BY position',
+                            (session_id,)).fetchall()
+    finally:
+        conn.close()
+    assert [tuple(row) for row in rows] == [('**Chunk** it', 0), ('Add visuals', 1)]
+
+
+def test_signup_and_approval(client, app):
+    other = app.test_client()
+    ok(other.get('/diff/signup'))
+    ok(other.post('/diff/signup', data={'email': 't@example.com', 'password': 'pw',
+                                        'first_name': 'Tia', 'last_name': 'Teacher'}), 302)
+    assert 'pending approval' in ok(other.post('/diff/login', data={'email': 't@example.com', 'password': 'pw'}))
+
+    assert 't@example.com' in ok(client.get('/diff/admin'))
+    ok(client.post('/diff/admin/users/approve/2'), 302)
+    ok(other.post('/diff/login', data={'email': 't@example.com', 'password': 'pw'}), 302)
+    ok(other.get('/diff/dashboard'))
+    ok(other.get('/diff/logout'), 302)
+
+
+def test_api_key_and_cache_settings(client):
+    assert client.get('/diff/api/get-api-key-status').get_json()['has_own_key']
+    assert client.post('/diff/api/save-api-key', json={'api_key': 'new-key'}).get_json()['success']
+    assert client.post('/diff/api/response-cache', json={'enabled': False}).get_json() == {'success': True, 'enabled': False}
+
+
+def test_students_and_groups(client):
+    add_roster(client)
+    assert 'Diaz' in ok(client.get('/diff/students'))
+    ok(client.get('/diff/students/edit/1'))
+    ok(client.post('/diff/students/edit/1', data={'first_name': 'Sam', 'last_name': 'Li',
+                                                  'accommodations': '', 'needs_description': ''}), 302)
+
+    assert 'ELL' in ok(client.get('/diff/groups'))
+    ok(client.get('/diff/groups/edit/1'))
+    ok(client.post('/diff/groups/edit/1', data={'name': 'ELL', 'students': ['2']}), 302)
+    ok(client.post('/diff/students/delete/2'), 302)
+    ok(client.post('/diff/groups/delete/1'), 302)
+
+    conn = db.get_db()
+    try:
+        assert conn.execute('SELECT COUNT(*) FROM group_members').fetchone()[0] == 0
+    finally:
+        conn.close()
+
+
+def test_delete_lesson_and_session(client):
+    session_id = ready_to_generate(client)
+    ok(client.get(f'/diff/differentiate/{session_id}/stream'))
+    ok(client.post(f'/diff/differentiate/{session_id}/save'), 302)
+
+    ok(client.post('/diff/library/1/delete'), 302)
+    ok(client.post(f'/diff/session/{session_id}/delete'), 302)
+    assert 'Loops' not in ok(client.get('/diff/dashboard'))
+
+
+def test_admin_views(client):
+    ok(client.get('/diff/admin/users/create'))
+    for i in range(3):
+        ok(client.post('/diff/admin/users/create', data={'email': f'u{i}@example.com', 'password': 'pw',
+                                                         'first_name': 'User', 'last_name': str(i),
+                                                         'is_active': '1'}), 302)
+    assert 'u2@example.com' in ok(client.get('/diff/admin/users'))
+    assert 'u1@example.com' in ok(client.get('/diff/admin/users?search=u1'))
+    ok(client.get('/diff/admin/users/edit/2'))
+    ok(client.post('/diff/admin/users/edit/2', data={'email': 'u0@example.com', 'first_name': 'User',
+                                                     'last_name': 'Zero', 'is_active': '1'}), 302)
+    db.track_api_usage(2, 'generate_suggestions', 'Gemini API')
+    assert 'u0@example.com' in ok(client.get('/diff/admin/statistics'))
+
+    ok(client.post('/diff/admin/users/delete/2'), 302)
+    ok(client.post('/diff/admin/users/bulk-delete', data={'user_ids': ['3', '4']}), 302)
+    conn = db.get_db()
+    try:
+        assert conn.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 1
+    finally:
+        conn.close()
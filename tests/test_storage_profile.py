@@ -0,0 +1,101 @@
+import os
+import threading
+
+import pytest
+
+from differentiation_tool import db
+
+
+@pytest.fixture
+def path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'profile.db')
+    monkeypatch.setattr(db, 'DB_PATH', path)
+    monkeypatch.setattr(db, '_pool', db.ConnectionPool())
+    yield path
+    db._pool.close_all()
+
+
+def pragmas(conn):
+    return {name: conn.execute(f'PRAGMA {name}').fetchone()[0]
+            for name in ('journal_mode', 'synchronous', 'busy_timeout', 'foreign_keys')}
+
+
+def test_wal_profile(path):
+    conn = db.get_db()
+    try:
+        assert pragmas(conn) == {'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 10000, 'foreign_keys': 1}
+    finally:
+        conn.close()
+
+
+def test_compat_profile_keeps_rollback_journal(path, monkeypatch):
+    monkeypatch.setattr(db, 'STORAGE_PROFILE', 'compat')
+    conn = db.get_db()
+    try:
+        assert pragmas(conn) == {'journal_mode': 'delete', 'synchronous': 2, 'busy_timeout': 10000, 'foreign_keys': 1}
+    finally:
+        conn.close()
+    assert db.checkpoint() is None
+
+
+def test_readers_are_not_blocked_by_a_writer(path):
+    writer = db.get_db()
+    writer.execute('CREATE TABLE t (x)')
+    writer.execute('INSERT INTO t VALUES (1)')
+    writer.commit()
+
+    writer.execute('BEGIN IMMEDIATE')
+    writer.execute('INSERT INTO t VALUES (2)')
+    reader = db.get_db()
+    try:
+        assert reader.execute('SELECT COUNT(*) FROM t').fetchone()[0] == 1
+    finally:
+        reader.close()
+        writer.commit()
+        writer.close()
+
+
+def test_writers_wait_for_the_lock(path):
+    setup = db.get_db()
+    setup.execute('CREATE TABLE t (x)')
+    setup.commit()
+    setup.close()
+
+    errors = []
+
+    def write(n):
+        conn = db.get_db()
+        try:
+            for i in range(20):
+                conn.execute('INSERT INTO t VALUES (?)', (n * 100 + i,))
+                conn.commit()
+        except Exception as error:
+            errors.append(error)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    conn = db.get_db()
+    try:
+        assert conn.execute('SELECT COUNT(*) FROM t').fetchone()[0] == 160
+    finally:
+        conn.close()
+
+
+def test_checkpoint_truncates_the_wal(path):
+    conn = db.get_db()
+    conn.execute('CREATE TABLE t (x)')
+    conn.executemany('INSERT INTO t VALUES (?)', [(i,) for i in range(1000)])
+    conn.commit()
+    conn.close()
+    assert os.path.getsize(path + '-wal') > 0
+
+    busy, _, _ = db.checkpoint()
+    assert busy == 0
+    assert os.path.getsize(path + '-wal') == 0
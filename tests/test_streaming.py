@@ -0,0 +1,49 @@
+from differentiation_tool import rendering
+
+LESSON = '''# Loops
+
+Trace each loop by hand.
+
+```python
+for i in range(3):
+
+    print(i)
+```
+
+- Step one
+- Step two
+'''
+
+
+def feed_in_pieces(renderer, text, size=7):
+    return [renderer.feed(text[i:i + size]) for i in range(0, len(text), size)]
+
+
+def test_blocks_are_rendered_as_they_complete():
+    renderer = rendering.IncrementalMarkdownRenderer()
+    fragments = [html for html in feed_in_pieces(renderer, LESSON) if html]
+    fragments.append(renderer.finish())
+
+    assert fragments[0] == '<h1>Loops</h1>'
+    html = ''.join(fragments)
+    assert '<p>Trace each loop by hand.</p>' in html
+    # The blank line inside the code fence is not a block boundary
+    assert sum('print' in fragment for fragment in fragments) == 1
+    assert html.index('Loops') < html.index('Step two')
+    assert renderer.full_html() == rendering.markdown_to_html(LESSON)
+
+
+def test_wrapping_markdown_fence_is_dropped():
+    renderer = rendering.IncrementalMarkdownRenderer()
+    fragments = feed_in_pieces(renderer, '```markdown\n# Loops\n\nTrace it.\n```')
+    html = ''.join(fragments) + renderer.finish()
+
+    assert '```' not in html
+    assert '<h1>Loops</h1>' in html and '<p>Trace it.</p>' in html
+
+
+def test_nothing_is_rendered_before_a_block_completes():
+    renderer = rendering.IncrementalMarkdownRenderer()
+    assert renderer.feed('# Loo') == ''
+    assert renderer.feed('ps\nTrace') == ''
+    assert renderer.finish() == rendering.markdown_to_html('# Loops\nTrace')
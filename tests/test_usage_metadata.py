@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+
+from differentiation_tool import db, gemini_api
+from test_routes import ok
+
+CACHE = SimpleNamespace(name='cachedContents/curriculum')
+
+
+def usage(prompt, cached, output):
+    return SimpleNamespace(prompt_token_count=prompt, cached_content_token_count=cached,
+                           candidates_token_count=output)
+
+
+def test_rollups_sum_tokens_and_cache_hits(db_path):
+    db.init_db()
+    conn = db.get_db()
+    conn.execute("INSERT INTO users (id, email, password_hash, first_name, last_name) VALUES (1, 't@example.com', 'x', 'T', 'T')")
+    conn.commit()
+    conn.close()
+
+    db.track_api_usage(1, 'generate_suggestions', 'Gemini API', {
+        'model': 'gemini-2.0-flash', 'cache_name': CACHE.name, 'prompt_tokens': 1000, 'cached_tokens': 800,
+        'output_tokens': 200, 'latency_ms': 1500})
+    db.track_api_usage(1, 'generate_suggestions', 'Gemini API', {
+        'model': 'gemini-2.0-flash', 'prompt_tokens': 300, 'output_tokens': 50, 'latency_ms': 500})
+    # Recorded without metadata: a request, but not metered
+    db.track_api_usage(1, 'generate_suggestions', 'Gemini API')
+    db.usage_recorder.flush()
+
+    conn = db.get_db()
+    try:
+        row = conn.execute('SELECT model, cache_name, cached_tokens, latency_ms FROM api_usage ORDER BY id LIMIT 1').fetchone()
+        assert tuple(row) == ('gemini-2.0-flash', CACHE.name, 800, 1500)
+        expected = (3, 2, 1300, 800, 250, 1, 2000)
+        daily = conn.execute('''SELECT count, metered, prompt_tokens, cached_tokens, output_tokens, cache_hits, latency_ms
+                                FROM api_usage_daily''').fetchone()
+        assert tuple(daily) == expected
+        stats = conn.execute('''SELECT api_requests_count, metered, prompt_tokens, cached_tokens, output_tokens,
+                                       cache_hits, latency_ms FROM user_stats''').fetchone()
+        assert tuple(stats) == expected
+    finally:
+        conn.close()
+
+
+class Chunk:
+    def __init__(self, text, usage_metadata=None):
+        self.text = text
+        self.candidates = [SimpleNamespace(content=SimpleNamespace(parts=[text]))]
+        self.usage_metadata = usage_metadata
+
+
+@pytest.fixture
+def recorded(monkeypatch):
+    """Gemini replaced by a model with fixed token counts; returns the usage it records"""
+    class Model:
+        model_name = 'models/gemini-2.0-flash'
+
+        def generate_content(self, prompt, stream=False):
+            if stream:
+                return iter([Chunk('# Lesson\n\n'), Chunk('Body', usage(900, 700, 40))])
+            return Chunk('# Lesson', usage(1200, 700, 60))
+
+    client = SimpleNamespace(fingerprint='k', model=lambda cached_content=None: Model())
+
+    @contextmanager
+    def gemini_client(api_key=None):
+        yield client
+
+    calls = []
+    monkeypatch.setattr(gemini_api, 'gemini_client', gemini_client)
+    monkeypatch.setattr(gemini_api, 'get_or_create_curriculum_cache', lambda client=None: CACHE)
+    monkeypatch.setattr(gemini_api, 'rate_limiter', gemini_api.RateLimiter(rate=6000, burst=100))
+    monkeypatch.setattr(gemini_api.db, 'track_api_usage',
+                        lambda user_id, endpoint, request_type, metadata: calls.append((user_id, endpoint, metadata)))
+    return calls
+
+
+def test_calls_record_their_usage(recorded):
+    assert '<h1>Lesson</h1>' in gemini_api.generate_differentiated_content('Loops', [], api_key='k', user_id=7)
+    (user_id, endpoint, metadata), = recorded
+    assert (user_id, endpoint) == (7, 'generate_differentiated_content')
+    assert metadata['model'] == 'models/gemini-2.0-flash' and metadata['cache_name'] == CACHE.name
+    assert (metadata['prompt_tokens'], metadata['cached_tokens'], metadata['output_tokens']) == (1200, 700, 60)
+    assert metadata['latency_ms'] >= 0
+
+    # Nothing is recorded without a user
+    gemini_api.generate_differentiated_content('Loops', [], api_key='k')
+    assert len(recorded) == 1
+
+
+def test_stream_records_the_last_chunk(recorded):
+    assert ''.join(gemini_api.stream_differentiated_content('Loops', [], api_key='k', user_id=7)) == '# Lesson\n\nBody'
+    assert recorded[0][2]['prompt_tokens'] == 900
+
+    # A client that goes away mid-stream is still recorded
+    stream = gemini_api.stream_differentiated_content('Loops', [], api_key='k', user_id=7)
+    next(stream)
+    stream.close()
+    assert len(recorded) == 2 and recorded[1][2]['prompt_tokens'] is None
+
+
+def test_statistics_show_tokens(client):
+    db.track_api_usage(1, 'generate_suggestions', 'Gemini API', {'prompt_tokens': 12345, 'cached_tokens': 10000,
+                                                                  'output_tokens': 678, 'latency_ms': 2000})
+    db.usage_recorder.flush()
+    page = ok(client.get('/diff/admin/statistics'))
+    assert '12,345 / 10,000 / 678' in page and '100.0%' in page and '2.0s' in page
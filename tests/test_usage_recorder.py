@@ -0,0 +1,124 @@
+import sqlite3
+import time
+
+import pytest
+from flask import Flask
+
+from differentiation_tool import db
+
+
+@pytest.fixture
+def teachers(db_path):
+    db.init_db()
+    conn = db.get_db()
+    conn.executemany(
+        "INSERT INTO users (id, email, password_hash, first_name, last_name) VALUES (?, ?, 'x', 'T', ?)",
+        [(user_id, f't{user_id}@example.com', str(user_id)) for user_id in (1, 2)]
+    )
+    conn.commit()
+    conn.close()
+    return (1, 2)
+
+
+def usage_rows():
+    conn = db.get_db()
+    try:
+        return [row[0] for row in conn.execute('SELECT user_id FROM api_usage ORDER BY id')]
+    finally:
+        conn.close()
+
+
+def wait_until_written(recorder, count):
+    for _ in range(200):
+        if not recorder.pending() and len(usage_rows()) == count:
+            return
+        time.sleep(0.01)
+    raise AssertionError('events were never written')
+
+
+def test_events_are_written_in_batches(teachers):
+    recorder = db.UsageRecorder(mode='buffered')
+    for _ in range(3):
+        recorder.record(1, 'generate_suggestions', 'Gemini API')
+    time.sleep(0.05)
+    # Neither 200 events nor 5 seconds yet
+    assert recorder.pending() == 3
+    assert recorder.flush() == 3
+    assert usage_rows() == [1, 1, 1]
+
+
+def test_recording_never_writes_on_the_callers_thread(teachers):
+    # The request holds the write lock on its connection; writing the event
+    # on another connection from this thread would wait for ourselves
+    app = Flask(__name__)
+    app.teardown_appcontext(db.close_db)
+    recorder = db.UsageRecorder(mode='sync')
+    with app.test_request_context():
+        conn = db.get_db()
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute("UPDATE users SET default_key_requests = 1 WHERE id = 1")
+        started = time.monotonic()
+        recorder.record(1, 'generate_suggestions', 'Gemini API')
+        assert time.monotonic() - started < 0.5
+        conn.commit()
+
+    # Sync mode writes it as soon as the lock is free
+    wait_until_written(recorder, 1)
+
+
+def test_only_the_newest_events_are_kept_when_writes_fall_behind(teachers, monkeypatch, caplog):
+    monkeypatch.setitem(db.USAGE_MODES, 'buffered', {'max_events': 200, 'max_delay': 5.0, 'max_pending': 3})
+    recorder = db.UsageRecorder(mode='buffered')
+    for user_id in (2, 1, 1, 1):
+        recorder.record(user_id, 'generate_suggestions', 'Gemini API')
+    assert recorder.pending() == 3
+    assert 'dropped 1 oldest events' in caplog.text
+    assert recorder.flush() == 3
+    assert usage_rows() == [1, 1, 1]
+
+
+def test_events_of_deleted_teacher_are_dropped(teachers, caplog):
+    recorder = db.UsageRecorder(mode='buffered')
+    for user_id in (1, 2, 1):
+        recorder.record(user_id, 'generate_suggestions', 'Gemini API')
+
+    # The admin deletes teacher 2 while their event is still buffered
+    conn = db.get_db()
+    conn.execute('DELETE FROM users WHERE id = 2')
+    conn.commit()
+    conn.close()
+
+    assert recorder.flush() == 2
+    assert recorder.pending() == 0
+    assert usage_rows() == [1, 1]
+    assert caplog.text.count('Dropped API usage event for user 2') == 1
+
+    # Later events are not held up by the dropped one
+    recorder.record(1, 'generate_suggestions', 'Gemini API')
+    assert recorder.flush() == 1
+    assert usage_rows() == [1, 1, 1]
+
+
+def test_locked_database_is_retried_with_backoff(teachers, monkeypatch):
+    monkeypatch.setitem(db.STORAGE_PROFILES[db.STORAGE_PROFILE], 'busy_timeout', 50)
+    db._pool.close_all()
+    recorder = db.UsageRecorder(mode='buffered')
+    recorder.record(1, 'generate_suggestions', 'Gemini API')
+
+    blocker = sqlite3.connect(db.DB_PATH)
+    blocker.execute('BEGIN EXCLUSIVE')
+    try:
+        assert recorder.flush() == 0
+        assert recorder.pending() == 1
+        first_delay = recorder._retry_delay
+        assert recorder._retry_at > time.monotonic()
+
+        assert recorder.flush() == 0
+        assert recorder._retry_delay == 2 * first_delay
+    finally:
+        blocker.rollback()
+        blocker.close()
+
+    assert recorder.flush() == 1
+    assert recorder._retry_at == 0
+    assert usage_rows() == [1]
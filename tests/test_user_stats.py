@@ -0,0 +1,76 @@
+import sqlite3
+
+from differentiation_tool import db
+from test_migrations import create_baseline
+from test_routes import add_roster, ok
+
+
+def stats(user_id=1):
+    conn = db.get_db()
+    try:
+        row = conn.execute('SELECT students_count, groups_count, lessons_created_count FROM user_stats WHERE user_id = ?',
+                           (user_id,)).fetchone()
+        return tuple(row) if row else None
+    finally:
+        conn.close()
+
+
+def member_counts():
+    conn = db.get_db()
+    try:
+        return [tuple(row) for row in conn.execute('SELECT name, member_count FROM groups ORDER BY id')]
+    finally:
+        conn.close()
+
+
+def test_counters_follow_roster_changes(client):
+    add_roster(client)
+    assert stats() == (2, 1, 0)
+    assert member_counts() == [('ELL', 2)]
+    assert 'ELL' in ok(client.get('/diff/groups'))
+
+    ok(client.post('/diff/groups/edit/1', data={'name': 'ELL', 'students': ['2']}), 302)
+    assert member_counts() == [('ELL', 1)]
+
+    # Cascaded deletes fire the triggers too
+    ok(client.post('/diff/students/delete/2'), 302)
+    assert stats() == (1, 1, 0)
+    assert member_counts() == [('ELL', 0)]
+
+
+def test_dashboard_reads_the_counters(client):
+    add_roster(client)
+    conn = db.get_db()
+    conn.execute('UPDATE user_stats SET lessons_created_count = 7 WHERE user_id = 1')
+    conn.commit()
+    conn.close()
+    assert '>7<' in ok(client.get('/diff/dashboard')).replace(' ', '').replace('\n', '')
+
+
+def test_deleting_a_teacher_removes_their_counters(client):
+    add_roster(client)
+    conn = db.get_db()
+    try:
+        conn.execute('DELETE FROM users WHERE id = 1')
+        conn.commit()
+    finally:
+        conn.close()
+    assert stats() is None
+
+
+def test_migration_backfills_existing_rows(tmp_path):
+    path = str(tmp_path / 'baseline.db')
+    create_baseline(path)
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO groups (id, user_id, name) VALUES (1, 1, 'G')")
+    conn.execute('INSERT INTO group_members (group_id, student_id) VALUES (1, 1)')
+    conn.commit()
+    conn.close()
+
+    db.configure(path)
+    try:
+        db.init_db()
+        assert stats() == (1, 1, 1)
+        assert member_counts() == [('G', 1)]
+    finally:
+        db.configure(db.MEMORY_DB)